@@ -0,0 +1,234 @@
+"""
+Микробенчмарки горячих функций бота.
+
+Для каждого размера данных (по умолчанию 1 000, 100 000 и 1 000 000 строк)
+создается временная база, заполняется пользователями, блокировками,
+напоминаниями, днями рождения и журналом действий, и замеряются:
+  - check_access вокруг пустого обработчика;
+  - is_banned / is_accepted;
+  - day_keyboard / month_keyboard (из кэша и сборка с нуля);
+  - days_to_birthday;
+  - один проход checker (run_checker_sweep);
+  - list_users / show_logs (первая страница и страница из середины).
+
+Telegram не вызывается: bot подменяется FakeBot, который только
+записывает вызовы. Очередь отправки работает, но без ограничений скорости.
+Результат печатается в JSON, чтобы сравнивать прогоны между коммитами.
+
+Примеры:
+    python bot_benchmark.py
+    python bot_benchmark.py --sizes 1000,100000 --repeat 500 --output before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from types import SimpleNamespace
+
+from bot_loader import BOT_FILE, FakeBot, load_bot
+
+FIRST_CHAT_ID = 1_000_000
+# Сколько дней рождения у одного пользователя
+BIRTHDAYS_PER_CHAT = 50
+# Сколько напоминаний наступает к каждому проходу checker
+DUE_REMINDERS = 100
+
+
+def fake_message(chat_id, text=""):
+    user = SimpleNamespace(id=chat_id, username=f"user{chat_id}", first_name="Bench", last_name=None)
+    return SimpleNamespace(chat=SimpleNamespace(id=chat_id), text=text, from_user=user, message_id=1)
+
+
+def fake_call(chat_id, data):
+    return SimpleNamespace(id="bench", data=data, message=fake_message(chat_id))
+
+
+def seed(tg, rows):
+    conn = tg.get_db_connection()
+    now = tg.now_epoch()
+    today = datetime.now(tg.TZ).date()
+    chat_ids = range(FIRST_CHAT_ID, FIRST_CHAT_ID + rows)
+    birthday_chats = max(1, rows // BIRTHDAYS_PER_CHAT)
+
+    conn.executemany(
+        "INSERT INTO users (chat_id, username, first_name, accepted, registered_date) VALUES (?, ?, ?, ?, ?)",
+        ((chat_id, f"user{chat_id}", f"Name_{chat_id}", int(chat_id % 10 != 9), now - (chat_id % 86400))
+         for chat_id in chat_ids)
+    )
+    conn.execute(
+        "INSERT INTO users (chat_id, first_name, accepted, registered_date) VALUES (?, 'Admin', 1, ?)",
+        (tg.ADMIN_ID, now)
+    )
+    # Каждый сотый заблокирован, половина блокировок - срочные
+    conn.executemany(
+        "INSERT INTO bans (chat_id, until, reason) VALUES (?, ?, ?)",
+        ((chat_id, None if chat_id % 200 == 0 else now + 86400, "spam")
+         for chat_id in chat_ids if chat_id % 100 == 0)
+    )
+    # Напоминания в будущем, по одному в минуту начиная с послезавтра;
+    # DUE_REMINDERS из них наступают перед каждым проходом checker
+    conn.executemany(
+        "INSERT INTO reminders (chat_id, text, remind_time, repeat_type, notify_before, done, notify_at) "
+        "VALUES (?, ?, ?, ?, 0, 0, ?)",
+        ((FIRST_CHAT_ID + i % rows, f"Reminder *{i}*", now + 2 * 86400 + i * 60, "none" if i % 4 else "daily",
+          now + 2 * 86400 + i * 60)
+         for i in range(rows))
+    )
+    conn.executemany(
+        "INSERT INTO birthdays (chat_id, name, birth_date, next_occurrence) VALUES (?, ?, ?, ?)",
+        ((FIRST_CHAT_ID + i % birthday_chats, f"Friend_{i}", f"1990-{i % 12 + 1:02d}-{i % 28 + 1:02d}",
+          tg.next_birthday(date(1990, i % 12 + 1, i % 28 + 1), today).isoformat())
+         for i in range(rows))
+    )
+    conn.executemany(
+        "INSERT INTO admin_logs (admin_id, action, target_id, details, timestamp) VALUES (?, ?, ?, ?, ?)",
+        ((tg.ADMIN_ID, "ban" if i % 2 else "unban", FIRST_CHAT_ID + i % rows, f"Причина: test_{i}", now - rows + i)
+         for i in range(rows))
+    )
+    conn.commit()
+
+
+def make_reminders_due(tg):
+    conn = tg.get_db_connection()
+    conn.execute(
+        "UPDATE reminders SET done = 0, remind_time = ?1, notify_at = ?1, claimed_until = NULL WHERE id <= ?2",
+        (tg.now_epoch() - 60, DUE_REMINDERS)
+    )
+    conn.commit()
+
+
+def bench(func, repeat, setup=None):
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+
+    samples.sort()
+    return {
+        "runs": repeat,
+        "mean_us": round(sum(samples) / repeat * 1e6, 2),
+        "min_us": round(samples[0] * 1e6, 2),
+        "p50_us": round(samples[repeat // 2] * 1e6, 2),
+        "p99_us": round(samples[min(repeat - 1, int(repeat * 0.99))] * 1e6, 2),
+    }
+
+
+def run_size(rows, repeat, metrics):
+    tmp_dir = tempfile.mkdtemp(prefix="bot_benchmark_")
+    tg = load_bot(os.path.join(tmp_dir, "bot.db"))
+    tg.METRICS_ENABLED = metrics
+
+    started = time.perf_counter()
+    seed(tg, rows)
+    seed_seconds = time.perf_counter() - started
+
+    fake = FakeBot()
+    tg.bot = fake
+    tg.OUTBOX_PER_CHAT_INTERVAL = 0
+    tg.outbox_bucket = tg.TokenBucket(10 ** 9, 10 ** 9)
+    tg.start_outbox()
+    tg.load_access_cache()
+    # Поздравления - отдельная ежедневная задача, в проход checker не входят
+    tg.last_birthday_run = datetime.now(tg.TZ).date()
+
+    user = FIRST_CHAT_ID + 1
+    banned = FIRST_CHAT_ID + 100
+    admin = tg.ADMIN_ID
+    today = datetime.now(tg.TZ).date()
+    next_month = (today.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+    noop = tg.check_access(lambda message: None)
+    user_message = fake_message(user, "📋 Список напоминаний")
+
+    middle = tg.get_db_connection().execute(
+        "SELECT registered_date, chat_id FROM users ORDER BY registered_date DESC, chat_id DESC LIMIT 1 OFFSET ?",
+        (rows // 2,)
+    ).fetchone()
+    middle_log = tg.get_db_connection().execute(
+        "SELECT timestamp, id FROM admin_logs ORDER BY timestamp DESC, id DESC LIMIT 1 OFFSET ?",
+        (rows // 2,)
+    ).fetchone()
+
+    def build_day_keyboard():
+        tg.build_day_keyboard(today.year, today.month, today).to_json()
+
+    def build_month_keyboard():
+        tg.build_month_keyboard(today.year).to_json()
+
+    results = {
+        "check_access_noop": bench(lambda: noop(user_message), repeat),
+        "is_banned": bench(lambda: tg.is_banned(banned), repeat),
+        "is_accepted": bench(lambda: tg.is_accepted(user), repeat),
+        "day_keyboard_cached": bench(lambda: tg.day_keyboard(next_month.year, next_month.month), repeat),
+        "day_keyboard_build": bench(build_day_keyboard, repeat),
+        "month_keyboard_cached": bench(lambda: tg.month_keyboard(today.year), repeat),
+        "month_keyboard_build": bench(build_month_keyboard, repeat),
+        "days_to_birthday": bench(lambda: tg.days_to_birthday(fake_message(user)), repeat),
+        "checker_sweep": bench(lambda: tg.run_checker_sweep(datetime.now(tg.TZ)),
+                               max(1, repeat // 20), setup=lambda: make_reminders_due(tg)),
+        "list_users": bench(lambda: tg.list_users(fake_message(admin)), repeat),
+        "list_users_middle_page": bench(lambda: tg.process_page(
+            fake_call(admin, f"page_u_n_2_{middle[0]}_{middle[1]}")), repeat),
+        "show_logs": bench(lambda: tg.show_logs(fake_message(admin)), repeat),
+        "show_logs_middle_page": bench(lambda: tg.process_page(
+            fake_call(admin, f"page_l_n_2_{middle_log[0]}_{middle_log[1]}")), repeat),
+    }
+
+    # Даем очереди отправки доставить хвост, чтобы посчитать вызовы
+    deadline = time.time() + 10
+    while tg.outbox_depth() and time.time() < deadline:
+        time.sleep(0.05)
+
+    return {
+        "rows": rows,
+        "seed_seconds": round(seed_seconds, 2),
+        "benchmarks": results,
+        "fake_bot_calls": dict(fake.calls),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(BOT_FILE), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарки горячих функций бота")
+    parser.add_argument("--sizes", default="1000,100000,1000000", help="размеры данных через запятую")
+    parser.add_argument("--repeat", type=int, default=200, help="повторов каждого замера")
+    parser.add_argument("--no-metrics", action="store_true", help="выключить METRICS_ENABLED")
+    parser.add_argument("--output", help="записать JSON в файл")
+    args = parser.parse_args()
+
+    report = {
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "metrics_enabled": not args.no_metrics,
+        "sizes": [run_size(int(size), args.repeat, not args.no_metrics) for size in args.sizes.split(",")],
+    }
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Общее для стендов и бенчмарков: загрузка бота, подмена Telegram и перцентили.
+
+Файл бота называется «ТГ бот.py» и не импортируется обычным import, поэтому
+скрипты загружают его отсюда. База задается переменной BOT_DB, а токен, если
+его не задали, подставляется фиктивный: telebot проверяет формат токена еще
+до первого запроса. Сообщения бота при загрузке (обновление схемы базы)
+уходят в stderr, чтобы в stdout скрипта оставался только JSON-отчет.
+"""
+
+import contextlib
+import importlib.util
+import os
+import sys
+import threading
+from collections import Counter, deque
+from types import SimpleNamespace
+
+BOT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ТГ бот.py")
+DEFAULT_TOKEN = "123456:bench"
+
+
+def load_bot(db_path, token=None):
+    os.environ["BOT_DB"] = db_path
+    if token is not None:
+        os.environ["BOT_TOKEN"] = token
+    else:
+        os.environ.setdefault("BOT_TOKEN", DEFAULT_TOKEN)
+    spec = importlib.util.spec_from_file_location("tg_bot", BOT_FILE)
+    module = importlib.util.module_from_spec(spec)
+    with contextlib.redirect_stdout(sys.stderr):
+        spec.loader.exec_module(module)
+    return module
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class FakeBot:
+    # Отвечает мгновенно и запоминает вызовы вместо обращения к Telegram.
+    # Подставляется вместо tg.bot; вызывается из потоков очереди отправки
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.recent = deque(maxlen=100)
+        self.message_id = 0
+
+    def record(self, method, args, kwargs):
+        with self.lock:
+            self.calls[method] += 1
+            self.recent.append((method, args, kwargs))
+            self.message_id += 1
+            return SimpleNamespace(message_id=self.message_id)
+
+    def send_message(self, *args, **kwargs):
+        return self.record("send_message", args, kwargs)
+
+    def edit_message_text(self, *args, **kwargs):
+        return self.record("edit_message_text", args, kwargs)
+
+    def edit_message_reply_markup(self, *args, **kwargs):
+        return self.record("edit_message_reply_markup", args, kwargs)
+
+    def answer_callback_query(self, *args, **kwargs):
+        return self.record("answer_callback_query", args, kwargs)
@@ -0,0 +1,543 @@
+"""
+Сквозной нагрузочный стенд: бот против локальной подмены Telegram Bot API.
+
+Стенд поднимает HTTP-сервер, который отвечает вместо api.telegram.org
+(getUpdates, sendMessage, editMessageText, answerCallbackQuery,
+editMessageReplyMarkup, а также служебные getMe/deleteWebhook), с настраиваемой
+задержкой и долей ответов 429. Бот загружается в этот же процесс с временной
+базой, запускается как обычно (start_services + polling) и ходит в подмену.
+
+Синтетический сценарий: каждый пользователь проходит
+/start -> «Принимаю» -> календарь (год, месяц, день) -> текст напоминания -> таймер,
+отвечая на каждое сообщение бота через --think секунд, деленные на --speed.
+Записанный поток (--updates, одно JSON-обновление на строку) проигрывается
+с исходными интервалами между обновлениями, тоже ускоренными в --speed раз.
+
+В отчете (JSON):
+  - обновлений в секунду;
+  - задержка ответа (от отправки обновления до нужного ответа бота), p50/p99;
+  - время обработчиков по метрикам бота (handler.*), p50/p99;
+  - опоздание таймеров: когда пришло «Таймер закончился» относительно срока;
+  - вызовы подмены API и число отданных 429;
+  - дубли: сколько обновлений бот обработал больше одного раза и сколько
+    пользователей получили больше одного «Таймер закончился».
+
+Если бот обработал не столько обновлений, сколько стенд отправил, или есть
+дубли, отчет все равно печатается, но стенд завершается с кодом 1.
+
+Примеры:
+    python replay_harness.py --users 1000 --speed 10
+    python replay_harness.py --users 10000 --speed 50 --outbox-rate 1000 --latency-ms 30 --rate-limit 0.01
+    python replay_harness.py --updates updates.jsonl --speed 5
+"""
+
+import argparse
+import heapq
+import itertools
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+from bot_loader import load_bot, percentile
+
+FAKE_TOKEN = "123456:replay-harness"
+FIRST_CHAT_ID = 5_000_000
+
+
+def summary_ms(values):
+    return {
+        "count": len(values),
+        "p50": round(percentile(values, 50) * 1000, 2),
+        "p99": round(percentile(values, 99) * 1000, 2),
+        "max": round(max(values, default=0) * 1000, 2),
+    }
+
+
+# ============================================================
+# ПОДМЕНА TELEGRAM BOT API
+# ============================================================
+
+class FakeTelegram:
+    def __init__(self, latency, jitter, rate_limit, retry_after):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+
+        self.cond = threading.Condition()
+        self.updates = []
+        self.first_update_id = 1
+        self.message_ids = Counter()
+        self.calls = Counter()
+        self.limited = 0
+        # Вызывается для каждого исходящего сообщения бота: (chat_id, text, message_id, at)
+        self.on_outgoing = None
+
+    def push_update(self, update):
+        with self.cond:
+            update["update_id"] = self.first_update_id + len(self.updates)
+            self.updates.append(update)
+            self.cond.notify_all()
+            return update["update_id"]
+
+    def get_updates(self, params):
+        offset = int(params.get("offset", 0) or 0)
+        limit = int(params.get("limit", 100) or 100)
+        timeout = min(float(params.get("timeout", 0) or 0), 30)
+        deadline = time.time() + timeout
+
+        with self.cond:
+            while True:
+                start = max(0, offset - self.first_update_id)
+                batch = self.updates[start:start + limit]
+                remaining = deadline - time.time()
+                if batch or remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+
+            # Подтвержденные ботом обновления больше не нужны
+            confirmed = max(0, offset - self.first_update_id)
+            if confirmed:
+                del self.updates[:confirmed]
+                self.first_update_id += confirmed
+        return batch
+
+    def message(self, chat_id, message_id, text):
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"},
+            "text": text,
+        }
+
+    def handle(self, method, params):
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": self.get_updates(params)}
+
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.random() * self.jitter)
+
+        if method != "getMe" and random.random() < self.rate_limit:
+            with self.cond:
+                self.limited += 1
+            return 429, {
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }
+
+        if method == "getMe":
+            return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}}
+
+        if method == "sendMessage":
+            chat_id = int(params["chat_id"])
+            with self.cond:
+                self.message_ids[chat_id] += 1
+                message_id = self.message_ids[chat_id]
+            self.notify(chat_id, params.get("text", ""), message_id)
+            return 200, {"ok": True, "result": self.message(chat_id, message_id, params.get("text", ""))}
+
+        if method in ("editMessageText", "editMessageReplyMarkup"):
+            chat_id = int(params["chat_id"])
+            message_id = int(params["message_id"])
+            text = params.get("text", "")
+            if method == "editMessageText":
+                self.notify(chat_id, text, message_id)
+            return 200, {"ok": True, "result": self.message(chat_id, message_id, text)}
+
+        # answerCallbackQuery, deleteWebhook и прочее
+        return 200, {"ok": True, "result": True}
+
+    def notify(self, chat_id, text, message_id):
+        if self.on_outgoing is not None:
+            self.on_outgoing(chat_id, text, message_id, time.time())
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    api = None
+
+    def handle_request(self):
+        url = urlparse(self.path)
+        # /bot<токен>/<метод>
+        method = url.path.rsplit("/", 1)[-1]
+        params = dict(parse_qsl(url.query))
+
+        length = int(self.headers.get("Content-Length", 0) or 0)
+        if length:
+            body = self.rfile.read(length).decode("utf-8")
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                params.update(json.loads(body))
+            else:
+                params.update(parse_qsl(body))
+
+        status, payload = self.api.handle(method, params)
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = handle_request
+    do_POST = handle_request
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeTelegramServer(ThreadingHTTPServer):
+    request_queue_size = 128
+    daemon_threads = True
+
+
+# ============================================================
+# СЦЕНАРИИ
+# ============================================================
+
+def user_json(chat_id):
+    return {"id": chat_id, "is_bot": False, "first_name": f"User{chat_id}", "username": f"user{chat_id}"}
+
+
+def message_update(chat_id, text):
+    return {
+        "message": {
+            "message_id": int(time.time() * 1000) % 1_000_000_000,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": user_json(chat_id),
+            "text": text,
+        }
+    }
+
+
+def callback_update(chat_id, message_id, data, seq):
+    return {
+        "callback_query": {
+            "id": f"cb{chat_id}-{seq}",
+            "from": user_json(chat_id),
+            "chat_instance": str(chat_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": "",
+            },
+        }
+    }
+
+
+def flow_steps(today, timer_minutes):
+    # (тип, текст или callback_data, по какому фрагменту узнать ответ бота)
+    return [
+        ("text", "/start", "Пользовательское соглашение"),
+        ("callback", "accept_agreement", "Главное меню"),
+        ("text", "➕ Добавить напоминание", "Выберите год"),
+        ("callback", f"year_{today.year}", "Выберите месяц"),
+        ("callback", f"month_{today.year}_{today.month}", "Выберите день"),
+        ("callback", f"day_{today.year}_{today.month}_{today.day}", "введите текст напоминания"),
+        ("text", "Купить хлеб", "Напоминание сохранено"),
+        ("text", f"{timer_minutes} Проверка стенда", "установлен"),
+    ]
+
+
+class SyntheticReplay:
+    # Пользователи ведут себя как люди: следующий шаг - только после
+    # ответа бота на предыдущий, через think секунд
+    def __init__(self, api, users, steps, think, ramp, timer_minutes):
+        self.api = api
+        self.steps = steps
+        self.think = think
+        self.timer_minutes = timer_minutes
+
+        self.cond = threading.Condition()
+        self.queue = []
+        self.seq = itertools.count()
+        self.state = {}
+        self.latencies = []
+        self.lateness = []
+        self.injected = 0
+        self.finished = 0
+        self.timers_pending = 0
+        self.timer_notifications = Counter()
+        self.users = users
+
+        now = time.time()
+        for i in range(users):
+            chat_id = FIRST_CHAT_ID + i
+            self.state[chat_id] = {"step": 0, "sent_at": None, "message_id": None, "timer_due": None}
+            heapq.heappush(self.queue, (now + ramp * i / max(1, users), next(self.seq), chat_id))
+
+    def inject(self, chat_id):
+        state = self.state[chat_id]
+        kind, payload, _ = self.steps[state["step"]]
+        if kind == "text":
+            update = message_update(chat_id, payload)
+        else:
+            update = callback_update(chat_id, state["message_id"], payload, state["step"])
+
+        state["sent_at"] = time.time()
+        if state["step"] == len(self.steps) - 1:
+            # Срок таймера считаем от секунды отправки: бот округляет время вниз
+            state["timer_due"] = int(state["sent_at"]) + self.timer_minutes * 60
+        self.api.push_update(update)
+        self.injected += 1
+
+    def on_outgoing(self, chat_id, text, message_id, at):
+        with self.cond:
+            state = self.state.get(chat_id)
+            if state is None:
+                return
+
+            if "Таймер закончился" in text:
+                self.timer_notifications[chat_id] += 1
+            if "Таймер закончился" in text and state["timer_due"] is not None:
+                self.lateness.append(at - state["timer_due"])
+                state["timer_due"] = None
+                self.timers_pending -= 1
+                self.cond.notify_all()
+                return
+
+            if state["sent_at"] is None or state["step"] >= len(self.steps):
+                return
+            _, _, marker = self.steps[state["step"]]
+            if marker not in text:
+                return
+
+            self.latencies.append(at - state["sent_at"])
+            state["sent_at"] = None
+            # Календарь и соглашение редактируются на месте - запоминаем сообщение
+            state["message_id"] = message_id
+            state["step"] += 1
+            if state["step"] == len(self.steps):
+                self.finished += 1
+                self.timers_pending += 1
+            else:
+                heapq.heappush(self.queue, (at + self.think, next(self.seq), chat_id))
+            self.cond.notify_all()
+
+    def run(self, timeout):
+        deadline = time.time() + timeout
+        with self.cond:
+            while self.finished < self.users and time.time() < deadline:
+                if not self.queue:
+                    self.cond.wait(min(1, deadline - time.time()))
+                    continue
+                due, _, chat_id = self.queue[0]
+                delay = due - time.time()
+                if delay > 0:
+                    self.cond.wait(min(delay, deadline - time.time()))
+                    continue
+                heapq.heappop(self.queue)
+                self.inject(chat_id)
+        return time.time()
+
+    def drain_timers(self, timeout):
+        deadline = time.time() + timeout
+        with self.cond:
+            while self.timers_pending > 0 and time.time() < deadline:
+                self.cond.wait(min(1, deadline - time.time()))
+
+
+class RecordedReplay:
+    # Открытая нагрузка: обновления идут по расписанию из записи, ответом на
+    # обновление считается первое сообщение бота в этот чат после него
+    def __init__(self, api, path, speed):
+        self.api = api
+        self.speed = speed
+        self.updates = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    self.updates.append(json.loads(line))
+
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.latencies = []
+        self.lateness = []
+        self.injected = 0
+        self.timer_notifications = Counter()
+
+    @staticmethod
+    def update_chat_and_date(update):
+        message = update.get("message") or (update.get("callback_query") or {}).get("message") or {}
+        return (message.get("chat") or {}).get("id"), message.get("date")
+
+    def on_outgoing(self, chat_id, text, message_id, at):
+        with self.lock:
+            waiting = self.pending.get(chat_id)
+            if waiting:
+                self.latencies.append(at - waiting.popleft())
+
+    def run(self, timeout):
+        started = time.time()
+        first_date = None
+        for update in self.updates:
+            chat_id, sent_date = self.update_chat_and_date(update)
+            if sent_date is not None:
+                if first_date is None:
+                    first_date = sent_date
+                delay = started + (sent_date - first_date) / self.speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            if time.time() - started > timeout:
+                break
+
+            update.pop("update_id", None)
+            with self.lock:
+                self.pending.setdefault(chat_id, deque()).append(time.time())
+            self.api.push_update(update)
+            self.injected += 1
+
+        # Ждем ответов на хвост потока
+        deadline = time.time() + 10
+        while time.time() < deadline and any(self.pending.values()):
+            time.sleep(0.05)
+        return time.time()
+
+    def drain_timers(self, timeout):
+        pass
+
+
+# ============================================================
+# ОТЧЕТ
+# ============================================================
+
+def handler_latency(tg):
+    # Сводная гистограмма всех handler.* из метрик бота
+    merged = tg.Histogram()
+    for name, (counts, total, count, errors, _, _) in tg.metrics_snapshot().items():
+        if name.startswith("handler."):
+            merged.counts = [a + b for a, b in zip(merged.counts, counts)]
+            merged.total += total
+            merged.count += count
+            merged.errors += errors
+
+    def bound_ms(seconds):
+        return None if seconds == float("inf") else seconds * 1000
+
+    return {
+        "count": merged.count,
+        "errors": merged.errors,
+        "mean": round(merged.total / merged.count * 1000, 2) if merged.count else 0,
+        "p50_at_most": bound_ms(merged.percentile(0.5)),
+        "p99_at_most": bound_ms(merged.percentile(0.99)),
+    }
+
+
+class HandledUpdates:
+    # Считает, сколько раз бот взял в обработку каждое обновление
+    def __init__(self, bot):
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.process = bot.process_updates_now
+        bot.process_updates_now = self.process_updates_now
+
+    def process_updates_now(self, updates):
+        with self.lock:
+            self.counts.update(update.update_id for update in updates)
+        self.process(updates)
+
+
+def duplicates_report(replay, handled):
+    counts = handled.counts
+    return {
+        "handled_updates": sum(counts.values()),
+        "updates_handled_twice_or_more": sum(1 for n in counts.values() if n > 1),
+        "users_with_repeated_timer": sum(1 for n in replay.timer_notifications.values() if n > 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сквозной стенд: бот против подмены Telegram Bot API")
+    parser.add_argument("--users", type=int, default=100, help="сколько синтетических пользователей")
+    parser.add_argument("--updates", help="проиграть записанные обновления (JSON на строку)")
+    parser.add_argument("--speed", type=float, default=1.0, help="ускорение: паузы делятся на это число")
+    parser.add_argument("--think", type=float, default=2.0, help="пауза пользователя перед следующим шагом, с")
+    parser.add_argument("--ramp", type=float, default=10.0, help="за сколько секунд приходят все пользователи")
+    parser.add_argument("--timer-minutes", type=int, default=1, help="длина таймера в конце сценария")
+    parser.add_argument("--latency-ms", type=float, default=0, help="задержка ответа подмены API")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="случайная добавка к задержке")
+    parser.add_argument("--rate-limit", type=float, default=0, help="доля ответов 429 (0..1)")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429")
+    parser.add_argument("--outbox-rate", type=float, help="переопределить OUTBOX_RATE бота")
+    parser.add_argument("--per-chat-interval", type=float, help="переопределить OUTBOX_PER_CHAT_INTERVAL")
+    parser.add_argument("--timeout", type=float, default=600, help="предел длительности прогона, с")
+    args = parser.parse_args()
+
+    api = FakeTelegram(args.latency_ms / 1000, args.jitter_ms / 1000, args.rate_limit, args.retry_after)
+    FakeTelegramHandler.api = api
+    server = FakeTelegramServer(("127.0.0.1", 0), FakeTelegramHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+
+    tmp_dir = tempfile.mkdtemp(prefix="replay_harness_")
+    tg = load_bot(os.path.join(tmp_dir, "bot.db"), FAKE_TOKEN)
+    tg.telebot.apihelper.API_URL = f"http://{host}:{port}/bot{{0}}/{{1}}"
+    if args.outbox_rate:
+        tg.OUTBOX_RATE = args.outbox_rate
+        tg.outbox_bucket = tg.TokenBucket(args.outbox_rate, args.outbox_rate)
+    if args.per_chat_interval is not None:
+        tg.OUTBOX_PER_CHAT_INTERVAL = args.per_chat_interval
+
+    if args.updates:
+        replay = RecordedReplay(api, args.updates, args.speed)
+    else:
+        today = datetime.now(tg.TZ).date()
+        replay = SyntheticReplay(
+            api, args.users, flow_steps(today, args.timer_minutes),
+            think=args.think / args.speed, ramp=args.ramp / args.speed,
+            timer_minutes=args.timer_minutes
+        )
+    api.on_outgoing = replay.on_outgoing
+    handled = HandledUpdates(tg.bot)
+
+    tg.start_services()
+    threading.Thread(target=tg.run_polling, daemon=True).start()
+
+    started = time.time()
+    finished = replay.run(args.timeout)
+    elapsed = finished - started
+    replay.drain_timers(args.timer_minutes * 60 + 60)
+
+    report = {
+        "mode": "recorded" if args.updates else "synthetic",
+        "users": None if args.updates else args.users,
+        "speed": args.speed,
+        "updates": replay.injected,
+        "seconds": round(elapsed, 3),
+        "updates_per_sec": round(replay.injected / elapsed, 1) if elapsed else None,
+        "response_latency_ms": summary_ms(replay.latencies),
+        "handler_latency_ms": handler_latency(tg),
+        "timer_lateness_ms": summary_ms(replay.lateness),
+        "api_calls": dict(api.calls),
+        "api_429": api.limited,
+        "outbox": dict(tg.outbox_stats),
+        "duplicates": duplicates_report(replay, handled),
+    }
+    if not args.updates:
+        report["completed_flows"] = replay.finished
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+    duplicates = report["duplicates"]
+    if (duplicates["handled_updates"] != replay.injected
+            or duplicates["updates_handled_twice_or_more"]
+            or duplicates["users_with_repeated_timer"]):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Прокрутка расписания бота на симулированных часах.
+
+Бот загружается с временной базой и SimulatedClock вместо настоящего
+времени. В базу кладутся таймеры и напоминания, равномерно разбросанные
+по --days суткам, затем запускаются обычные службы (start_services:
+планировщик, checker, очередь отправки) и время прокручивается от одного
+ближайшего срока к следующему, шагами не больше --step секунд. Сроки не
+перескакиваются, поэтому опоздание в отчете - это опоздание бота, а не шага.
+Перед каждым шагом стенд ждет, пока планировщик и checker обработают
+наступившие сроки, а очередь отправки опустеет.
+
+Telegram не вызывается: bot подменяется FakeBot, который запоминает
+симулированное время каждой отправки. В отчете (JSON):
+  - сколько таймеров и напоминаний доставлено, потеряно и продублировано;
+  - опоздание относительно срока в симулированных секундах, p50/p99/max;
+  - сколько реальных секунд заняла прокрутка и время загрузки таймеров.
+
+Примеры:
+    python schedule_benchmark.py
+    python schedule_benchmark.py --timers 1000000 --days 30 --step 60
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import tempfile
+import time
+
+from bot_loader import FakeBot, load_bot, percentile
+
+FIRST_CHAT_ID = 2_000_000
+ITEM_RE = re.compile(r"#([tr])(\d+)$")
+# Потоки, которые ждут по часам: планировщик отложенных задач и checker
+CLOCK_THREADS = 2
+
+
+class DeliveryBot(FakeBot):
+    # Запоминает, в какой момент симулированного времени ушел каждый таймер
+    # и каждое напоминание (их текст оканчивается на #t<номер> / #r<номер>)
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+        self.delivered = {}
+        self.duplicates = 0
+
+    def send_message(self, chat_id, text, **kwargs):
+        result = super().send_message(chat_id, text, **kwargs)
+        match = ITEM_RE.search(text)
+        if match:
+            key = (match.group(1), int(match.group(2)))
+            with self.lock:
+                if key in self.delivered:
+                    self.duplicates += 1
+                else:
+                    self.delivered[key] = self.clock.time()
+        return result
+
+
+def seed(tg, start, timers, reminders, days, users, rng):
+    span = int(days * 86400)
+    timer_due = [start + rng.randrange(1, span) for _ in range(timers)]
+    reminder_due = [start + rng.randrange(1, span) for _ in range(reminders)]
+
+    conn = tg.get_db_connection()
+    conn.executemany(
+        "INSERT INTO users (chat_id, first_name, accepted, registered_date) VALUES (?, ?, 1, ?)",
+        ((FIRST_CHAT_ID + i, f"User{i}", start) for i in range(users))
+    )
+    conn.executemany(
+        "INSERT INTO timers (chat_id, end_time, text) VALUES (?, ?, ?)",
+        ((FIRST_CHAT_ID + i % users, due, f"#t{i}") for i, due in enumerate(timer_due))
+    )
+    conn.executemany(
+        "INSERT INTO reminders (chat_id, text, remind_time, repeat_type, notify_before, done, notify_at) "
+        "VALUES (?, ?, ?, 'none', 0, 0, ?)",
+        ((FIRST_CHAT_ID + i % users, f"#r{i}", due, due) for i, due in enumerate(reminder_due))
+    )
+    conn.commit()
+    conn.close()
+    return timer_due, reminder_due
+
+
+def outbox_idle(tg):
+    # Чат выходит из outbox_busy уже после колбэков отправки (подтверждений)
+    with tg.outbox_cond:
+        return not tg.outbox_queues and not tg.outbox_busy
+
+
+def settle(tg, clock, timeout=60):
+    # Планировщик и checker снова спят, все отправки дошли до FakeBot, а
+    # подтверждения доставки записаны в базу. Очередь отправки и групповая
+    # запись работают в реальном времени, поэтому их ждем явно.
+    deadline = time.monotonic() + timeout
+    while True:
+        clock.wait_idle(timeout, CLOCK_THREADS)
+        if outbox_idle(tg) and not tg.write_pending and clock.idle(CLOCK_THREADS):
+            return
+        if time.monotonic() >= deadline:
+            raise TimeoutError("outbox or writer did not drain")
+        time.sleep(0.001)
+
+
+def lateness_report(expected, delivered, kind):
+    lateness = [delivered[(kind, i)] - due for i, due in enumerate(expected) if (kind, i) in delivered]
+    return {
+        "scheduled": len(expected),
+        "delivered": len(lateness),
+        "missing": len(expected) - len(lateness),
+        "lateness_s": {
+            "p50": round(percentile(lateness, 50), 3),
+            "p99": round(percentile(lateness, 99), 3),
+            "max": round(max(lateness, default=0), 3),
+            "min": round(min(lateness, default=0), 3),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Прокрутка расписания бота на симулированных часах")
+    parser.add_argument("--timers", type=int, default=100000, help="сколько таймеров")
+    parser.add_argument("--reminders", type=int, default=10000, help="сколько разовых напоминаний")
+    parser.add_argument("--days", type=float, default=30, help="на сколько суток разбросать сроки")
+    parser.add_argument("--users", type=int, default=1000, help="между сколькими чатами")
+    parser.add_argument("--step", type=float, default=30, help="наибольший шаг симулированного времени, с")
+    parser.add_argument("--seed", type=int, default=1, help="зерно генератора сроков")
+    parser.add_argument("--output", help="записать JSON в файл")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix="schedule_benchmark_")
+    tg = load_bot(os.path.join(tmp_dir, "bot.db"))
+
+    # Старт с начала минуты, чтобы шаги checker шли по ровным отметкам
+    start = int(time.time()) // 60 * 60
+    clock = tg.SimulatedClock(start)
+    tg.set_clock(clock)
+
+    fake = DeliveryBot(clock)
+    tg.bot = fake
+    tg.OUTBOX_PER_CHAT_INTERVAL = 0
+    tg.outbox_bucket = tg.TokenBucket(10 ** 9, 10 ** 9)
+    # Подтверждения доставки пишутся сразу, без ожидания пачки: стенд ждет
+    # записи на каждом шаге, а пауза пачки идет в реальном времени
+    tg.WRITE_BATCH_INTERVAL = 0
+
+    timer_due, reminder_due = seed(tg, start, args.timers, args.reminders, args.days, args.users,
+                                   random.Random(args.seed))
+
+    started = time.perf_counter()
+    tg.start_services()
+    settle(tg, clock)
+    startup_seconds = time.perf_counter() - started
+
+    end = start + args.days * 86400
+    steps = 0
+    started = time.perf_counter()
+    while clock.time() < end or tg.pending_tasks():
+        wakeup = clock.next_wakeup()
+        target = clock.time() + args.step
+        if wakeup is not None and wakeup < target:
+            target = wakeup
+        clock.advance_to(target)
+        settle(tg, clock)
+        steps += 1
+    elapsed = time.perf_counter() - started
+
+    report = {
+        "timers": lateness_report(timer_due, fake.delivered, "t"),
+        "reminders": lateness_report(reminder_due, fake.delivered, "r"),
+        "duplicates": fake.duplicates,
+        "simulated_days": round((clock.time() - start) / 86400, 3),
+        "steps": steps,
+        "startup_seconds": round(startup_seconds, 3),
+        "real_seconds": round(elapsed, 3),
+        "simulated_days_per_real_second": round((clock.time() - start) / 86400 / elapsed, 3) if elapsed else None,
+        "fake_bot_calls": dict(fake.calls),
+    }
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Проверка polling: каждое полученное обновление попадает в обработку один раз.
+
+Запуск:
+    python -m pytest -q test_polling.py
+"""
+
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from bot_loader import load_bot
+
+
+def message_update(update_id, chat_id):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"User{chat_id}"},
+            "text": "/start",
+        },
+    }
+
+
+def test_polled_updates_are_dispatched_once():
+    tg = load_bot(os.path.join(tempfile.mkdtemp(prefix="test_polling_"), "bot.db"))
+    updates = [tg.telebot.types.Update.de_json(message_update(n, 100 + n % 3)) for n in range(1, 11)]
+
+    # Подмена getUpdates: отдает все обновления начиная с offset, как Telegram
+    requested = []
+
+    def get_updates(offset=None, **kwargs):
+        requested.append(offset)
+        return [u for u in updates if u.update_id >= offset]
+
+    handled = Counter()
+    lock = threading.Lock()
+
+    def process_updates_now(batch):
+        # Обработчик медленнее polling - ровно тот случай, когда смещение отставало
+        time.sleep(0.01)
+        with lock:
+            handled.update(u.update_id for u in batch)
+
+    tg.bot.get_updates = get_updates
+    tg.bot.process_updates_now = process_updates_now
+    tg.start_update_workers()
+
+    for _ in range(3):
+        tg.bot._TeleBot__retrieve_updates(timeout=0, long_polling_timeout=0)
+
+    deadline = time.time() + 5
+    while sum(handled.values()) < len(updates) and time.time() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.1)
+
+    assert requested == [1, 11, 11]
+    assert tg.bot.last_update_id == 10
+    assert handled == Counter(range(1, 11))
@@ -0,0 +1,69 @@
+"""
+Проверка статистики: сообщение с частыми маршрутами - корректный Markdown.
+
+Запуск:
+    python -m pytest -q test_statistics.py
+"""
+
+import os
+import tempfile
+from datetime import datetime
+from types import SimpleNamespace
+
+from bot_loader import load_bot
+
+MARKDOWN_ENTITIES = {"*": "*", "_": "_", "`": "`", "[": "]"}
+
+
+def legacy_markdown_ok(text):
+    # Разметка Telegram parse_mode="Markdown": каждая открытая сущность
+    # закрывается, вне сущностей спецсимвол экранируется обратной косой
+    closing = None
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if closing is None:
+            if char == "\\" and text[i + 1:i + 2] in MARKDOWN_ENTITIES:
+                i += 2
+                continue
+            closing = MARKDOWN_ENTITIES.get(char)
+        elif char == closing:
+            closing = None
+        i += 1
+    return closing is None
+
+
+def test_statistics_with_handler_names_is_valid_markdown():
+    tg = load_bot(os.path.join(tempfile.mkdtemp(prefix="test_statistics_"), "bot.db"))
+    sent = []
+    tg.send_message = lambda chat_id, text, **kwargs: sent.append((text, kwargs))
+
+    # route_message считает вызов до обработчика, поэтому первый же
+    # показ статистики содержит show_statistics
+    tg.route_hits.update({"show_statistics": 1, "list_users": 2, "back_to_menu": 3})
+    message = SimpleNamespace(chat=SimpleNamespace(id=tg.ADMIN_ID), text="📊 Статистика")
+    # Без check_access: соглашение и блокировки здесь не проверяем
+    tg.show_statistics.__wrapped__(message)
+
+    text, kwargs = sent[-1]
+    assert kwargs.get("parse_mode") == "Markdown"
+    assert "show\\_statistics (1)" in text
+    assert legacy_markdown_ok(text)
+
+
+def test_daily_counters_follow_injected_clock():
+    tg = load_bot(os.path.join(tempfile.mkdtemp(prefix="test_statistics_"), "bot.db"))
+    # 23:30 и 00:30 по Москве - разные дни, хотя по UTC (20:30 и 21:30) один
+    start = tg.to_epoch(datetime(2026, 3, 10, 23, 30))
+    clock = tg.SimulatedClock(start)
+    tg.set_clock(clock)
+
+    tg.set_accepted(1)
+    clock.advance_to(start + 3600)
+    tg.set_accepted(2)
+
+    _, days = tg.read_counters()
+    conn = tg.get_db_connection()
+    rows = conn.execute("SELECT day, value FROM counter_days WHERE name = 'users' ORDER BY day").fetchall()
+    assert [tuple(row) for row in rows] == [("2026-03-10", 1), ("2026-03-11", 1)]
+    assert days["users"] == (1, 2)
@@ -0,0 +1,153 @@
+"""
+Нагрузочный стенд для webhook-режима бота.
+
+Отправляет POST-запросы с обновлениями Telegram на локальный webhook-сервер
+и печатает, сколько обновлений принято, отклонено и с какой задержкой.
+
+Обновления берутся из файла (одно JSON-обновление на строку, например
+записанное из реального трафика) или генерируются (--synthetic N).
+
+Примеры:
+    python webhook_harness.py --serve --synthetic 20000 --concurrency 32
+    python webhook_harness.py --url http://127.0.0.1:8443/webhook --updates updates.jsonl
+
+С флагом --serve стенд сам поднимает webhook-сервер бота в этом процессе
+с временной базой, а вместо обработчиков считает полученные обновления.
+Так можно измерить пропускную способность приема без сети и без Telegram.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from bot_loader import load_bot, percentile
+
+
+def synthetic_updates(count, users):
+    texts = ["/start", "📋 Список напоминаний", "🎉 Сколько дней до ДР", "10 Сделать чай"]
+    now = int(time.time())
+    for i in range(count):
+        chat_id = 100000 + i % users
+        yield {
+            "update_id": i + 1,
+            "message": {
+                "message_id": i + 1,
+                "date": now,
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": f"User{chat_id}"},
+                "text": texts[i % len(texts)],
+            },
+        }
+
+
+def recorded_updates(path):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def post_update(url, secret, body):
+    request = urllib.request.Request(
+        url,
+        data=body,
+        method="POST",
+        headers={
+            "Content-Type": "application/json",
+            "X-Telegram-Bot-Api-Secret-Token": secret,
+        },
+    )
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except Exception:
+        status = None
+    return status, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд webhook-режима")
+    parser.add_argument("--url", default=None,
+                        help="адрес webhook; обязателен без --serve, с --serve - адрес поднятого сервера")
+    parser.add_argument("--secret", default=None,
+                        help="секрет; обязателен без --serve, с --serve - WEBHOOK_SECRET бота")
+    parser.add_argument("--updates", help="файл с обновлениями, по одному JSON на строку")
+    parser.add_argument("--synthetic", type=int, default=1000, help="сколько обновлений сгенерировать")
+    parser.add_argument("--users", type=int, default=1000, help="сколько разных чатов в синтетике")
+    parser.add_argument("--concurrency", type=int, default=16, help="параллельных соединений")
+    parser.add_argument("--serve", action="store_true", help="поднять webhook-сервер бота в этом процессе")
+    args = parser.parse_args()
+
+    url, secret = args.url, args.secret
+    processed = {"count": 0}
+
+    if args.serve:
+        tmp_dir = tempfile.mkdtemp(prefix="webhook_harness_")
+        tg = load_bot(os.path.join(tmp_dir, "bot.db"))
+        lock = threading.Lock()
+
+        def count_updates(updates):
+            with lock:
+                processed["count"] += len(updates)
+
+        # Обработчики не вызываются: измеряем только прием обновлений
+        tg.bot.process_new_updates = count_updates
+        tg.WEBHOOK_PORT = 0
+        server = tg.start_webhook_server()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        host, port = server.server_address
+        url = url or f"http://{host}:{port}{tg.WEBHOOK_PATH}"
+        secret = secret or tg.WEBHOOK_SECRET
+
+    if not url or secret is None:
+        parser.error("--url и --secret обязательны, если не указан --serve")
+
+    if args.updates:
+        updates = recorded_updates(args.updates)
+    else:
+        updates = synthetic_updates(args.synthetic, args.users)
+    bodies = [json.dumps(update, ensure_ascii=False).encode("utf-8") for update in updates]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(lambda body: post_update(url, secret, body), bodies))
+    elapsed = time.perf_counter() - started
+
+    statuses = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    latencies = [latency for status, latency in results if status == 200]
+
+    report = {
+        "updates": len(bodies),
+        "seconds": round(elapsed, 3),
+        "requests_per_sec": round(len(bodies) / elapsed, 1) if elapsed else None,
+        "statuses": {str(k): v for k, v in statuses.items()},
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+            "max": round(max(latencies, default=0) * 1000, 2),
+        },
+    }
+    if args.serve:
+        # Даем воркерам разобрать хвост очереди
+        deadline = time.time() + 10
+        while processed["count"] < report["statuses"].get("200", 0) and time.time() < deadline:
+            time.sleep(0.05)
+        report["processed"] = processed["count"]
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Сравнение записи в базу: коммит на каждую строку против групповой записи.
+
+Несколько потоков (как воркеры обработки обновлений) вставляют строки
+в admin_logs временной базы бота:
+  - per_row: каждая вставка в своей транзакции, как раньше делали обработчики;
+  - group:   вставки идут через submit_write() и коммитятся пачками.
+
+Пример:
+    python write_benchmark.py --rows 20000 --threads 8
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+from bot_loader import load_bot
+
+
+INSERT = """
+    INSERT INTO admin_logs (admin_id, action, target_id, details, timestamp)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+
+def run_threads(threads, rows, write_row):
+    per_thread = rows // threads
+
+    def worker(index):
+        for i in range(per_thread):
+            write_row(index, i)
+
+    started = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return per_thread * threads, time.perf_counter() - started
+
+
+def bench_per_row(tg, threads, rows):
+    def write_row(index, i):
+        conn = tg.get_db_connection()
+        conn.execute(INSERT, (index, "bench", i, "per_row", tg.now_epoch()))
+        conn.commit()
+        conn.close()
+
+    return run_threads(threads, rows, write_row)
+
+
+def bench_group(tg, threads, rows):
+    futures = []
+    lock = threading.Lock()
+
+    def write_row(index, i):
+        future = tg.submit_write(INSERT, (index, "bench", i, "group", tg.now_epoch()))
+        with lock:
+            futures.append(future)
+
+    tg.start_writer()
+    started = time.perf_counter()
+    count, _ = run_threads(threads, rows, write_row)
+    # Считаем время до коммита последней строки, а не до постановки в очередь
+    for future in futures:
+        future.result()
+    return count, time.perf_counter() - started
+
+
+def report(count, elapsed):
+    return {
+        "rows": count,
+        "seconds": round(elapsed, 3),
+        "rows_per_sec": round(count / elapsed, 1) if elapsed else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Коммит на строку против групповой записи")
+    parser.add_argument("--rows", type=int, default=10000, help="сколько строк вставить в каждом режиме")
+    parser.add_argument("--threads", type=int, default=8, help="сколько потоков пишут одновременно")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix="write_benchmark_")
+    tg = load_bot(os.path.join(tmp_dir, "bot.db"))
+
+    per_row = report(*bench_per_row(tg, args.threads, args.rows))
+    group = report(*bench_group(tg, args.threads, args.rows))
+    group["batches"] = tg.write_stats["batches"]
+
+    result = {
+        "threads": args.threads,
+        "batch_rows": tg.WRITE_BATCH_ROWS,
+        "batch_interval_ms": tg.WRITE_BATCH_INTERVAL * 1000,
+        "per_row": per_row,
+        "group": group,
+        "speedup": round(per_row["seconds"] / group["seconds"], 1) if group["seconds"] else None,
+    }
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
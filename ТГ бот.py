@@ -2,8 +2,25 @@ import telebot
 import sqlite3
 import threading
 import time
+import heapq
+import bisect
+import calendar
+import atexit
+import weakref
+import os
+import hmac
+import re
+import functools
+import itertools
+import json
+import queue
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import deque, OrderedDict
+from concurrent.futures import Future
 from datetime import datetime, date, timedelta
 import pytz
+import requests
+from telebot.apihelper import ApiTelegramException
 from telebot.types import (
     ReplyKeyboardMarkup,
     InlineKeyboardMarkup,
@@ -15,29 +32,600 @@ from telebot.types import (
 # НАСТРОЙКИ
 # ============================================================
 
-TOKEN = "токен"
+# Токен можно задать переменной окружения BOT_TOKEN (нужно стендам нагрузки)
+TOKEN = os.environ.get("BOT_TOKEN", "токен")
 ADMIN_ID = 152343  # <<< ВСТАВЬ СВОЙ TELEGRAM ID
 
-bot = telebot.TeleBot(TOKEN)
+class ShardedTeleBot(telebot.TeleBot):
+    # Обновления из polling и webhook не обрабатываются на месте, а
+    # раскладываются по очередям воркеров по chat_id (см. "ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА")
+    def process_new_updates(self, updates):
+        # Смещение polling двигаем сразу: обработка идет позже в воркерах, и без
+        # этого следующий getUpdates вернул бы те же обновления повторно
+        if updates:
+            self.last_update_id = max(self.last_update_id, max(u.update_id for u in updates))
+        dispatch_updates(updates)
+
+    def process_updates_now(self, updates):
+        super().process_new_updates(updates)
+
+# threaded=False: параллельностью управляет наш диспетчер, а не пул telebot
+bot = ShardedTeleBot(TOKEN, threaded=False)
 
 TZ = pytz.timezone("Europe/Moscow")
-DB_NAME = "bot.db"
+# Путь к базе можно переопределить переменной окружения (нужно скриптам нагрузки)
+DB_NAME = os.environ.get("BOT_DB", "bot.db")
+
+# Способ получения обновлений: "polling" или "webhook".
+# В режиме webhook бот поднимает локальный HTTP-сервер; HTTPS снаружи
+# обеспечивает обратный прокси (nginx и т.п.), который проксирует запросы
+# с WEBHOOK_URL на WEBHOOK_HOST:WEBHOOK_PORT.
+RUN_MODE = "polling"
+WEBHOOK_URL = "https://example.com"  # <<< ВСТАВЬ ПУБЛИЧНЫЙ АДРЕС
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_HOST = "127.0.0.1"
+WEBHOOK_PORT = 8443
+WEBHOOK_SECRET = "change-me"  # <<< ВСТАВЬ СЛУЧАЙНУЮ СТРОКУ (A-Z, a-z, 0-9, _ и -)
+WEBHOOK_QUEUE_SIZE = 1000
+WEBHOOK_WORKERS = 4
+
+# Замеры времени обработчиков, запросов к базе и вызовов Telegram.
+# Страница /metrics слушает только локальный адрес; METRICS_PORT = None - без нее.
+METRICS_ENABLED = True
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9100
+
+# ============================================================
+# ВРЕМЯ
+# ============================================================
+
+# Все моменты времени хранятся в базе как целые секунды UTC (unix epoch).
+# В московское время они переводятся только для показа пользователю.
+
+# Текущее время и ожидание до срока берутся только через clock. В обычной
+# работе это SystemClock; стенды подменяют его на SimulatedClock через
+# set_clock() и прокручивают дни и месяцы расписания за секунды.
+# Ограничение скорости отправки, пакетная запись и метрики меряют реальные
+# интервалы (time.monotonic/perf_counter) и от clock не зависят.
+
+class SystemClock:
+    def time(self):
+        return time.time()
+
+    def now(self):
+        return datetime.now(TZ)
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def wait(self, cond, timeout=None):
+        # Вызывается под блокировкой cond, как cond.wait()
+        return cond.wait(timeout)
+
+# Условия, на которых ждут через clock.wait(); SimulatedClock будит их
+# при каждом сдвиге времени
+clock_conditions = weakref.WeakSet()
+
+def clock_condition():
+    cond = threading.Condition()
+    clock_conditions.add(cond)
+    return cond
+
+class SimulatedClock:
+    # Время стоит на месте, пока его не сдвинут advance()/run_until().
+    # Потоки, уснувшие через sleep()/wait(), просыпаются при сдвиге;
+    # run_until() переходит от одного ближайшего срока к следующему и перед
+    # каждым шагом ждет, пока все такие потоки снова уснут.
+
+    def __init__(self, start=None):
+        self.current = time.time() if start is None else float(start)
+        self.cond = threading.Condition()
+        # поток -> момент, до которого он спит (None - до notify)
+        self.blocked = {}
+        self.threads = weakref.WeakSet()
+
+    def time(self):
+        return self.current
+
+    def now(self):
+        return datetime.fromtimestamp(self.current, TZ)
+
+    def block(self, until):
+        thread = threading.current_thread()
+        with self.cond:
+            self.threads.add(thread)
+            self.blocked[thread] = until
+        return thread
+
+    def unblock(self, thread):
+        with self.cond:
+            self.blocked.pop(thread, None)
+
+    def sleep(self, seconds):
+        thread = self.block(self.current + seconds)
+        try:
+            with self.cond:
+                while self.current < self.blocked[thread]:
+                    self.cond.wait()
+        finally:
+            self.unblock(thread)
+
+    def wait(self, cond, timeout=None):
+        # Реального тайм-аута нет: cond будит либо notify, либо advance().
+        # Вызывающий код все равно перепроверяет свое условие в цикле.
+        if timeout is not None and timeout <= 0:
+            return False
+        thread = self.block(None if timeout is None else self.current + timeout)
+        try:
+            return cond.wait()
+        finally:
+            self.unblock(thread)
+
+    def advance(self, seconds):
+        self.advance_to(self.current + seconds)
+
+    def advance_to(self, moment):
+        with self.cond:
+            self.current = max(self.current, float(moment))
+            self.cond.notify_all()
+        # Поток, прочитавший старое время под cond, держит блокировку до
+        # своего wait(), поэтому notify до него дойдет
+        for cond in list(clock_conditions):
+            with cond:
+                cond.notify_all()
+
+    def idle(self, threads=0):
+        # Все потоки, ждущие через clock, снова ждут, и никому не пора просыпаться.
+        # threads - сколько потоков должно уже ждать: только что запущенный
+        # поток часам еще не известен, и без этого время ушло бы вперед без него
+        with self.cond:
+            alive = [thread for thread in self.threads if thread.is_alive()]
+            if len(alive) < threads:
+                return False
+            for thread in alive:
+                if thread not in self.blocked:
+                    return False
+                until = self.blocked[thread]
+                if until is not None and until <= self.current:
+                    return False
+            return True
+
+    def next_wakeup(self):
+        with self.cond:
+            moments = [until for until in self.blocked.values() if until is not None]
+        return min(moments, default=None)
+
+    def wait_idle(self, timeout=60, threads=0):
+        deadline = time.monotonic() + timeout
+        while not self.idle(threads):
+            if time.monotonic() >= deadline:
+                raise TimeoutError("simulated clock: threads did not settle")
+            time.sleep(0.001)
+
+    def run_until(self, moment, timeout=60, threads=0):
+        # Прокрутка времени до moment с остановкой на каждом сроке
+        moment = float(moment)
+        while True:
+            self.wait_idle(timeout, threads)
+            if self.current >= moment:
+                return
+            wakeup = self.next_wakeup()
+            if wakeup is None or wakeup > moment:
+                wakeup = moment
+            self.advance_to(wakeup)
+
+clock = SystemClock()
+
+def set_clock(new_clock):
+    global clock
+    clock = new_clock
+    # Будим всех, кто ждет по старым часам
+    for cond in list(clock_conditions):
+        with cond:
+            cond.notify_all()
+
+def now_epoch():
+    return int(clock.time())
+
+def to_epoch(dt):
+    # Время без часового пояса считаем московским
+    if dt.tzinfo is None:
+        dt = TZ.localize(dt)
+    return int(dt.timestamp())
+
+def from_epoch(ts):
+    return datetime.fromtimestamp(ts, TZ)
+
+def iso_to_epoch(value):
+    # Перевод старых ISO-строк в epoch; "permanent" и мусор превращаются в NULL
+    if value is None or isinstance(value, int):
+        return value
+    try:
+        return to_epoch(datetime.fromisoformat(value))
+    except (TypeError, ValueError):
+        return None
+
+# ============================================================
+# МЕТРИКИ
+# ============================================================
+
+# Для каждого имени (handler.*, db.*, telegram.*, checker.*) хранится
+# гистограмма длительностей и число ошибок. Когда METRICS_ENABLED = False,
+# замер сводится к одной проверке флага.
+
+# Верхние границы корзин, в секундах
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "total", "count", "errors")
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        # Последняя корзина - все, что дольше самой большой границы
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.errors = 0
+
+    def observe(self, seconds, failed=False):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+        if failed:
+            self.errors += 1
+
+    def percentile(self, q):
+        # Оценка сверху: граница корзины, в которую попал q-й перцентиль
+        target = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return float("inf")
+
+metrics = {}
+metrics_lock = threading.Lock()
+
+def observe(name, seconds, failed=False):
+    with metrics_lock:
+        histogram = metrics.get(name)
+        if histogram is None:
+            histogram = metrics[name] = Histogram()
+        histogram.observe(seconds, failed)
+
+class MetricTimer:
+    # with MetricTimer("checker.reminders"): ...
+    __slots__ = ("name", "started")
+
+    def __init__(self, name):
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        if METRICS_ENABLED:
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.started is not None:
+            observe(self.name, time.perf_counter() - self.started, exc_type is not None)
+        return False
+
+def timed(func):
+    # Замер обработчика целиком; имя метрики - handler.<имя функции>
+    name = f"handler.{func.__name__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not METRICS_ENABLED:
+            return func(*args, **kwargs)
+        started = time.perf_counter()
+        failed = False
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            observe(name, time.perf_counter() - started, failed)
+    return wrapper
+
+def metrics_snapshot():
+    with metrics_lock:
+        return {
+            name: (list(h.counts), h.total, h.count, h.errors, h.percentile(0.5), h.percentile(0.99))
+            for name, h in metrics.items()
+        }
+
+def metrics_gauges():
+    return {
+        "outbox_depth": outbox_depth(),
+        "outbox_sent_total": outbox_stats["sent"],
+        "outbox_failed_total": outbox_stats["failed"],
+        "outbox_retried_total": outbox_stats["retried"],
+        "update_queue_depth": sum(update_queue_depths()),
+        "delayed_tasks": pending_tasks(),
+        "write_pending": write_pending,
+    }
+
+def render_metrics():
+    # Текстовый формат Prometheus
+    lines = [
+        "# TYPE bot_latency_seconds histogram",
+    ]
+    errors = []
+    for name, (counts, total, count, error_count, _, _) in sorted(metrics_snapshot().items()):
+        cumulative = 0
+        for bound, bucket in zip(METRICS_BUCKETS, counts):
+            cumulative += bucket
+            lines.append(f'bot_latency_seconds_bucket{{name="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'bot_latency_seconds_bucket{{name="{name}",le="+Inf"}} {count}')
+        lines.append(f'bot_latency_seconds_sum{{name="{name}"}} {total:.6f}')
+        lines.append(f'bot_latency_seconds_count{{name="{name}"}} {count}')
+        errors.append(f'bot_errors_total{{name="{name}"}} {error_count}')
+
+    lines.append("# TYPE bot_errors_total counter")
+    lines.extend(errors)
+    for name, value in metrics_gauges().items():
+        lines.append(f"bot_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server():
+    server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
 
 # ============================================================
 # БАЗА ДАННЫХ
 # ============================================================
 
-# Используем отдельные соединения для разных потоков
-def get_db_connection():
-    conn = sqlite3.connect(DB_NAME, check_same_thread=False)
+# Размер кэша страниц SQLite на одно соединение (в КиБ)
+DB_CACHE_SIZE_KB = 16 * 1024
+# Сколько миллисекунд ждать снятия блокировки, прежде чем вернуть "database is locked"
+DB_BUSY_TIMEOUT_MS = 5000
+
+class TimedCursor(sqlite3.Cursor):
+    # Время выполнения запроса (без чтения строк) - db.select, db.insert и т.д.
+    def execute(self, sql, parameters=()):
+        if not METRICS_ENABLED:
+            return super().execute(sql, parameters)
+        started = time.perf_counter()
+        failed = False
+        try:
+            return super().execute(sql, parameters)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            verb = sql.lstrip().split(None, 1)[0].lower()
+            observe(f"db.{verb}", time.perf_counter() - started, failed)
+
+    def executemany(self, sql, seq_of_parameters):
+        with MetricTimer("db.executemany"):
+            return super().executemany(sql, seq_of_parameters)
+
+class PooledConnection(sqlite3.Connection):
+    # Соединение живет все время работы потока. close() в обработчиках
+    # только откатывает незавершенную транзакцию, как это делало настоящее
+    # закрытие, а само соединение закрывается при остановке бота.
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    # Встроенные conn.execute/executemany обходят методы курсора-наследника
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        with MetricTimer("db.commit"):
+            super().commit()
+
+    def shutdown(self):
+        super().close()
+
+db_local = threading.local()
+db_connections = weakref.WeakSet()
+db_connections_lock = threading.Lock()
+
+def open_db_connection():
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False, factory=PooledConnection)
     conn.row_factory = sqlite3.Row
+    # WAL: читатели не ждут, пока checker держит транзакцию на запись
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    # День для counter_days берется из clock, как и в read_counters
+    conn.create_function("counter_day", 0, counter_day)
     return conn
 
-# Создаем таблицы при запуске
-def init_database():
+# Одно переиспользуемое соединение на поток
+def get_db_connection():
+    conn = getattr(db_local, "conn", None)
+    if conn is None:
+        with MetricTimer("db.connect"):
+            conn = open_db_connection()
+        db_local.conn = conn
+        with db_connections_lock:
+            db_connections.add(conn)
+    return conn
+
+def close_all_connections():
+    with db_connections_lock:
+        connections = list(db_connections)
+        db_connections.clear()
+    for conn in connections:
+        try:
+            conn.close()
+            conn.shutdown()
+        except Exception as e:
+            print(f"Error in close_all_connections: {e}")
+
+atexit.register(close_all_connections)
+
+# ============================================================
+# ГРУППОВАЯ ЗАПИСЬ
+# ============================================================
+
+# Вставки из обработчиков не коммитятся по одной: отдельный поток собирает
+# их в пачку и фиксирует одной транзакцией раз в WRITE_BATCH_INTERVAL секунд
+# или по набору WRITE_BATCH_ROWS строк. Так на много действий пользователей
+# приходится одна синхронизация с диском вместо одной на каждое.
+# submit_write() возвращает Future, который получает id строки после коммита.
+
+WRITE_BATCH_ROWS = 500
+WRITE_BATCH_INTERVAL = 0.02
+WRITE_FLUSH_TIMEOUT = 10
+
+write_queue = deque()
+write_cond = threading.Condition()
+write_pending = 0
+writer_running = False
+write_stats = {"rows": 0, "batches": 0, "failed": 0}
+
+def submit_write(sql, params=()):
+    global write_pending
+    future = Future()
+    with write_cond:
+        if writer_running:
+            write_queue.append((sql, params, future))
+            write_pending += 1
+            # Будим поток на первой строке пачки и когда пачка набралась
+            if len(write_queue) == 1 or len(write_queue) >= WRITE_BATCH_ROWS:
+                write_cond.notify_all()
+            return future
+
+    # Поток записи не запущен (например, в служебных скриптах) - пишем сразу
+    commit_writes([(sql, params, future)])
+    return future
+
+def commit_writes(batch):
     conn = get_db_connection()
-    cursor = conn.cursor()
-    
+    results = []
+    try:
+        for sql, params, future in batch:
+            # Ошибка одной строки (например, нарушение ограничения)
+            # не должна отменять остальные строки пачки
+            try:
+                cursor = conn.execute(sql, params)
+                results.append((future, cursor.lastrowid, None))
+            except sqlite3.Error as e:
+                results.append((future, None, e))
+        conn.commit()
+    except Exception as e:
+        print(f"Error in commit_writes: {e}")
+        conn.close()
+        write_stats["failed"] += len(batch)
+        for _, _, future in batch:
+            future.set_exception(e)
+        return
+
+    write_stats["rows"] += len(batch)
+    write_stats["batches"] += 1
+    for future, rowid, error in results:
+        if error is None:
+            future.set_result(rowid)
+        else:
+            print(f"Error in commit_writes: {error}")
+            write_stats["failed"] += 1
+            future.set_exception(error)
+
+def take_write_batch():
+    with write_cond:
+        while not write_queue:
+            write_cond.wait()
+
+        # Ждем, пока пачка наберется или выйдет время
+        deadline = time.time() + WRITE_BATCH_INTERVAL
+        while len(write_queue) < WRITE_BATCH_ROWS:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            write_cond.wait(remaining)
+
+        count = min(len(write_queue), WRITE_BATCH_ROWS)
+        return [write_queue.popleft() for _ in range(count)]
+
+def finish_write_batch(batch):
+    global write_pending
+    with write_cond:
+        write_pending -= len(batch)
+        if write_pending == 0:
+            write_cond.notify_all()
+
+def write_worker():
+    while True:
+        batch = take_write_batch()
+        try:
+            commit_writes(batch)
+        except Exception as e:
+            print(f"Error in write_worker: {e}")
+        finally:
+            finish_write_batch(batch)
+
+def start_writer():
+    global writer_running
+    with write_cond:
+        if writer_running:
+            return
+        writer_running = True
+    threading.Thread(target=write_worker, daemon=True).start()
+
+def flush_writes(timeout=WRITE_FLUSH_TIMEOUT):
+    # Ждем, пока поток записи закоммитит все, что уже поставлено в очередь
+    deadline = time.time() + timeout
+    with write_cond:
+        while write_pending:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            write_cond.wait(remaining)
+        leftover = list(write_queue)
+        write_queue.clear()
+
+    # Поток записи не успел - дописываем остаток сами
+    if leftover:
+        commit_writes(leftover)
+        finish_write_batch(leftover)
+
+# Регистрируется после close_all_connections, поэтому при выходе
+# выполняется раньше него: сначала сбрасываем очередь, потом закрываем базу
+atexit.register(flush_writes)
+
+# ============================================================
+# МИГРАЦИИ СХЕМЫ
+# ============================================================
+
+# Версия схемы хранится в PRAGMA user_version. Каждая миграция выполняется
+# один раз, в своей транзакции, и повышает версию на единицу.
+# Новые изменения схемы добавляются в конец списка MIGRATIONS.
+
+def migration_base_schema(cursor):
     cursor.execute("""
     CREATE TABLE IF NOT EXISTS reminders (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -99,40 +687,462 @@ def init_database():
     )
     """)
 
-    conn.commit()
-    
-    # Проверяем существующие колонки в таблице users
+    # Базы старых версий бота могли быть созданы без этих колонок
     cursor.execute("PRAGMA table_info(users)")
     existing_columns = [column[1] for column in cursor.fetchall()]
 
-    # Если таблица уже существует но без нужных колонок - добавляем их
-    if 'username' not in existing_columns:
-        try:
-            cursor.execute("ALTER TABLE users ADD COLUMN username TEXT")
-        except:
-            pass
+    for column in ("username", "first_name", "last_name", "registered_date"):
+        if column not in existing_columns:
+            cursor.execute(f"ALTER TABLE users ADD COLUMN {column} TEXT")
 
-    if 'first_name' not in existing_columns:
-        try:
-            cursor.execute("ALTER TABLE users ADD COLUMN first_name TEXT")
-        except:
-            pass
+def migration_birthday_schedule(cursor):
+    # Ближайшая дата дня рождения хранится в таблице и сдвигается после поздравления
+    cursor.execute("PRAGMA table_info(birthdays)")
+    birthday_columns = [column[1] for column in cursor.fetchall()]
+
+    if 'next_occurrence' not in birthday_columns:
+        cursor.execute("ALTER TABLE birthdays ADD COLUMN next_occurrence TEXT")
+
+    # Журнал отправленных поздравлений: не больше одного на день рождения в год
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS birthday_notifications (
+        birthday_id INTEGER,
+        year INTEGER,
+        sent_at TEXT,
+        PRIMARY KEY (birthday_id, year)
+    )
+    """)
 
-    if 'last_name' not in existing_columns:
+    # Заполняем next_occurrence для старых записей
+    today = clock.now().date()
+    cursor.execute("SELECT id, birth_date FROM birthdays WHERE next_occurrence IS NULL")
+    for bid, birth_date in cursor.fetchall():
         try:
-            cursor.execute("ALTER TABLE users ADD COLUMN last_name TEXT")
-        except:
-            pass
+            bdate = datetime.strptime(birth_date, "%Y-%m-%d").date()
+        except (TypeError, ValueError):
+            continue
+        cursor.execute(
+            "UPDATE birthdays SET next_occurrence = ? WHERE id = ?",
+            (next_birthday(bdate, today).isoformat(), bid)
+        )
+
+def migration_indexes(cursor):
+    # Выборка напоминаний, которые пора отправить
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_reminders_due ON reminders(done, remind_time)")
+    # Список напоминаний пользователя
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_reminders_chat ON reminders(chat_id, done, remind_time)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_birthdays_chat ON birthdays(chat_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_birthdays_next ON birthdays(next_occurrence)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_timers_chat ON timers(chat_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_timers_end ON timers(end_time)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_registered ON users(registered_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_accepted ON users(accepted)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bans_until ON bans(until)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_admin_logs_timestamp ON admin_logs(timestamp)")
+
+def migration_epoch_times(cursor):
+    # Все моменты времени переводятся из ISO-строк в целые секунды UTC,
+    # bans.until = NULL означает бессрочную блокировку. SQLite не умеет менять
+    # тип колонки, поэтому таблицы пересоздаются с копированием данных.
+    cursor.connection.create_function("iso_to_epoch", 1, iso_to_epoch)
+
+    cursor.execute("""
+    CREATE TABLE reminders_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER,
+        text TEXT,
+        remind_time INTEGER,
+        category TEXT DEFAULT 'Без категории',
+        repeat_type TEXT DEFAULT 'none',
+        notify_before INTEGER DEFAULT 0,
+        done INTEGER DEFAULT 0
+    )
+    """)
+    cursor.execute("""
+        INSERT INTO reminders_new (id, chat_id, text, remind_time, category, repeat_type, notify_before, done)
+        SELECT id, chat_id, text, iso_to_epoch(remind_time), category, repeat_type, notify_before, done
+        FROM reminders
+    """)
+
+    cursor.execute("""
+    CREATE TABLE timers_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER,
+        end_time INTEGER,
+        text TEXT
+    )
+    """)
+    cursor.execute("""
+        INSERT INTO timers_new (id, chat_id, end_time, text)
+        SELECT id, chat_id, iso_to_epoch(end_time), text FROM timers
+    """)
+
+    cursor.execute("""
+    CREATE TABLE users_new (
+        chat_id INTEGER PRIMARY KEY,
+        accepted INTEGER DEFAULT 0,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        registered_date INTEGER
+    )
+    """)
+    cursor.execute("""
+        INSERT INTO users_new (chat_id, accepted, username, first_name, last_name, registered_date)
+        SELECT chat_id, accepted, username, first_name, last_name, iso_to_epoch(registered_date)
+        FROM users
+    """)
+
+    cursor.execute("""
+    CREATE TABLE bans_new (
+        chat_id INTEGER PRIMARY KEY,
+        until INTEGER,
+        reason TEXT
+    )
+    """)
+    cursor.execute("""
+        INSERT INTO bans_new (chat_id, until, reason)
+        SELECT chat_id, iso_to_epoch(until), reason FROM bans
+    """)
+
+    cursor.execute("""
+    CREATE TABLE admin_logs_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        admin_id INTEGER,
+        action TEXT,
+        target_id INTEGER,
+        details TEXT,
+        timestamp INTEGER
+    )
+    """)
+    cursor.execute("""
+        INSERT INTO admin_logs_new (id, admin_id, action, target_id, details, timestamp)
+        SELECT id, admin_id, action, target_id, details, iso_to_epoch(timestamp)
+        FROM admin_logs
+    """)
+
+    cursor.execute("""
+    CREATE TABLE birthday_notifications_new (
+        birthday_id INTEGER,
+        year INTEGER,
+        sent_at INTEGER,
+        PRIMARY KEY (birthday_id, year)
+    )
+    """)
+    cursor.execute("""
+        INSERT INTO birthday_notifications_new (birthday_id, year, sent_at)
+        SELECT birthday_id, year, iso_to_epoch(sent_at) FROM birthday_notifications
+    """)
+
+    for table in ("reminders", "timers", "users", "bans", "admin_logs", "birthday_notifications"):
+        cursor.execute(f"DROP TABLE {table}")
+        cursor.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+    # Индексы удалились вместе со старыми таблицами
+    migration_indexes(cursor)
 
-    if 'registered_date' not in existing_columns:
+def migration_broadcast_jobs(cursor):
+    # Рассылка - фоновая задача. cursor - chat_id последнего получателя,
+    # по нему рассылка продолжается после паузы или перезапуска бота.
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        admin_id INTEGER,
+        text TEXT,
+        status TEXT DEFAULT 'running',
+        cursor INTEGER DEFAULT 0,
+        total INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        message_id INTEGER,
+        created_at INTEGER,
+        finished_at INTEGER
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts(status)")
+
+def migration_fsm_state(cursor):
+    # Состояния диалогов (user_state/temp_data) переживают перезапуск бота
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS fsm_state (
+        namespace TEXT,
+        key TEXT,
+        value TEXT,
+        expires_at INTEGER,
+        PRIMARY KEY (namespace, key)
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fsm_state_expires ON fsm_state(expires_at)")
+
+# ============================================================
+# СЧЕТЧИКИ
+# ============================================================
+
+# Количество строк в таблицах хранится в counters и поддерживается
+# триггерами, поэтому статистика читает готовые числа вместо COUNT(*)
+# по всей таблице. В counter_days - сколько строк добавлено за каждый
+# день по Москве (для «сегодня» и «за неделю»). День триггер получает из
+# Python - функцией counter_day(), которую регистрирует open_db_connection:
+# так граница суток совпадает с clock (и с SimulatedClock на стендах).
+# Вставлять в эти таблицы в обход get_db_connection поэтому нельзя.
+# Если таблицу пересоздать (как в migration_epoch_times), ее триггеры
+# удалятся - после этого нужно снова вызвать create_counter_triggers.
+
+# таблица -> имя счетчика
+COUNTED_TABLES = {
+    "users": "users",
+    "bans": "bans",
+    "reminders": "reminders",
+    "birthdays": "birthdays",
+    "timers": "timers",
+}
+# Счетчики, для которых ведется разбивка по дням
+DAILY_COUNTERS = ("users", "reminders", "birthdays", "timers")
+
+def counter_day():
+    return clock.now().date().isoformat()
+
+def moscow_day_sql(column):
+    # Московская дата момента из колонки (секунды UTC). Смещение Москвы
+    # от UTC постоянное (без перехода на летнее время)
+    offset = int(clock.now().utcoffset().total_seconds() // 60)
+    return f"date({column}, 'unixepoch', '{offset:+d} minutes')"
+
+def create_counter_triggers(cursor):
+    for table, name in COUNTED_TABLES.items():
+        daily = ""
+        if name in DAILY_COUNTERS:
+            daily = f"""
+                INSERT INTO counter_days (name, day, value) VALUES ('{name}', counter_day(), 1)
+                ON CONFLICT(name, day) DO UPDATE SET value = value + 1;"""
+
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS counters_{table}_insert AFTER INSERT ON {table}
+        BEGIN
+            UPDATE counters SET value = value + 1 WHERE name = '{name}';{daily}
+        END
+        """)
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS counters_{table}_delete AFTER DELETE ON {table}
+        BEGIN
+            UPDATE counters SET value = value - 1 WHERE name = '{name}';
+        END
+        """)
+
+    # Принявшие соглашение: accepted меняется и при вставке, и при обновлении
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS counters_users_accepted_insert AFTER INSERT ON users
+    WHEN COALESCE(NEW.accepted, 0) != 0
+    BEGIN
+        UPDATE counters SET value = value + 1 WHERE name = 'users_accepted';
+    END
+    """)
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS counters_users_accepted_update AFTER UPDATE OF accepted ON users
+    WHEN COALESCE(NEW.accepted, 0) != COALESCE(OLD.accepted, 0)
+    BEGIN
+        UPDATE counters SET value = value + (CASE WHEN COALESCE(NEW.accepted, 0) != 0 THEN 1 ELSE -1 END)
+        WHERE name = 'users_accepted';
+    END
+    """)
+    cursor.execute("""
+    CREATE TRIGGER IF NOT EXISTS counters_users_accepted_delete AFTER DELETE ON users
+    WHEN COALESCE(OLD.accepted, 0) != 0
+    BEGIN
+        UPDATE counters SET value = value - 1 WHERE name = 'users_accepted';
+    END
+    """)
+
+def reconcile_counters(cursor):
+    # Полный пересчет счетчиков по таблицам. Разбивку по дням можно
+    # восстановить только для пользователей (у них есть registered_date),
+    # у остальных таблиц времени создания нет - их дни не трогаем.
+    totals = {}
+    for table, name in COUNTED_TABLES.items():
+        totals[name] = cursor.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    totals["users_accepted"] = cursor.execute(
+        "SELECT COUNT(*) FROM users WHERE accepted = 1"
+    ).fetchone()[0]
+
+    cursor.executemany("""
+        INSERT INTO counters (name, value) VALUES (?, ?)
+        ON CONFLICT(name) DO UPDATE SET value = excluded.value
+    """, totals.items())
+
+    cursor.execute("DELETE FROM counter_days WHERE name = 'users'")
+    cursor.execute(f"""
+        INSERT INTO counter_days (name, day, value)
+        SELECT 'users', {moscow_day_sql("registered_date")} AS day, COUNT(*)
+        FROM users WHERE registered_date IS NOT NULL
+        GROUP BY day
+    """)
+    return totals
+
+def migration_counters(cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER DEFAULT 0
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS counter_days (
+        name TEXT,
+        day TEXT,
+        value INTEGER DEFAULT 0,
+        PRIMARY KEY (name, day)
+    )
+    """)
+    create_counter_triggers(cursor)
+    reconcile_counters(cursor)
+
+def reconcile_counters_now():
+    conn = get_db_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        totals = reconcile_counters(conn.cursor())
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return totals
+
+def read_counters():
+    conn = get_db_connection()
+    totals = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+
+    today = clock.now().date()
+    week_start = today - timedelta(days=today.weekday())
+    rows = conn.execute("""
+        SELECT name,
+               SUM(CASE WHEN day = ? THEN value ELSE 0 END),
+               SUM(value)
+        FROM counter_days
+        WHERE day >= ?
+        GROUP BY name
+    """, (today.isoformat(), week_start.isoformat())).fetchall()
+    conn.close()
+
+    days = {name: (today_count, week_count) for name, today_count, week_count in rows}
+    return totals, days
+
+def migration_pagination(cursor):
+    # Постраничные списки идут по ключу (колонка сортировки, id). В сравнении
+    # кортежей NULL не участвует, поэтому пустые даты заменяются нулем.
+    cursor.execute("UPDATE users SET registered_date = 0 WHERE registered_date IS NULL")
+    cursor.execute("UPDATE admin_logs SET timestamp = 0 WHERE timestamp IS NULL")
+    # Дни рождения пользователя по ближайшей дате
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_birthdays_chat_next ON birthdays(chat_id, next_occurrence)")
+
+def migration_delivery_lateness(cursor):
+    # Опоздания уведомлений: одна строка на вид и час. le_N - сколько
+    # уведомлений опоздало не больше чем на N секунд (и больше предыдущей
+    # границы), колонки совпадают с LATENESS_BUCKETS
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS delivery_lateness (
+            kind TEXT NOT NULL,
+            hour INTEGER NOT NULL,
+            le_1 INTEGER NOT NULL DEFAULT 0,
+            le_2 INTEGER NOT NULL DEFAULT 0,
+            le_5 INTEGER NOT NULL DEFAULT 0,
+            le_10 INTEGER NOT NULL DEFAULT 0,
+            le_30 INTEGER NOT NULL DEFAULT 0,
+            le_60 INTEGER NOT NULL DEFAULT 0,
+            le_120 INTEGER NOT NULL DEFAULT 0,
+            le_300 INTEGER NOT NULL DEFAULT 0,
+            le_600 INTEGER NOT NULL DEFAULT 0,
+            le_1800 INTEGER NOT NULL DEFAULT 0,
+            le_3600 INTEGER NOT NULL DEFAULT 0,
+            le_10800 INTEGER NOT NULL DEFAULT 0,
+            le_86400 INTEGER NOT NULL DEFAULT 0,
+            le_inf INTEGER NOT NULL DEFAULT 0,
+            total REAL NOT NULL DEFAULT 0,
+            delivered INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            retries INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (hour, kind)
+        ) WITHOUT ROWID
+    """)
+
+def migration_delivery_claims(cursor):
+    # Захват строки на время отправки (см. "ЗАХВАТ И ПОДТВЕРЖДЕНИЕ ДОСТАВКИ")
+    for table in ("reminders", "timers"):
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN claimed_until INTEGER")
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+
+def migration_counter_day_clock(cursor):
+    # Триггеры вставки считали день через date('now') в SQLite, мимо clock;
+    # пересоздаем их с counter_day()
+    for table in COUNTED_TABLES:
+        cursor.execute(f"DROP TRIGGER IF EXISTS counters_{table}_insert")
+    create_counter_triggers(cursor)
+
+def migration_reminder_notify_at(cursor):
+    # notify_at - когда отправить следующее уведомление напоминания: заранее
+    # (remind_time - notify_before минут), а после него - в сам срок.
+    # checker выбирает по индексу только то, что уже пора отправить.
+    cursor.execute("ALTER TABLE reminders ADD COLUMN notify_at INTEGER")
+    cursor.execute("UPDATE reminders SET notify_at = remind_time - COALESCE(notify_before, 0) * 60")
+    cursor.execute("DROP INDEX IF EXISTS idx_reminders_due")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_reminders_notify ON reminders(done, notify_at)")
+
+MIGRATIONS = [
+    migration_base_schema,
+    migration_birthday_schedule,
+    migration_indexes,
+    migration_epoch_times,
+    migration_broadcast_jobs,
+    migration_fsm_state,
+    migration_counters,
+    migration_pagination,
+    migration_delivery_lateness,
+    migration_delivery_claims,
+    migration_reminder_notify_at,
+    migration_counter_day_clock,
+]
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def apply_migrations(conn):
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        if get_schema_version(conn) >= version:
+            continue
+
+        # IMMEDIATE: второй процесс дождется окончания миграции и не применит ее повторно
+        conn.execute("BEGIN IMMEDIATE")
         try:
-            cursor.execute("ALTER TABLE users ADD COLUMN registered_date TEXT")
-        except:
-            pass
+            if get_schema_version(conn) < version:
+                migration(conn.cursor())
+                conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
 
-    conn.commit()
+        print(f"Схема базы данных обновлена до версии {version}")
+
+# Создаем и обновляем таблицы при запуске
+def init_database():
+    conn = get_db_connection()
+    apply_migrations(conn)
     conn.close()
 
+# ============================================================
+# ДАТЫ ДНЕЙ РОЖДЕНИЯ
+# ============================================================
+
+def birthday_in_year(bdate, year):
+    # 29 февраля в невисокосный год отмечаем 28 февраля
+    day = min(bdate.day, calendar.monthrange(year, bdate.month)[1])
+    return date(year, bdate.month, day)
+
+def next_birthday(bdate, today):
+    next_bd = birthday_in_year(bdate, today.year)
+    if next_bd < today:
+        next_bd = birthday_in_year(bdate, today.year + 1)
+    return next_bd
+
 # Инициализируем базу данных
 init_database()
 
@@ -140,8 +1150,166 @@ init_database()
 # СОСТОЯНИЯ
 # ============================================================
 
-user_state = {}
-temp_data = {}
+# Сколько живет незавершенный диалог (выбор даты, бан, рассылка), секунд
+FSM_TTL = 60 * 60
+# Сколько записей каждого хранилища держать в памяти
+FSM_CACHE_SIZE = 10000
+
+def encode_state(value):
+    def default(obj):
+        if isinstance(obj, date):
+            return {"__date__": obj.isoformat()}
+        raise TypeError(f"Нельзя сохранить {type(obj).__name__}")
+    return json.dumps(value, ensure_ascii=False, default=default)
+
+def decode_state(text):
+    def object_hook(obj):
+        if "__date__" in obj:
+            return date.fromisoformat(obj["__date__"])
+        return obj
+    return json.loads(text, object_hook=object_hook)
+
+class StateStore:
+    # Словарь с временем жизни записей. Последние записи (и отметки об их
+    # отсутствии) лежат в ограниченном LRU в памяти, все записи - в таблице
+    # fsm_state, поэтому диалог не теряется при перезапуске, а память не
+    # растет от брошенных диалогов.
+    MISSING = object()
+
+    def __init__(self, namespace, ttl=FSM_TTL, cache_size=FSM_CACHE_SIZE):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # ключ -> (значение или MISSING, expires_at)
+        self.lock = threading.RLock()
+
+    def _remember(self, key, value, expires_at):
+        self.cache[key] = (value, expires_at)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _load(self, key):
+        conn = get_db_connection()
+        row = conn.execute(
+            "SELECT value, expires_at FROM fsm_state WHERE namespace = ? AND key = ?",
+            (self.namespace, str(key))
+        ).fetchone()
+        if row is None or row[1] <= now_epoch():
+            return self.MISSING, None
+        return decode_state(row[0]), row[1]
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None:
+                entry = self._load(key)
+                self._remember(key, *entry)
+            value, expires_at = entry
+            if value is self.MISSING:
+                return default
+            if expires_at <= now_epoch():
+                self._remember(key, self.MISSING, None)
+                return default
+            self.cache.move_to_end(key)
+            return value
+
+    def __contains__(self, key):
+        return self.get(key, self.MISSING) is not self.MISSING
+
+    def __getitem__(self, key):
+        value = self.get(key, self.MISSING)
+        if value is self.MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        expires_at = now_epoch() + self.ttl
+        with self.lock:
+            conn = get_db_connection()
+            conn.execute("""
+                INSERT INTO fsm_state (namespace, key, value, expires_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(namespace, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at
+            """, (self.namespace, str(key), encode_state(value), expires_at))
+            conn.commit()
+            self._remember(key, value, expires_at)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            value = self.get(key, self.MISSING)
+            if value is self.MISSING:
+                return default
+            conn = get_db_connection()
+            conn.execute(
+                "DELETE FROM fsm_state WHERE namespace = ? AND key = ?",
+                (self.namespace, str(key))
+            )
+            conn.commit()
+            self._remember(key, self.MISSING, None)
+            return value
+
+    def evict_expired(self):
+        now = now_epoch()
+        with self.lock:
+            conn = get_db_connection()
+            conn.execute(
+                "DELETE FROM fsm_state WHERE namespace = ? AND expires_at <= ?",
+                (self.namespace, now)
+            )
+            conn.commit()
+            for key in [k for k, (v, exp) in self.cache.items() if v is not self.MISSING and exp <= now]:
+                self._remember(key, self.MISSING, None)
+
+user_state = StateStore("user_state")
+temp_data = StateStore("temp_data")
+
+# ============================================================
+# КЭШ ДОСТУПА
+# ============================================================
+
+# Принявшие соглашение и заблокированные пользователи держатся в памяти.
+# Кэш загружается при запуске и обновляется при каждой записи в базу,
+# поэтому check_access в обычном случае не обращается к диску.
+accepted_users = set()
+banned_users = {}  # chat_id -> окончание блокировки в epoch (None - навсегда)
+access_lock = threading.Lock()
+access_cache_loaded = False
+access_stats = {"hits": 0, "misses": 0}
+
+def load_access_cache():
+    global access_cache_loaded
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT chat_id FROM users WHERE accepted = 1")
+    accepted = {row[0] for row in cursor.fetchall()}
+    cursor.execute("SELECT chat_id, until FROM bans")
+    bans = {}
+    for chat_id, until in cursor.fetchall():
+        bans[chat_id] = until
+    conn.close()
+
+    with access_lock:
+        accepted_users.clear()
+        accepted_users.update(accepted)
+        banned_users.clear()
+        banned_users.update(bans)
+        access_cache_loaded = True
+
+def cache_ban(chat_id, until):
+    with access_lock:
+        banned_users[chat_id] = until
+
+def cache_unban(chat_id):
+    with access_lock:
+        banned_users.pop(chat_id, None)
+
+def access_hit_ratio():
+    total = access_stats["hits"] + access_stats["misses"]
+    if total == 0:
+        return 0.0
+    return access_stats["hits"] / total
 
 # ============================================================
 # ПРОВЕРКИ (исправлено - теперь каждое обращение создает новое соединение)
@@ -151,6 +1319,11 @@ def is_admin(chat_id):
     return chat_id == ADMIN_ID
 
 def is_accepted(chat_id):
+    if access_cache_loaded:
+        access_stats["hits"] += 1
+        return chat_id in accepted_users
+
+    access_stats["misses"] += 1
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT accepted FROM users WHERE chat_id=?", (chat_id,))
@@ -162,14 +1335,36 @@ def set_accepted(chat_id):
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute("""
-        INSERT INTO users(chat_id, accepted)
-        VALUES (?, 1)
+        INSERT INTO users(chat_id, accepted, registered_date)
+        VALUES (?, 1, ?)
         ON CONFLICT(chat_id) DO UPDATE SET accepted=1
-    """, (chat_id,))
+    """, (chat_id, now_epoch()))
     conn.commit()
     conn.close()
 
+    with access_lock:
+        accepted_users.add(chat_id)
+
 def is_banned(chat_id):
+    if access_cache_loaded:
+        until = banned_users.get(chat_id, False)
+        if until is False:
+            access_stats["hits"] += 1
+            return False
+        if until is None or now_epoch() < until:
+            access_stats["hits"] += 1
+            return True
+
+        # Блокировка истекла - удаляем ее из кэша и из базы
+        access_stats["misses"] += 1
+        cache_unban(chat_id)
+        conn = get_db_connection()
+        conn.execute("DELETE FROM bans WHERE chat_id=?", (chat_id,))
+        conn.commit()
+        conn.close()
+        return False
+
+    access_stats["misses"] += 1
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT until FROM bans WHERE chat_id=?", (chat_id,))
@@ -181,40 +1376,427 @@ def is_banned(chat_id):
 
     until = row[0]
 
-    if until == "permanent":
+    if until is None or now_epoch() < until:
         conn.close()
         return True
 
-    try:
-        until_dt = datetime.fromisoformat(until)
-        if datetime.now(TZ) < until_dt:
-            conn.close()
-            return True
-        else:
-            cursor.execute("DELETE FROM bans WHERE chat_id=?", (chat_id,))
-            conn.commit()
-            conn.close()
-            return False
-    except:
-        conn.close()
-        return False
+    cursor.execute("DELETE FROM bans WHERE chat_id=?", (chat_id,))
+    conn.commit()
+    conn.close()
+    return False
 
 def log_admin_action(admin_id, action, target_id=None, details=""):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
+    return submit_write("""
         INSERT INTO admin_logs (admin_id, action, target_id, details, timestamp)
         VALUES (?, ?, ?, ?, ?)
-    """, (admin_id, action, target_id, details, datetime.now(TZ).isoformat()))
-    conn.commit()
-    conn.close()
+    """, (admin_id, action, target_id, details, now_epoch()))
+
+# ============================================================
+# ОЧЕРЕДЬ ИСХОДЯЩИХ СООБЩЕНИЙ
+# ============================================================
+
+# Все отправки и редактирования сообщений, а также ответы на нажатия
+# кнопок идут через одну очередь.
+# Она соблюдает общий лимит Telegram (~30 сообщений в секунду) и лимит
+# одного чата (~1 сообщение в секунду), повторяет отправку при 429 и
+# сетевых ошибках, а неудачи пишет в лог вместо молчаливого except: pass.
+
+OUTBOX_RATE = 25
+OUTBOX_PER_CHAT_INTERVAL = 1.0
+OUTBOX_WORKERS = 4
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_MAX_BACKOFF = 60
+
+class TokenBucket:
+    # Ведро токенов: не больше rate операций в секунду, всплеск до capacity
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+outbox_bucket = TokenBucket(OUTBOX_RATE, OUTBOX_RATE)
+outbox_cond = threading.Condition()
+outbox_queues = {}      # chat_id -> deque заданий этого чата
+outbox_next_send = {}   # chat_id -> время (monotonic), раньше которого чату писать нельзя
+outbox_ready = []       # куча (время готовности, порядковый номер, chat_id)
+outbox_busy = set()     # чаты, задание которых сейчас отправляется
+outbox_seq = 0
+outbox_paused_until = 0.0
+outbox_stats = {"queued": 0, "sent": 0, "failed": 0, "retried": 0}
+
+def get_retry_after(error):
+    # Telegram при 429 сообщает, сколько секунд подождать
+    parameters = (getattr(error, "result_json", None) or {}).get("parameters") or {}
+    return parameters.get("retry_after")
+
+def is_transient_error(error):
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    return isinstance(error, ApiTelegramException) and error.error_code >= 500
+
+def outbox_schedule(chat_id, ready_at):
+    # Вызывается под outbox_cond
+    global outbox_seq
+    outbox_seq += 1
+    heapq.heappush(outbox_ready, (ready_at, outbox_seq, chat_id))
+    outbox_cond.notify()
+
+def outbox_submit(chat_id, method, *args, **kwargs):
+    future = Future()
+    job = {"method": method, "args": args, "kwargs": kwargs, "future": future, "attempts": 0}
+    # По заданию в колбэке видно, сколько было попыток (send_scheduled)
+    future.job = job
+    with outbox_cond:
+        queue = outbox_queues.get(chat_id)
+        if queue is None:
+            queue = outbox_queues[chat_id] = deque()
+        queue.append(job)
+        outbox_stats["queued"] += 1
+        # Чат с непустой очередью либо уже в куче, либо отправляется прямо сейчас
+        if len(queue) == 1 and chat_id not in outbox_busy:
+            outbox_schedule(chat_id, max(time.monotonic(), outbox_next_send.get(chat_id, 0)))
+    return future
+
+def send_message(chat_id, text, **kwargs):
+    return outbox_submit(chat_id, bot.send_message, chat_id, text, **kwargs)
+
+def edit_message_text(text, chat_id, message_id, **kwargs):
+    return outbox_submit(chat_id, bot.edit_message_text, text, chat_id, message_id, **kwargs)
+
+def edit_message_reply_markup(chat_id, message_id, **kwargs):
+    return outbox_submit(chat_id, bot.edit_message_reply_markup, chat_id, message_id, **kwargs)
+
+def answer_callback_query(callback_query_id, text=None, **kwargs):
+    # Ответ на нажатие не сообщение в чат: своя очередь на каждое нажатие,
+    # поэтому интервал чата его не задерживает, а общий лимит и 429 - да
+    return outbox_submit(
+        ("callback", callback_query_id), bot.answer_callback_query, callback_query_id, text, **kwargs
+    )
+
+def outbox_depth():
+    with outbox_cond:
+        return sum(len(queue) for queue in outbox_queues.values())
+
+def outbox_take():
+    # Ждет чат, которому уже можно отправлять, и забирает его первое задание
+    with outbox_cond:
+        while True:
+            if not outbox_ready:
+                outbox_cond.wait()
+                continue
+            delay = outbox_ready[0][0] - time.monotonic()
+            if delay > 0:
+                outbox_cond.wait(delay)
+                continue
+            _, _, chat_id = heapq.heappop(outbox_ready)
+            outbox_busy.add(chat_id)
+            return chat_id, outbox_queues[chat_id].popleft()
+
+def outbox_release(chat_id, job=None, delay=None):
+    # job - задание, которое нужно повторить первым после паузы delay
+    if delay is None:
+        delay = OUTBOX_PER_CHAT_INTERVAL
+    with outbox_cond:
+        outbox_busy.discard(chat_id)
+        ready_at = time.monotonic() + delay
+        outbox_next_send[chat_id] = ready_at
+        queue = outbox_queues[chat_id]
+        if job is not None:
+            queue.appendleft(job)
+        if queue:
+            outbox_schedule(chat_id, ready_at)
+        else:
+            del outbox_queues[chat_id]
+            if len(outbox_next_send) > 10000:
+                # Старые отметки уже не ограничивают отправку
+                now = time.monotonic()
+                for stale in [c for c, t in outbox_next_send.items() if t < now]:
+                    del outbox_next_send[stale]
+
+def outbox_worker():
+    global outbox_paused_until
+
+    while True:
+        chat_id, job = outbox_take()
+
+        # После глобального 429 ждем, пока Telegram снова начнет принимать
+        pause = outbox_paused_until - time.monotonic()
+        if pause > 0:
+            time.sleep(pause)
+        outbox_bucket.acquire()
+
+        job["attempts"] += 1
+        try:
+            with MetricTimer(f"telegram.{job['method'].__name__}"):
+                result = job["method"](*job["args"], **job["kwargs"])
+        except Exception as e:
+            if isinstance(e, ApiTelegramException) and e.error_code == 429:
+                retry_after = get_retry_after(e) or 1
+                outbox_paused_until = time.monotonic() + retry_after
+                outbox_stats["retried"] += 1
+                outbox_release(chat_id, job, retry_after)
+                continue
+
+            if is_transient_error(e) and job["attempts"] < OUTBOX_MAX_ATTEMPTS:
+                outbox_stats["retried"] += 1
+                outbox_release(chat_id, job, min(2 ** job["attempts"], OUTBOX_MAX_BACKOFF))
+                continue
+
+            if isinstance(e, ApiTelegramException) and "message is not modified" in str(e):
+                # Повторное редактирование тем же текстом - не ошибка
+                job["future"].set_result(None)
+            else:
+                outbox_stats["failed"] += 1
+                print(f"Error in outbox_worker: chat {chat_id}: {e}")
+                job["future"].set_exception(e)
+            outbox_release(chat_id)
+            continue
+
+        outbox_stats["sent"] += 1
+        job["future"].set_result(result)
+        outbox_release(chat_id)
+
+def start_outbox():
+    for _ in range(OUTBOX_WORKERS):
+        threading.Thread(target=outbox_worker, daemon=True).start()
+
+# ============================================================
+# СВОЕВРЕМЕННОСТЬ УВЕДОМЛЕНИЙ
+# ============================================================
+
+# Для каждого уведомления по расписанию (таймер, напоминание, поздравление)
+# запоминается опоздание: момент, когда Telegram принял сообщение, минус срок.
+# Опоздания копятся в гистограммах по часам, и checker на каждом проходе
+# дописывает их в delivery_lateness (одна строка на вид и час). Если p99 за
+# час выше SLO_LATENESS_P99, администратор получает одно предупреждение.
+
+# Границы корзин опоздания, в секундах; по ним названы колонки delivery_lateness,
+# поэтому новые границы требуют новой миграции
+LATENESS_BUCKETS = (1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 3 * 3600, 24 * 3600)
+LATENESS_COLUMNS = [f"le_{bound}" for bound in LATENESS_BUCKETS] + ["le_inf"]
+# Норма для p99; лучше брать одну из границ корзин, p99 оценивается по ним
+SLO_LATENESS_P99 = 120
+# Меньше доставок за час - слишком мало для p99, предупреждение не шлем
+SLO_MIN_DELIVERIES = 20
+LATENESS_KINDS = {"timer": "Таймеры", "reminder": "Напоминания", "birthday": "Дни рождения"}
+
+class LatenessBucket:
+    __slots__ = ("histogram", "retries")
+
+    def __init__(self):
+        # histogram.errors - неудачные отправки, в корзины они не попадают
+        self.histogram = Histogram(LATENESS_BUCKETS)
+        self.retries = 0
+
+lateness_lock = threading.Lock()
+lateness_pending = {}       # (вид, начало часа) -> LatenessBucket, еще не записанный в базу
+lateness_alerted = set()    # (вид, начало часа), о которых администратор уже знает
+
+def record_lateness(kind, due, sent_at, failed=False, retries=0):
+    hour = int(sent_at) // 3600 * 3600
+    with lateness_lock:
+        bucket = lateness_pending.get((kind, hour))
+        if bucket is None:
+            bucket = lateness_pending[(kind, hour)] = LatenessBucket()
+        if failed:
+            bucket.histogram.errors += 1
+        else:
+            bucket.histogram.observe(max(0, sent_at - due))
+        bucket.retries += retries
+
+def send_scheduled(kind, due, chat_id, text, **kwargs):
+    # send_message для уведомления со сроком due (epoch)
+    future = send_message(chat_id, text, **kwargs)
+
+    def done(future):
+        record_lateness(kind, due, clock.time(), future.exception() is not None,
+                        future.job["attempts"] - 1)
+
+    future.add_done_callback(done)
+    return future
+
+def flush_lateness(conn):
+    # Переносит накопленное в базу; коммит - за вызывающим
+    with lateness_lock:
+        pending = list(lateness_pending.items())
+        lateness_pending.clear()
+    if not pending:
+        return []
+
+    columns = ", ".join(LATENESS_COLUMNS)
+    placeholders = ", ".join("?" for _ in LATENESS_COLUMNS)
+    updates = ", ".join(f"{column} = {column} + excluded.{column}" for column in LATENESS_COLUMNS)
+    conn.executemany(f"""
+        INSERT INTO delivery_lateness (kind, hour, {columns}, total, delivered, failed, retries)
+        VALUES (?, ?, {placeholders}, ?, ?, ?, ?)
+        ON CONFLICT(hour, kind) DO UPDATE SET {updates},
+            total = total + excluded.total,
+            delivered = delivered + excluded.delivered,
+            failed = failed + excluded.failed,
+            retries = retries + excluded.retries
+    """, [
+        (kind, hour, *bucket.histogram.counts, bucket.histogram.total,
+         bucket.histogram.count, bucket.histogram.errors, bucket.retries)
+        for (kind, hour), bucket in pending
+    ])
+    return [key for key, _ in pending]
+
+def read_lateness(conn, since):
+    # {(вид, начало часа): (Histogram, повторов)} за часы начиная с since
+    rows = conn.execute(f"""
+        SELECT kind, hour, {", ".join(LATENESS_COLUMNS)}, total, delivered, failed, retries
+        FROM delivery_lateness
+        WHERE hour >= ?
+        ORDER BY hour
+    """, (since,)).fetchall()
+
+    result = {}
+    for row in rows:
+        histogram = Histogram(LATENESS_BUCKETS)
+        histogram.counts = list(row[2:2 + len(LATENESS_COLUMNS)])
+        histogram.total, histogram.count, histogram.errors, retries = row[2 + len(LATENESS_COLUMNS):]
+        result[(row[0], row[1])] = (histogram, retries)
+    return result
+
+def merge_lateness(items):
+    merged = Histogram(LATENESS_BUCKETS)
+    retries = 0
+    for histogram, extra in items:
+        merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+        merged.total += histogram.total
+        merged.count += histogram.count
+        merged.errors += histogram.errors
+        retries += extra
+    return merged, retries
+
+def check_lateness_slo(conn, hours):
+    # Предупреждения по часам, в которые только что были доставки
+    keys = set(hours) - lateness_alerted
+    if not keys:
+        return []
+
+    since = min(hour for _, hour in keys)
+    alerts = []
+    for key, (histogram, _) in read_lateness(conn, since).items():
+        if key not in keys or histogram.count < SLO_MIN_DELIVERIES:
+            continue
+        p99 = histogram.percentile(0.99)
+        if p99 > SLO_LATENESS_P99:
+            lateness_alerted.add(key)
+            alerts.append((key[0], key[1], p99, histogram.count, histogram.errors))
+
+    # Старые отметки больше не понадобятся
+    horizon = int(clock.time()) - 2 * 86400
+    for stale in [key for key in lateness_alerted if key[1] < horizon]:
+        lateness_alerted.discard(stale)
+    return alerts
+
+def format_lateness(seconds):
+    if seconds == float("inf"):
+        return f">{LATENESS_BUCKETS[-1] // 3600} ч"
+    if seconds >= 3600:
+        return f"{seconds / 3600:g} ч"
+    if seconds >= 60:
+        return f"{seconds / 60:g} мин"
+    return f"{seconds:g} с"
+
+def send_lateness_alerts(alerts):
+    for kind, hour, p99, delivered, failed in alerts:
+        text = (
+            f"⚠️ Уведомления опаздывают\n\n"
+            f"{LATENESS_KINDS.get(kind, kind)}, час с {from_epoch(hour).strftime('%d.%m %H:00')}: "
+            f"p99 ≤{format_lateness(p99)} при норме {format_lateness(SLO_LATENESS_P99)}\n"
+            f"Доставлено: {delivered}, ошибок: {failed}"
+        )
+        send_message(ADMIN_ID, text)
+
+# ============================================================
+# ОТЛОЖЕННЫЕ ЗАДАЧИ
+# ============================================================
+
+# Один поток и куча (дедлайн, порядковый номер, задача). Поток спит до
+# ближайшего дедлайна; новая более ранняя задача будит его через notify().
+# Отмена ленивая: задача помечается и пропускается, когда подходит ее срок.
+# Колбэки выполняются в потоке планировщика и должны быть короткими
+# (поставить сообщение в очередь, записать строку в базу).
+
+class DelayedTask:
+    __slots__ = ("deadline", "callback", "args", "cancelled")
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+task_heap = []
+task_cond = clock_condition()
+task_seq = itertools.count()
+
+def schedule_at(deadline, callback, *args):
+    # deadline - epoch в секундах
+    task = DelayedTask(deadline, callback, args)
+    with task_cond:
+        heapq.heappush(task_heap, (deadline, next(task_seq), task))
+        # Будим поток только если новая задача стала ближайшей
+        if task_heap[0][2] is task:
+            task_cond.notify()
+    return task
+
+def schedule_in(delay, callback, *args):
+    return schedule_at(clock.time() + delay, callback, *args)
+
+def pending_tasks():
+    with task_cond:
+        return len(task_heap)
+
+def delayed_task_worker():
+    while True:
+        with task_cond:
+            while not task_heap:
+                clock.wait(task_cond)
+
+            delay = task_heap[0][0] - clock.time()
+            if delay > 0:
+                clock.wait(task_cond, delay)
+                continue
+
+            _, _, task = heapq.heappop(task_heap)
+
+        if task.cancelled:
+            continue
+
+        # Выполняем уже без блокировки, чтобы schedule_at не ждал колбэк
+        try:
+            task.callback(*task.args)
+        except Exception as e:
+            print(f"Error in delayed_task_worker: {task.callback.__name__}: {e}")
 
 # ============================================================
 # ДЕКОРАТОР ДЛЯ ПРОВЕРКИ ДОСТУПА (исправлен)
 # ============================================================
 
 def check_access(func):
+    @functools.wraps(func)
     def wrapper(message_or_call):
+        started = time.perf_counter() if METRICS_ENABLED else None
         try:
             if hasattr(message_or_call, 'chat'):
                 chat_id = message_or_call.chat.id
@@ -226,22 +1808,25 @@ def check_access(func):
             # Проверяем бан
             if is_banned(chat_id):
                 if hasattr(message_or_call, 'chat'):
-                    bot.send_message(chat_id, "🚫 Вы заблокированы")
+                    send_message(chat_id, "🚫 Вы заблокированы")
                 else:
-                    bot.answer_callback_query(message_or_call.id, "🚫 Вы заблокированы", show_alert=True)
+                    answer_callback_query(message_or_call.id, "🚫 Вы заблокированы", show_alert=True)
                 return
 
             # Проверяем принятие соглашения (пропускаем /start и accept_agreement)
             if not is_accepted(chat_id):
                 if hasattr(message_or_call, 'chat'):
                     if message_or_call.text != "/start":
-                        bot.send_message(chat_id, "❗ Сначала примите соглашение через /start")
+                        send_message(chat_id, "❗ Сначала примите соглашение через /start")
                         return
                 elif hasattr(message_or_call, 'data'):
                     if message_or_call.data != "accept_agreement" and not message_or_call.data.startswith("year_") and not message_or_call.data.startswith("month_") and not message_or_call.data.startswith("day_"):
-                        bot.answer_callback_query(message_or_call.id, "❗ Сначала примите соглашение", show_alert=True)
+                        answer_callback_query(message_or_call.id, "❗ Сначала примите соглашение", show_alert=True)
                         return
 
+            if started is not None:
+                observe("check_access", time.perf_counter() - started)
+
             # Вызываем функцию
             return func(message_or_call)
             
@@ -254,61 +1839,354 @@ def check_access(func):
                 return
     return wrapper
 
+# ============================================================
+# МАРШРУТИЗАЦИЯ ТЕКСТОВЫХ СООБЩЕНИЙ
+# ============================================================
+
+# Вместо цепочки message_handler(func=...), которые telebot проверяет по
+# очереди, текст разбирается за постоянное время: сначала по состоянию
+# пользователя, затем точным совпадением с кнопкой меню, затем по
+# короткому упорядоченному списку шаблонов (день рождения, таймер).
+STATE_ROUTES = {}
+TEXT_ROUTES = {}
+PATTERN_ROUTES = []
+route_hits = {}
+
+def state_route(state):
+    def decorator(func):
+        STATE_ROUTES[state] = func
+        return func
+    return decorator
+
+def text_route(text):
+    def decorator(func):
+        TEXT_ROUTES[text] = func
+        return func
+    return decorator
+
+def pattern_route(pattern):
+    def decorator(func):
+        PATTERN_ROUTES.append((re.compile(pattern, re.DOTALL), func))
+        return func
+    return decorator
+
+def find_route(message):
+    state = user_state.get(message.chat.id)
+    if state in STATE_ROUTES:
+        return STATE_ROUTES[state]
+
+    handler = TEXT_ROUTES.get(message.text)
+    if handler is not None:
+        return handler
+
+    for pattern, handler in PATTERN_ROUTES:
+        if pattern.match(message.text):
+            return handler
+
+    return handle_other_messages
+
 # ============================================================
 # КЛАВИАТУРЫ (исправлено - убрана кнопка "Планы на сегодня")
 # ============================================================
 
-def main_keyboard(chat_id):
+# Клавиатуры хранятся уже сериализованными в JSON: telebot передает строку
+# в reply_markup как есть и не пересобирает разметку при каждой отправке.
+# Постоянные клавиатуры строятся один раз. Календарные зависят от текущей
+# даты, поэтому ключ включает сегодняшний день по Москве, а кэш целиком
+# сбрасывается, когда день сменился.
+
+static_keyboards = {}
+calendar_keyboards = {}
+calendar_keyboards_day = None
+keyboard_lock = threading.Lock()
+keyboard_stats = {"hits": 0, "misses": 0}
+
+def cached_keyboard(key, build):
+    with keyboard_lock:
+        markup = static_keyboards.get(key)
+        if markup is not None:
+            keyboard_stats["hits"] += 1
+            return markup
+
+    markup = build().to_json()
+    with keyboard_lock:
+        keyboard_stats["misses"] += 1
+        static_keyboards[key] = markup
+    return markup
+
+def cached_calendar_keyboard(kind, year, month, build):
+    global calendar_keyboards_day
+    today = clock.now().date()
+    key = (kind, year, month, today)
+
+    with keyboard_lock:
+        if calendar_keyboards_day != today:
+            # Наступила полночь по Москве - вчерашние клавиатуры устарели
+            calendar_keyboards.clear()
+            calendar_keyboards_day = today
+        markup = calendar_keyboards.get(key)
+        if markup is not None:
+            keyboard_stats["hits"] += 1
+            return markup
+
+    markup = build(today).to_json()
+    with keyboard_lock:
+        keyboard_stats["misses"] += 1
+        if calendar_keyboards_day == today:
+            calendar_keyboards[key] = markup
+    return markup
+
+def build_main_keyboard(admin):
     kb = ReplyKeyboardMarkup(resize_keyboard=True)
-    
-    if is_admin(chat_id):
+    kb.add("➕ Добавить напоминание", "📋 Список напоминаний")
+    kb.add("🎂 Добавить день рождения", "🎉 Сколько дней до ДР")
+    kb.add("⏱ Таймер", "❌ Удалить напоминание")
+    if admin:
         # Для админа - расширенное меню
-        kb.add("➕ Добавить напоминание", "📋 Список напоминаний")
-        kb.add("🎂 Добавить день рождения", "🎉 Сколько дней до ДР")
-        kb.add("⏱ Таймер", "❌ Удалить напоминание")
         kb.add("⚙️ Админ панель")
-    else:
-        # Для обычных пользователей
-        kb.add("➕ Добавить напоминание", "📋 Список напоминаний")
-        kb.add("🎂 Добавить день рождения", "🎉 Сколько дней до ДР")
-        kb.add("⏱ Таймер", "❌ Удалить напоминание")
-    
     return kb
 
-def admin_keyboard():
+def main_keyboard(chat_id):
+    admin = is_admin(chat_id)
+    return cached_keyboard(("main", admin), lambda: build_main_keyboard(admin))
+
+def build_admin_keyboard():
     kb = ReplyKeyboardMarkup(resize_keyboard=True)
     kb.add("📊 Статистика", "👥 Список пользователей")
     kb.add("🔨 Заблокировать", "🔓 Разблокировать")
     kb.add("🚫 Список блокировок", "📜 Логи действий")
     kb.add("📢 Рассылка", "📋 Команды")
+    kb.add("📈 Метрики", "⏱ Доставка")
     kb.add("◀️ Назад в меню")
     return kb
 
+def admin_keyboard():
+    return cached_keyboard("admin", build_admin_keyboard)
+
+# ============================================================
+# СБОРКА ДЛИННЫХ СООБЩЕНИЙ
+# ============================================================
+
+# Telegram ограничивает сообщение 4096 символами, считая в UTF-16
+# (эмодзи занимает два). Сообщение собирается из целых записей: запись,
+# которая не помещается, начинает следующее сообщение, поэтому разметка
+# (**жирный**, `код`) никогда не разрезается посередине.
+
+MESSAGE_LIMIT = 4096
+# Длиннее этого пользовательские поля обрезаются, чтобы одна запись
+# всегда помещалась в сообщение
+MAX_FIELD_LENGTH = 500
+
+MARKDOWN_SPECIAL = re.compile(r"([_*`\[])")
+
+def utf16_len(text):
+    return len(text.encode("utf-16-le")) // 2
+
+def escape_field(value):
+    # Имена, username и тексты пользователей могут содержать * и _,
+    # которые иначе ломают Markdown всего сообщения
+    text = str(value)
+    if len(text) > MAX_FIELD_LENGTH:
+        text = text[:MAX_FIELD_LENGTH] + "…"
+    return MARKDOWN_SPECIAL.sub(r"\\\1", text)
+
+class MessageBuilder:
+    def __init__(self, header="", limit=MESSAGE_LIMIT):
+        self.parts = [header]
+        self.size = utf16_len(header)
+        self.limit = limit
+        self.records = 0
+
+    def add(self, record):
+        # Возвращает False, если запись не помещается целиком
+        record_size = utf16_len(record)
+        if self.size + record_size > self.limit:
+            return False
+        self.parts.append(record)
+        self.size += record_size
+        self.records += 1
+        return True
+
+    def text(self):
+        return "".join(self.parts)
+
+# ============================================================
+# ПОСТРАНИЧНЫЕ СПИСКИ
+# ============================================================
+
+# Страницы выбираются по ключу (keyset), а не через OFFSET: кнопки
+# «◀️ / ▶️» несут в callback_data ключ первой или последней строки
+# текущей страницы, и следующая страница - это один поиск по индексу
+# от этого ключа, сколько бы строк ни было в таблице.
+# Ключ должен быть уникальным (последней колонкой обычно идет id)
+# и покрываться индексом в порядке сортировки.
+
+PAGE_SIZE = 10
+
+# имя списка -> Pager (имя попадает в callback_data)
+PAGERS = {}
+
+def encode_page_key(values):
+    return "_".join(str(value) for value in values)
+
+def decode_page_key(parts):
+    return [int(part) if part.lstrip("-").isdigit() else part for part in parts]
+
+class Pager:
+    def __init__(self, name, title, empty_text, table, columns, keys, format_row,
+                 where="", scoped=False, descending=False, admin_only=False):
+        self.name = name
+        self.title = title
+        self.empty_text = empty_text
+        self.table = table
+        self.columns = columns
+        self.keys = keys
+        self.format_row = format_row
+        # where - постоянное условие; при scoped=True в нем один параметр - chat_id
+        self.where = where
+        self.scoped = scoped
+        self.descending = descending
+        self.admin_only = admin_only
+        PAGERS[name] = self
+
+    def fetch(self, chat_id, cursor=None, backward=False):
+        conditions = [self.where] if self.where else []
+        params = [chat_id] if self.scoped else []
+
+        # Назад по списку - это вперед в обратном порядке
+        desc = self.descending != backward
+        if cursor is not None:
+            keys = ", ".join(self.keys)
+            marks = ", ".join("?" for _ in self.keys)
+            conditions.append(f"({keys}) {'<' if desc else '>'} ({marks})")
+            params.extend(cursor)
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        order = ", ".join(f"{key} {'DESC' if desc else 'ASC'}" for key in self.keys)
+
+        # Строки читаются по одной: render перестает читать,
+        # как только страница заполнилась
+        conn = get_db_connection()
+        yield from conn.execute(f"""
+            SELECT {self.columns}, {", ".join(self.keys)}
+            FROM {self.table} {where}
+            ORDER BY {order} LIMIT ?
+        """, params + [PAGE_SIZE + 1])
+        conn.close()
+
+    def render(self, chat_id, cursor=None, backward=False, page=1):
+        key_count = len(self.keys)
+        builder = MessageBuilder(f"{self.title} (стр. {page}):\n\n")
+        rows = []
+        more = False
+
+        # Страница заканчивается на PAGE_SIZE строках или раньше, если
+        # следующая запись не влезает в сообщение - тогда она откроет
+        # следующую страницу
+        for row in self.fetch(chat_id, cursor, backward):
+            if len(rows) == PAGE_SIZE or not builder.add(self.format_row(*row[:-key_count])):
+                more = True
+                break
+            rows.append(row)
+
+        if not rows:
+            return self.empty_text, None
+
+        text = builder.text()
+        if backward:
+            # Строки шли от ключа назад - переставляем записи в порядок списка
+            rows.reverse()
+            text = builder.parts[0] + "".join(reversed(builder.parts[1:]))
+
+        if backward:
+            has_prev, has_next = more, True
+        else:
+            has_prev, has_next = cursor is not None, more
+
+        buttons = []
+        if has_prev:
+            first_key = encode_page_key(rows[0][-key_count:])
+            buttons.append(InlineKeyboardButton(
+                "◀️", callback_data=f"page_{self.name}_p_{page - 1}_{first_key}"
+            ))
+        if has_next:
+            last_key = encode_page_key(rows[-1][-key_count:])
+            buttons.append(InlineKeyboardButton(
+                "▶️", callback_data=f"page_{self.name}_n_{page + 1}_{last_key}"
+            ))
+
+        kb = None
+        if buttons:
+            kb = InlineKeyboardMarkup()
+            kb.row(*buttons)
+        return text, kb
+
+    def send(self, chat_id):
+        text, kb = self.render(chat_id)
+        return send_message(chat_id, text, parse_mode="Markdown", reply_markup=kb)
+
+def process_page(call):
+    # page_<список>_<n|p>_<номер страницы>_<ключ...>
+    parts = call.data.split("_")
+    pager = PAGERS.get(parts[1])
+    chat_id = call.message.chat.id
+
+    if pager is None or (pager.admin_only and not is_admin(chat_id)):
+        answer_callback_query(call.id, "🚫 Доступ запрещен")
+        return
+
+    text, kb = pager.render(
+        chat_id,
+        cursor=decode_page_key(parts[4:]),
+        backward=parts[2] == "p",
+        page=int(parts[3])
+    )
+    edit_message_text(text, chat_id, call.message.message_id, parse_mode="Markdown", reply_markup=kb)
+    answer_callback_query(call.id)
+
 # ============================================================
 # СОГЛАШЕНИЕ
 # ============================================================
 
-def agreement_keyboard():
+def build_agreement_keyboard():
     kb = InlineKeyboardMarkup()
     kb.add(InlineKeyboardButton("✅ Принимаю", callback_data="accept_agreement"))
     return kb
 
+def agreement_keyboard():
+    return cached_keyboard("agreement", build_agreement_keyboard)
+
+# Сколько секунд ждать принятия соглашения
+AGREEMENT_TIMEOUT = 60
+
+# chat_id -> отложенная задача, которая уберет кнопку «Принимаю»
+agreement_tasks = {}
+
+def schedule_agreement_timeout(chat_id, message_id):
+    previous = agreement_tasks.pop(chat_id, None)
+    if previous is not None:
+        previous.cancel()
+    agreement_tasks[chat_id] = schedule_in(
+        AGREEMENT_TIMEOUT, remove_agreement_if_not_accepted, chat_id, message_id
+    )
+
+def cancel_agreement_timeout(chat_id):
+    task = agreement_tasks.pop(chat_id, None)
+    if task is not None:
+        task.cancel()
+
 def remove_agreement_if_not_accepted(chat_id, message_id):
-    time.sleep(60)
+    agreement_tasks.pop(chat_id, None)
     if not is_accepted(chat_id):
-        try:
-            bot.edit_message_reply_markup(chat_id, message_id, reply_markup=None)
-            bot.send_message(chat_id, "⏳ Время истекло. Введите /start")
-        except:
-            pass
+        edit_message_reply_markup(chat_id, message_id, reply_markup=None)
+        send_message(chat_id, "⏳ Время истекло. Введите /start")
 
 @bot.message_handler(commands=["start"])
+@timed
 def start(message):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
         # Сохраняем информацию о пользователе
-        cursor.execute("""
+        saved = submit_write("""
             INSERT INTO users(chat_id, username, first_name, last_name, registered_date, accepted)
             VALUES (?, ?, ?, ?, ?, 0)
             ON CONFLICT(chat_id) DO UPDATE SET 
@@ -320,10 +2198,8 @@ def start(message):
             message.from_user.username,
             message.from_user.first_name,
             message.from_user.last_name,
-            datetime.now(TZ).isoformat()
+            now_epoch()
         ))
-        conn.commit()
-        conn.close()
 
         text = (
             "📜 Пользовательское соглашение\n\n"
@@ -332,22 +2208,31 @@ def start(message):
             "Нажмите «Принимаю»."
         )
 
-        msg = bot.send_message(message.chat.id, text, reply_markup=agreement_keyboard())
+        def start_agreement_timeout(future):
+            if future.exception() is None:
+                schedule_agreement_timeout(message.chat.id, future.result().message_id)
+
+        def send_agreement(saved):
+            if saved.exception() is not None:
+                send_message(message.chat.id, "❌ Произошла ошибка. Попробуйте позже.")
+                return
+            # Соглашение показываем только после записи пользователя в базу,
+            # иначе «Принимаю» может прийти раньше, чем появится строка
+            future = send_message(message.chat.id, text, reply_markup=agreement_keyboard())
+            # Таймаут запускается, когда сообщение действительно отправлено
+            future.add_done_callback(start_agreement_timeout)
 
-        threading.Thread(
-            target=remove_agreement_if_not_accepted,
-            args=(message.chat.id, msg.message_id),
-            daemon=True
-        ).start()
+        saved.add_done_callback(send_agreement)
     except Exception as e:
         print(f"Error in start: {e}")
-        bot.send_message(message.chat.id, "❌ Произошла ошибка. Попробуйте позже.")
+        send_message(message.chat.id, "❌ Произошла ошибка. Попробуйте позже.")
 
 # ============================================================
 # ОБРАБОТЧИКИ CALLBACK
 # ============================================================
 
 @bot.callback_query_handler(func=lambda call: True)
+@timed
 @check_access
 def callback_handler(call):
     try:
@@ -355,27 +2240,28 @@ def callback_handler(call):
         print(f"Callback received: {call.data} from {chat_id}")
 
         if call.data == "accept_agreement":
+            cancel_agreement_timeout(chat_id)
             set_accepted(chat_id)
-            bot.edit_message_text(
+            edit_message_text(
                 "✅ Соглашение принято!\n\nТеперь можно пользоваться ботом.",
                 chat_id,
                 call.message.message_id
             )
-            bot.send_message(chat_id, "📌 Главное меню:", reply_markup=main_keyboard(chat_id))
-            bot.answer_callback_query(call.id)
+            send_message(chat_id, "📌 Главное меню:", reply_markup=main_keyboard(chat_id))
+            answer_callback_query(call.id)
             return
 
         if call.data == "ignore":
-            bot.answer_callback_query(call.id)
+            answer_callback_query(call.id)
             return
 
         if call.data == "cancel":
-            bot.edit_message_text(
+            edit_message_text(
                 "❌ Действие отменено",
                 chat_id,
                 call.message.message_id
             )
-            bot.answer_callback_query(call.id)
+            answer_callback_query(call.id)
             return
 
         if call.data.startswith("year_"):
@@ -388,13 +2274,17 @@ def callback_handler(call):
             process_ban_duration(call)
         elif call.data.startswith("broadcast_"):
             process_broadcast_confirm(call)
+        elif call.data.startswith("page_"):
+            process_page(call)
+        elif call.data.startswith("bjob_"):
+            process_broadcast_control(call)
         else:
-            bot.answer_callback_query(call.id)
+            answer_callback_query(call.id)
             
     except Exception as e:
         print(f"Error in callback_handler: {e}")
         try:
-            bot.answer_callback_query(call.id, "❌ Произошла ошибка", show_alert=True)
+            answer_callback_query(call.id, "❌ Произошла ошибка", show_alert=True)
         except:
             pass
 
@@ -402,20 +2292,23 @@ def callback_handler(call):
 # КАЛЕНДАРЬ
 # ============================================================
 
-def year_keyboard():
+MONTH_NAMES = ["Янв", "Фев", "Мар", "Апр", "Май", "Июн", "Июл", "Авг", "Сен", "Окт", "Ноя", "Дек"]
+
+def build_year_keyboard(today):
     kb = InlineKeyboardMarkup()
-    current_year = datetime.now(TZ).year
-    for y in range(current_year, current_year + 5):
+    for y in range(today.year, today.year + 5):
         kb.add(InlineKeyboardButton(str(y), callback_data=f"year_{y}"))
     kb.add(InlineKeyboardButton("❌ Отмена", callback_data="cancel"))
     return kb
 
-def month_keyboard(year):
+def year_keyboard():
+    return cached_calendar_keyboard("year", None, None, build_year_keyboard)
+
+def build_month_keyboard(year):
     kb = InlineKeyboardMarkup()
-    months = ["Янв", "Фев", "Мар", "Апр", "Май", "Июн", "Июл", "Авг", "Сен", "Окт", "Ноя", "Дек"]
 
     row = []
-    for i, m in enumerate(months, start=1):
+    for i, m in enumerate(MONTH_NAMES, start=1):
         row.append(InlineKeyboardButton(m, callback_data=f"month_{year}_{i}"))
         if len(row) == 3:
             kb.row(*row)
@@ -427,46 +2320,54 @@ def month_keyboard(year):
     kb.add(InlineKeyboardButton("❌ Отмена", callback_data="cancel"))
     return kb
 
-def day_keyboard(year, month):
+def month_keyboard(year):
+    return cached_calendar_keyboard("month", year, None, lambda today: build_month_keyboard(year))
+
+def build_day_keyboard(year, month, today):
     kb = InlineKeyboardMarkup(row_width=7)
-    today = datetime.now(TZ).date()
-    
-    # Определяем количество дней в месяце
-    if month == 12:
-        days_in_month = (date(year + 1, 1, 1) - date(year, month, 1)).days
+    days_in_month = calendar.monthrange(year, month)[1]
+
+    # Первый день месяца, который еще не прошел
+    if (year, month) < (today.year, today.month):
+        first_active = days_in_month + 1
+    elif (year, month) == (today.year, today.month):
+        first_active = today.day
     else:
-        days_in_month = (date(year, month + 1, 1) - date(year, month, 1)).days
+        first_active = 1
 
     buttons = []
     for day in range(1, days_in_month + 1):
-        current_date = date(year, month, day)
-        
-        if current_date < today:
+        if day < first_active:
             # Прошедшие дни - неактивные кнопки
             buttons.append(InlineKeyboardButton("❌", callback_data="ignore"))
         else:
             # Будущие дни - активные
             buttons.append(InlineKeyboardButton(str(day), callback_data=f"day_{year}_{month}_{day}"))
-    
+
     # Добавляем кнопки в клавиатуру
     kb.add(*buttons)
     kb.add(InlineKeyboardButton("❌ Отмена", callback_data="cancel"))
-    
+
     return kb
 
+def day_keyboard(year, month):
+    return cached_calendar_keyboard(
+        "day", year, month, lambda today: build_day_keyboard(year, month, today)
+    )
+
 def choose_year(call):
     try:
         year = int(call.data.split("_")[1])
-        bot.edit_message_text(
+        edit_message_text(
             "📅 Выберите месяц:",
             call.message.chat.id,
             call.message.message_id,
             reply_markup=month_keyboard(year)
         )
-        bot.answer_callback_query(call.id)
+        answer_callback_query(call.id)
     except Exception as e:
         print(f"Error in choose_year: {e}")
-        bot.answer_callback_query(call.id, "❌ Ошибка", show_alert=True)
+        answer_callback_query(call.id, "❌ Ошибка", show_alert=True)
 
 def choose_month(call):
     try:
@@ -474,16 +2375,16 @@ def choose_month(call):
         year = int(parts[1])
         month = int(parts[2])
         
-        bot.edit_message_text(
+        edit_message_text(
             f"📅 Выберите день:",
             call.message.chat.id,
             call.message.message_id,
             reply_markup=day_keyboard(year, month)
         )
-        bot.answer_callback_query(call.id)
+        answer_callback_query(call.id)
     except Exception as e:
         print(f"Error in choose_month: {e}")
-        bot.answer_callback_query(call.id, "❌ Ошибка", show_alert=True)
+        answer_callback_query(call.id, "❌ Ошибка", show_alert=True)
 
 def choose_day(call):
     try:
@@ -493,16 +2394,16 @@ def choose_day(call):
         day = int(parts[3])
 
         selected = date(year, month, day)
-        today = datetime.now(TZ).date()
+        today = clock.now().date()
 
         if selected < today:
-            bot.answer_callback_query(call.id, "❌ Нельзя выбрать прошедшую дату!", show_alert=True)
+            answer_callback_query(call.id, "❌ Нельзя выбрать прошедшую дату!", show_alert=True)
             return
 
         # Сохраняем дату в temp_data для следующего шага
         temp_data[f"selected_date_{call.message.chat.id}"] = selected
         
-        bot.edit_message_text(
+        edit_message_text(
             f"✅ Вы выбрали дату: {selected.strftime('%d.%m.%Y')}\n\nТеперь введите текст напоминания:",
             call.message.chat.id,
             call.message.message_id
@@ -511,197 +2412,281 @@ def choose_day(call):
         # Устанавливаем состояние для ожидания текста напоминания
         user_state[call.message.chat.id] = "waiting_reminder_text"
         
-        bot.answer_callback_query(call.id)
+        answer_callback_query(call.id)
         
     except Exception as e:
         print(f"Error in choose_day: {e}")
-        bot.answer_callback_query(call.id, "❌ Ошибка при выборе даты", show_alert=True)
+        answer_callback_query(call.id, "❌ Ошибка при выборе даты", show_alert=True)
 
 # ============================================================
 # ОБРАБОТЧИК ТЕКСТА НАПОМИНАНИЯ
 # ============================================================
 
-@bot.message_handler(func=lambda m: user_state.get(m.chat.id) == "waiting_reminder_text")
+@state_route("waiting_reminder_text")
 @check_access
 def process_reminder_text(message):
     try:
         selected_date = temp_data.pop(f"selected_date_{message.chat.id}", None)
         
         if not selected_date:
-            bot.send_message(message.chat.id, "❌ Ошибка: дата не найдена. Начните заново.")
+            send_message(message.chat.id, "❌ Ошибка: дата не найдена. Начните заново.")
             user_state.pop(message.chat.id, None)
             return
         
         reminder_text = message.text
         
         # Сохраняем напоминание в базу данных
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        remind_time = datetime.combine(selected_date, datetime.min.time()).isoformat()
-        cursor.execute("""
-            INSERT INTO reminders (chat_id, text, remind_time, category, repeat_type, notify_before, done)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (message.chat.id, reminder_text, remind_time, "Без категории", "none", 0, 0))
-        conn.commit()
-        conn.close()
-        
-        bot.send_message(
-            message.chat.id, 
-            f"✅ Напоминание сохранено!\n\n"
-            f"📅 Дата: {selected_date.strftime('%d.%m.%Y')}\n"
-            f"📝 Текст: {reminder_text}"
-        )
-        
+        remind_time = to_epoch(datetime.combine(selected_date, datetime.min.time()))
+        saved = submit_write("""
+            INSERT INTO reminders (chat_id, text, remind_time, category, repeat_type, notify_before, done, notify_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (message.chat.id, reminder_text, remind_time, "Без категории", "none", 0, 0, remind_time))
         user_state.pop(message.chat.id, None)
+
+        def confirm(saved):
+            if saved.exception() is not None:
+                send_message(message.chat.id, "❌ Произошла ошибка. Попробуйте снова.")
+                return
+            send_message(
+                message.chat.id,
+                f"✅ Напоминание сохранено!\n\n"
+                f"📅 Дата: {selected_date.strftime('%d.%m.%Y')}\n"
+                f"📝 Текст: {reminder_text}"
+            )
+
+        # Подтверждаем, когда строка действительно закоммичена
+        saved.add_done_callback(confirm)
         
     except Exception as e:
         print(f"Error in process_reminder_text: {e}")
-        bot.send_message(message.chat.id, "❌ Произошла ошибка. Попробуйте снова.")
+        send_message(message.chat.id, "❌ Произошла ошибка. Попробуйте снова.")
         user_state.pop(message.chat.id, None)
 
 # ============================================================
 # АДМИН ПАНЕЛЬ
 # ============================================================
 
-@bot.message_handler(func=lambda m: m.text == "⚙️ Админ панель")
+@text_route("⚙️ Админ панель")
 @check_access
 def admin_panel(message):
     if not is_admin(message.chat.id):
-        bot.send_message(message.chat.id, "🚫 Доступ запрещен")
+        send_message(message.chat.id, "🚫 Доступ запрещен")
         return
     
-    bot.send_message(
+    send_message(
         message.chat.id,
         "⚙️ Административная панель\n\n"
         "Выберите действие:",
         reply_markup=admin_keyboard()
     )
 
-@bot.message_handler(func=lambda m: m.text == "◀️ Назад в меню")
+@text_route("◀️ Назад в меню")
 @check_access
 def back_to_menu(message):
-    bot.send_message(
+    send_message(
         message.chat.id,
         "📌 Главное меню:",
         reply_markup=main_keyboard(message.chat.id)
     )
 
 # Статистика
-@bot.message_handler(func=lambda m: m.text == "📊 Статистика")
+@text_route("📊 Статистика")
 @check_access
 def show_statistics(message):
     if not is_admin(message.chat.id):
         return
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT COUNT(*) FROM users")
-        total_users = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM users WHERE accepted = 1")
-        accepted_users = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM bans")
-        banned_users = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM reminders")
-        total_reminders = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM birthdays")
-        total_birthdays = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM timers")
-        total_timers = cursor.fetchone()[0]
-        
-        conn.close()
+        # Готовые счетчики вместо COUNT(*) по таблицам
+        totals, days = read_counters()
+
+        def added(name):
+            today_count, week_count = days.get(name, (0, 0))
+            return f"(сегодня +{today_count}, за неделю +{week_count})"
+
+        hot_routes = sorted(route_hits.items(), key=lambda item: item[1], reverse=True)[:5]
+        # Имена обработчиков содержат "_", а сообщение уходит в Markdown
+        top_routes = ", ".join(
+            f"{escape_field(name)} ({count})" for name, count in hot_routes
+        ) or "нет данных"
         
         stats_text = (
             f"📊 **Статистика бота**\n\n"
             f"👥 **Пользователи:**\n"
-            f"• Всего: {total_users}\n"
-            f"• Активных: {accepted_users}\n"
-            f"• Заблокировано: {banned_users}\n\n"
-            f"📌 **Напоминания:** {total_reminders}\n"
-            f"🎂 **Дни рождения:** {total_birthdays}\n"
-            f"⏱ **Таймеры:** {total_timers}"
+            f"• Всего: {totals.get('users', 0)} {added('users')}\n"
+            f"• Активных: {totals.get('users_accepted', 0)}\n"
+            f"• Заблокировано: {totals.get('bans', 0)}\n\n"
+            f"📌 **Напоминания:** {totals.get('reminders', 0)} {added('reminders')}\n"
+            f"🎂 **Дни рождения:** {totals.get('birthdays', 0)} {added('birthdays')}\n"
+            f"⏱ **Таймеры:** {totals.get('timers', 0)} {added('timers')}\n\n"
+            f"🗄 **Кэш доступа:** {access_hit_ratio():.1%} попаданий "
+            f"({access_stats['hits']}/{access_stats['hits'] + access_stats['misses']})\n"
+            f"📤 **Очередь отправки:** {outbox_depth()} "
+            f"(отправлено {outbox_stats['sent']}, повторов {outbox_stats['retried']}, "
+            f"ошибок {outbox_stats['failed']})\n"
+            f"⌨️ **Кэш клавиатур:** {keyboard_stats['hits']} попаданий, "
+            f"{keyboard_stats['misses']} построений\n"
+            f"🧵 **Очереди обработки:** {sum(update_queue_depths())}\n"
+            f"⏰ **Отложенные задачи:** {pending_tasks()}\n"
+            f"🔥 **Частые маршруты:** {top_routes}"
         )
         
-        bot.send_message(message.chat.id, stats_text, parse_mode="Markdown")
+        send_message(message.chat.id, stats_text, parse_mode="Markdown")
     except Exception as e:
         print(f"Error in show_statistics: {e}")
-        bot.send_message(message.chat.id, "❌ Ошибка при получении статистики")
+        send_message(message.chat.id, "❌ Ошибка при получении статистики")
 
-# Список пользователей
-@bot.message_handler(func=lambda m: m.text == "👥 Список пользователей")
+# Метрики
+def format_seconds(seconds):
+    if seconds == float("inf"):
+        return f">{METRICS_BUCKETS[-1]:g} с"
+    return f"{seconds * 1000:g} мс"
+
+@text_route("📈 Метрики")
 @check_access
-def list_users(message):
+def show_metrics(message):
     if not is_admin(message.chat.id):
         return
-    
+
+    try:
+        if not METRICS_ENABLED:
+            send_message(message.chat.id, "📈 Метрики выключены (METRICS_ENABLED = False)")
+            return
+
+        snapshot = metrics_snapshot()
+        if not snapshot:
+            send_message(message.chat.id, "📭 Замеров пока нет")
+            return
+
+        builder = MessageBuilder("📈 Метрики (вызовов, p50, p99, ошибок):\n\n")
+        # Сначала самые нагруженные места по суммарному времени
+        rows = sorted(snapshot.items(), key=lambda item: item[1][1], reverse=True)
+        for name, (_, total, count, errors, p50, p99) in rows:
+            line = f"{name}: {count}, ≤{format_seconds(p50)}, ≤{format_seconds(p99)}"
+            if errors:
+                line += f", ❗{errors}"
+            if not builder.add(line + "\n"):
+                break
+
+        send_message(message.chat.id, builder.text())
+    except Exception as e:
+        print(f"Error in show_metrics: {e}")
+        send_message(message.chat.id, "❌ Ошибка при получении метрик")
+
+# Своевременность уведомлений
+LATENESS_VIEW_HOURS = 24
+
+def format_lateness_line(title, histogram, retries):
+    line = f"{title}: {histogram.count}"
+    if histogram.count:
+        line += f", ≤{format_lateness(histogram.percentile(0.5))}, ≤{format_lateness(histogram.percentile(0.99))}"
+    if histogram.errors or retries:
+        line += f", ❗{histogram.errors}/{retries}"
+    return line + "\n"
+
+@text_route("⏱ Доставка")
+@check_access
+def show_lateness(message):
+    if not is_admin(message.chat.id):
+        return
+
     try:
         conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT chat_id, username, first_name, last_name, accepted, registered_date 
-            FROM users ORDER BY registered_date DESC LIMIT 20
-        """)
-        users = cursor.fetchall()
+        # Свежие доставки еще не записаны checker - дописываем их сейчас
+        flush_lateness(conn)
+        conn.commit()
+        hour = int(clock.time()) // 3600 * 3600
+        rows = read_lateness(conn, hour - (LATENESS_VIEW_HOURS - 1) * 3600)
         conn.close()
-        
-        if not users:
-            bot.send_message(message.chat.id, "📭 Нет пользователей")
+
+        if not rows:
+            send_message(message.chat.id, "📭 Уведомлений по расписанию пока не было")
             return
-        
-        text = "👥 **Последние 20 пользователей:**\n\n"
-        
-        for user in users:
-            user_id, username, first_name, last_name, accepted, reg_date = user
-            
-            reg_datetime = datetime.fromisoformat(reg_date) if reg_date else datetime.now(TZ)
-            reg_str = reg_datetime.strftime("%d.%m.%Y %H:%M")
-            
-            name_parts = []
-            if first_name:
-                name_parts.append(first_name)
-            if last_name:
-                name_parts.append(last_name)
-            full_name = " ".join(name_parts) if name_parts else "Нет имени"
-            
-            status = "✅" if accepted else "⏳"
-            username_str = f"@{username}" if username else "нет username"
-            
-            text += (
-                f"{status} **ID:** `{user_id}`\n"
-                f"   • Имя: {full_name}\n"
-                f"   • Username: {username_str}\n"
-                f"   • Зарегистрирован: {reg_str}\n\n"
-            )
-        
-        if len(text) > 4000:
-            for i in range(0, len(text), 4000):
-                bot.send_message(message.chat.id, text[i:i+4000], parse_mode="Markdown")
-        else:
-            bot.send_message(message.chat.id, text, parse_mode="Markdown")
+
+        builder = MessageBuilder(
+            f"⏱ Опоздание уведомлений (доставлено, p50, p99, ❗ошибок/повторов), "
+            f"норма p99 ≤{format_lateness(SLO_LATENESS_P99)}\n\n"
+        )
+        for title, since in (("За текущий час", hour), (f"За {LATENESS_VIEW_HOURS} ч", 0)):
+            builder.add(f"{title}:\n")
+            for kind, name in LATENESS_KINDS.items():
+                histogram, retries = merge_lateness(
+                    value for (k, h), value in rows.items() if k == kind and h >= since
+                )
+                builder.add(format_lateness_line(name, histogram, retries))
+            builder.add("\n")
+
+        builder.add("По часам:\n")
+        # Сначала последние часы
+        for (kind, start), (histogram, retries) in sorted(rows.items(), key=lambda item: (-item[0][1], item[0][0])):
+            title = f"{from_epoch(start).strftime('%H:00')} {LATENESS_KINDS.get(kind, kind)}"
+            if not builder.add(format_lateness_line(title, histogram, retries)):
+                break
+
+        send_message(message.chat.id, builder.text())
+    except Exception as e:
+        print(f"Error in show_lateness: {e}")
+        send_message(message.chat.id, "❌ Ошибка при получении данных о доставке")
+
+# Список пользователей
+def format_user(user_id, username, first_name, last_name, accepted, reg_date):
+    reg_datetime = from_epoch(reg_date) if reg_date else clock.now()
+    reg_str = reg_datetime.strftime("%d.%m.%Y %H:%M")
+
+    name_parts = []
+    if first_name:
+        name_parts.append(first_name)
+    if last_name:
+        name_parts.append(last_name)
+    full_name = escape_field(" ".join(name_parts)) if name_parts else "Нет имени"
+
+    status = "✅" if accepted else "⏳"
+    username_str = f"@{escape_field(username)}" if username else "нет username"
+
+    return (
+        f"{status} **ID:** `{user_id}`\n"
+        f"   • Имя: {full_name}\n"
+        f"   • Username: {username_str}\n"
+        f"   • Зарегистрирован: {reg_str}\n\n"
+    )
+
+# Новые сверху; индекс idx_users_registered хранит и chat_id (rowid)
+users_pager = Pager(
+    "u", "👥 **Пользователи**", "📭 Нет пользователей",
+    table="users",
+    columns="chat_id, username, first_name, last_name, accepted, registered_date",
+    keys=["registered_date", "chat_id"],
+    format_row=format_user,
+    descending=True,
+    admin_only=True
+)
+
+@text_route("👥 Список пользователей")
+@check_access
+def list_users(message):
+    if not is_admin(message.chat.id):
+        return
+    
+    try:
+        users_pager.send(message.chat.id)
     except Exception as e:
         print(f"Error in list_users: {e}")
-        bot.send_message(message.chat.id, "❌ Ошибка при получении списка пользователей")
+        send_message(message.chat.id, "❌ Ошибка при получении списка пользователей")
 
 # Заблокировать
-@bot.message_handler(func=lambda m: m.text == "🔨 Заблокировать")
+@text_route("🔨 Заблокировать")
 @check_access
 def ban_user_start(message):
     if not is_admin(message.chat.id):
         return
     
-    bot.send_message(
+    send_message(
         message.chat.id,
         "🔨 Введите ID пользователя для блокировки:"
     )
     user_state[message.chat.id] = "waiting_ban_id"
 
-@bot.message_handler(func=lambda m: user_state.get(m.chat.id) == "waiting_ban_id")
+@state_route("waiting_ban_id")
 @check_access
 def process_ban_id(message):
     if not is_admin(message.chat.id):
@@ -718,7 +2703,7 @@ def process_ban_id(message):
         conn.close()
         
         if not user_exists:
-            bot.send_message(message.chat.id, f"❌ Пользователь {user_id} не найден в базе")
+            send_message(message.chat.id, f"❌ Пользователь {user_id} не найден в базе")
             user_state.pop(message.chat.id, None)
             return
         
@@ -739,7 +2724,7 @@ def process_ban_id(message):
             InlineKeyboardButton("❌ Отмена", callback_data="cancel")
         )
         
-        bot.send_message(
+        send_message(
             message.chat.id,
             f"Выберите срок блокировки для пользователя `{user_id}`:",
             reply_markup=kb,
@@ -749,16 +2734,16 @@ def process_ban_id(message):
         user_state.pop(message.chat.id, None)
         
     except ValueError:
-        bot.send_message(message.chat.id, "❌ Некорректный ID")
+        send_message(message.chat.id, "❌ Некорректный ID")
         user_state.pop(message.chat.id, None)
     except Exception as e:
         print(f"Error in process_ban_id: {e}")
-        bot.send_message(message.chat.id, "❌ Ошибка при обработке")
+        send_message(message.chat.id, "❌ Ошибка при обработке")
         user_state.pop(message.chat.id, None)
 
 def process_ban_duration(call):
     if not is_admin(call.message.chat.id):
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен", show_alert=True)
+        answer_callback_query(call.id, "🚫 Доступ запрещен", show_alert=True)
         return
     
     try:
@@ -767,7 +2752,7 @@ def process_ban_duration(call):
         user_id = int(parts[3])
         
         if duration_type == "permanent":
-            until = "permanent"
+            until = None
             duration_text = "навсегда"
         else:
             number = int(duration_type[:-1])
@@ -780,11 +2765,10 @@ def process_ban_duration(call):
                 delta = timedelta(days=number)
                 duration_text = f"{number} день(дней)"
             else:
-                bot.answer_callback_query(call.id, "❌ Неверный формат", show_alert=True)
+                answer_callback_query(call.id, "❌ Неверный формат", show_alert=True)
                 return
             
-            until_dt = datetime.now(TZ) + delta
-            until = until_dt.isoformat()
+            until = now_epoch() + int(delta.total_seconds())
         
         # Сохраняем данные для следующего шага
         temp_data[f"ban_final_{call.message.chat.id}"] = {
@@ -793,20 +2777,20 @@ def process_ban_duration(call):
             "duration_text": duration_text
         }
         
-        bot.send_message(
+        send_message(
             call.message.chat.id,
             f"📝 Введите причину блокировки пользователя `{user_id}`:",
             parse_mode="Markdown"
         )
         
         user_state[call.message.chat.id] = "waiting_ban_reason"
-        bot.answer_callback_query(call.id)
+        answer_callback_query(call.id)
         
     except Exception as e:
         print(f"Error in process_ban_duration: {e}")
-        bot.answer_callback_query(call.id, "❌ Ошибка", show_alert=True)
+        answer_callback_query(call.id, "❌ Ошибка", show_alert=True)
 
-@bot.message_handler(func=lambda m: user_state.get(m.chat.id) == "waiting_ban_reason")
+@state_route("waiting_ban_reason")
 def process_ban_reason(message):
     if not is_admin(message.chat.id):
         return
@@ -814,7 +2798,7 @@ def process_ban_reason(message):
     try:
         ban_data = temp_data.pop(f"ban_final_{message.chat.id}", None)
         if not ban_data:
-            bot.send_message(message.chat.id, "❌ Ошибка: данные не найдены")
+            send_message(message.chat.id, "❌ Ошибка: данные не найдены")
             user_state.pop(message.chat.id, None)
             return
         
@@ -832,6 +2816,7 @@ def process_ban_reason(message):
         """, (user_id, until, reason, until, reason))
         conn.commit()
         conn.close()
+        cache_ban(user_id, until)
         
         # Логируем действие
         log_admin_action(
@@ -844,20 +2829,19 @@ def process_ban_reason(message):
         # Уведомляем пользователя
         try:
             ban_text = f"🚫 Вы заблокированы в боте"
-            if until != "permanent":
-                until_dt = datetime.fromisoformat(until)
-                ban_text += f" до {until_dt.strftime('%d.%m.%Y %H:%M')}"
+            if until is not None:
+                ban_text += f" до {from_epoch(until).strftime('%d.%m.%Y %H:%M')}"
             else:
                 ban_text += " навсегда"
             
             if reason:
                 ban_text += f"\nПричина: {reason}"
             
-            bot.send_message(user_id, ban_text)
+            send_message(user_id, ban_text)
         except:
             pass
         
-        bot.send_message(
+        send_message(
             message.chat.id,
             f"✅ Пользователь {user_id} заблокирован {duration_text}\nПричина: {reason}"
         )
@@ -866,23 +2850,23 @@ def process_ban_reason(message):
         
     except Exception as e:
         print(f"Error in process_ban_reason: {e}")
-        bot.send_message(message.chat.id, "❌ Ошибка при блокировке")
+        send_message(message.chat.id, "❌ Ошибка при блокировке")
         user_state.pop(message.chat.id, None)
 
 # Разблокировать
-@bot.message_handler(func=lambda m: m.text == "🔓 Разблокировать")
+@text_route("🔓 Разблокировать")
 @check_access
 def unban_user_start(message):
     if not is_admin(message.chat.id):
         return
     
-    bot.send_message(
+    send_message(
         message.chat.id,
         "🔓 Введите ID пользователя для разблокировки:"
     )
     user_state[message.chat.id] = "waiting_unban_id"
 
-@bot.message_handler(func=lambda m: user_state.get(m.chat.id) == "waiting_unban_id")
+@state_route("waiting_unban_id")
 def process_unban(message):
     if not is_admin(message.chat.id):
         return
@@ -896,142 +2880,117 @@ def process_unban(message):
         conn.commit()
         deleted = cursor.rowcount
         conn.close()
+        cache_unban(user_id)
         
         if deleted > 0:
             log_admin_action(message.chat.id, "unban", user_id)
-            bot.send_message(message.chat.id, f"✅ Пользователь {user_id} разблокирован")
+            send_message(message.chat.id, f"✅ Пользователь {user_id} разблокирован")
             
             # Уведомляем пользователя
-            try:
-                bot.send_message(user_id, "🔓 Вы разблокированы в боте")
-            except:
-                pass
+            send_message(user_id, "🔓 Вы разблокированы в боте")
         else:
-            bot.send_message(message.chat.id, f"❌ Пользователь {user_id} не найден в списке заблокированных")
+            send_message(message.chat.id, f"❌ Пользователь {user_id} не найден в списке заблокированных")
     
     except ValueError:
-        bot.send_message(message.chat.id, "❌ Некорректный ID")
+        send_message(message.chat.id, "❌ Некорректный ID")
     except Exception as e:
         print(f"Error in process_unban: {e}")
-        bot.send_message(message.chat.id, "❌ Ошибка при разблокировке")
+        send_message(message.chat.id, "❌ Ошибка при разблокировке")
     
     user_state.pop(message.chat.id, None)
 
 # Список блокировок
-@bot.message_handler(func=lambda m: m.text == "🚫 Список блокировок")
+def format_ban(user_id, until, reason, username, first_name):
+    name = escape_field(first_name) if first_name else "Нет имени"
+    username_str = f" (@{escape_field(username)})" if username else ""
+
+    if until is None:
+        until_text = "НАВСЕГДА"
+    else:
+        until_text = from_epoch(until).strftime('%d.%m.%Y %H:%M')
+
+    reason_text = f"\n   • Причина: {escape_field(reason)}" if reason else ""
+
+    return (
+        f"• **ID:** `{user_id}`{username_str}\n"
+        f"  Имя: {name}\n"
+        f"  До: {until_text}{reason_text}\n\n"
+    )
+
+bans_pager = Pager(
+    "b", "🚫 **Список заблокированных**", "✅ Заблокированных пользователей нет",
+    table="bans LEFT JOIN users ON bans.chat_id = users.chat_id",
+    columns="bans.chat_id, bans.until, bans.reason, users.username, users.first_name",
+    keys=["bans.chat_id"],
+    format_row=format_ban,
+    admin_only=True
+)
+
+@text_route("🚫 Список блокировок")
 @check_access
 def list_bans(message):
     if not is_admin(message.chat.id):
         return
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT bans.chat_id, bans.until, bans.reason, users.username, users.first_name 
-            FROM bans 
-            LEFT JOIN users ON bans.chat_id = users.chat_id
-        """)
-        rows = cursor.fetchall()
-        conn.close()
-        
-        if not rows:
-            bot.send_message(message.chat.id, "✅ Заблокированных пользователей нет")
-            return
-        
-        text = "🚫 **Список заблокированных:**\n\n"
-        
-        for user_id, until, reason, username, first_name in rows:
-            name = first_name if first_name else "Нет имени"
-            username_str = f" (@{username})" if username else ""
-            
-            if until == "permanent":
-                until_text = "НАВСЕГДА"
-            else:
-                until_dt = datetime.fromisoformat(until)
-                until_text = until_dt.strftime('%d.%m.%Y %H:%M')
-            
-            reason_text = f"\n   • Причина: {reason}" if reason else ""
-            
-            text += (
-                f"• **ID:** `{user_id}`{username_str}\n"
-                f"  Имя: {name}\n"
-                f"  До: {until_text}{reason_text}\n\n"
-            )
-        
-        if len(text) > 4000:
-            for i in range(0, len(text), 4000):
-                bot.send_message(message.chat.id, text[i:i+4000], parse_mode="Markdown")
-        else:
-            bot.send_message(message.chat.id, text, parse_mode="Markdown")
-            
+        bans_pager.send(message.chat.id)
     except Exception as e:
         print(f"Error in list_bans: {e}")
-        bot.send_message(message.chat.id, "❌ Ошибка при получении списка блокировок")
+        send_message(message.chat.id, "❌ Ошибка при получении списка блокировок")
 
 # Логи действий
-@bot.message_handler(func=lambda m: m.text == "📜 Логи действий")
+def format_log(admin_id, action, target_id, details, timestamp):
+    ts = from_epoch(timestamp).strftime("%d.%m.%Y %H:%M")
+
+    action_emoji = {
+        "ban": "🔨",
+        "unban": "🔓",
+        "broadcast": "📢",
+        "warning": "⚠️"
+    }.get(action, "📌")
+
+    target_text = f" над `{target_id}`" if target_id else ""
+    details_text = f"\n   • {escape_field(details)}" if details else ""
+
+    return f"{action_emoji} [{ts}] {escape_field(action.upper())}{target_text}{details_text}\n\n"
+
+# Новые сверху; индекс idx_admin_logs_timestamp хранит и id (rowid)
+logs_pager = Pager(
+    "l", "📜 **Действия администраторов**", "📭 Логов пока нет",
+    table="admin_logs",
+    columns="admin_id, action, target_id, details, timestamp",
+    keys=["timestamp", "id"],
+    format_row=format_log,
+    descending=True,
+    admin_only=True
+)
+
+@text_route("📜 Логи действий")
 @check_access
 def show_logs(message):
     if not is_admin(message.chat.id):
         return
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT admin_id, action, target_id, details, timestamp 
-            FROM admin_logs 
-            ORDER BY timestamp DESC LIMIT 20
-        """)
-        logs = cursor.fetchall()
-        conn.close()
-        
-        if not logs:
-            bot.send_message(message.chat.id, "📭 Логов пока нет")
-            return
-        
-        text = "📜 **Последние 20 действий:**\n\n"
-        
-        for admin_id, action, target_id, details, timestamp in logs:
-            ts = datetime.fromisoformat(timestamp).strftime("%d.%m.%Y %H:%M")
-            
-            action_emoji = {
-                "ban": "🔨",
-                "unban": "🔓",
-                "broadcast": "📢",
-                "warning": "⚠️"
-            }.get(action, "📌")
-            
-            target_text = f" над `{target_id}`" if target_id else ""
-            details_text = f"\n   • {details}" if details else ""
-            
-            text += f"{action_emoji} [{ts}] {action.upper()}{target_text}{details_text}\n\n"
-        
-        if len(text) > 4000:
-            for i in range(0, len(text), 4000):
-                bot.send_message(message.chat.id, text[i:i+4000], parse_mode="Markdown")
-        else:
-            bot.send_message(message.chat.id, text, parse_mode="Markdown")
-            
+        logs_pager.send(message.chat.id)
     except Exception as e:
         print(f"Error in show_logs: {e}")
-        bot.send_message(message.chat.id, "❌ Ошибка при получении логов")
+        send_message(message.chat.id, "❌ Ошибка при получении логов")
 
 # Рассылка
-@bot.message_handler(func=lambda m: m.text == "📢 Рассылка")
+@text_route("📢 Рассылка")
 @check_access
 def broadcast_start(message):
     if not is_admin(message.chat.id):
         return
     
-    bot.send_message(
+    send_message(
         message.chat.id,
         "📢 Введите текст для рассылки всем пользователям:"
     )
     user_state[message.chat.id] = "waiting_broadcast"
 
-@bot.message_handler(func=lambda m: user_state.get(m.chat.id) == "waiting_broadcast")
+@state_route("waiting_broadcast")
 def process_broadcast(message):
     if not is_admin(message.chat.id):
         return
@@ -1046,7 +3005,7 @@ def process_broadcast(message):
             InlineKeyboardButton("❌ Отмена", callback_data="broadcast_cancel")
         )
         
-        bot.send_message(
+        send_message(
             message.chat.id,
             f"📢 **Предпросмотр рассылки:**\n\n{broadcast_text}\n\nОтправить всем пользователям?",
             reply_markup=kb,
@@ -1058,75 +3017,255 @@ def process_broadcast(message):
         
     except Exception as e:
         print(f"Error in process_broadcast: {e}")
-        bot.send_message(message.chat.id, "❌ Ошибка")
+        send_message(message.chat.id, "❌ Ошибка")
         user_state.pop(message.chat.id, None)
 
-def process_broadcast_confirm(call):
-    if not is_admin(call.message.chat.id):
-        bot.answer_callback_query(call.id, "🚫 Доступ запрещен", show_alert=True)
-        return
-    
-    try:
-        if call.data == "broadcast_cancel":
-            bot.edit_message_text(
-                "❌ Рассылка отменена",
-                call.message.chat.id,
-                call.message.message_id
+def process_broadcast_confirm(call):
+    if not is_admin(call.message.chat.id):
+        answer_callback_query(call.id, "🚫 Доступ запрещен", show_alert=True)
+        return
+    
+    try:
+        if call.data == "broadcast_cancel":
+            edit_message_text(
+                "❌ Рассылка отменена",
+                call.message.chat.id,
+                call.message.message_id
+            )
+            answer_callback_query(call.id)
+            return
+        
+        broadcast_text = temp_data.pop(f"broadcast_{call.message.chat.id}", None)
+        if not broadcast_text:
+            answer_callback_query(call.id, "❌ Текст не найден", show_alert=True)
+            return
+        
+        # Сама отправка идет в фоновом потоке, обработчик сразу освобождается
+        job_id = create_broadcast(call.message.chat.id, broadcast_text, call.message.message_id)
+        update_broadcast_progress(job_id)
+        
+        answer_callback_query(call.id, "📢 Рассылка запущена")
+        
+    except Exception as e:
+        print(f"Error in process_broadcast_confirm: {e}")
+        answer_callback_query(call.id, "❌ Ошибка", show_alert=True)
+
+def process_broadcast_control(call):
+    if not is_admin(call.message.chat.id):
+        answer_callback_query(call.id, "🚫 Доступ запрещен", show_alert=True)
+        return
+
+    try:
+        _, action, job_id = call.data.split("_")
+        job_id = int(job_id)
+
+        # Допустимые переходы: из каких статусов и в какой
+        transitions = {
+            "pause": (("running",), "paused"),
+            "resume": (("paused",), "running"),
+            "cancel": (("running", "paused"), "cancelled"),
+        }
+        if action not in transitions:
+            answer_callback_query(call.id)
+            return
+
+        from_statuses, to_status = transitions[action]
+        if broadcast_status.get(job_id) not in from_statuses:
+            answer_callback_query(call.id, "❌ Рассылка уже в другом состоянии", show_alert=True)
+            return
+
+        set_broadcast_status(job_id, to_status)
+        if to_status == "running":
+            broadcast_wakeup.set()
+
+        update_broadcast_progress(job_id)
+        answer_callback_query(call.id)
+
+    except Exception as e:
+        print(f"Error in process_broadcast_control: {e}")
+        answer_callback_query(call.id, "❌ Ошибка", show_alert=True)
+
+# ============================================================
+# ФОНОВЫЕ РАССЫЛКИ
+# ============================================================
+
+# Сколько сообщений рассылки держать в очереди отправки одновременно.
+# Курсор сохраняется после каждого такого окна.
+BROADCAST_WINDOW = 25
+# Как часто (в секундах) обновлять сообщение с прогрессом у админа
+BROADCAST_PROGRESS_INTERVAL = 3
+# Сколько получателей читать из базы за один запрос
+BROADCAST_BATCH = 200
+
+broadcast_wakeup = threading.Event()
+# id рассылки -> статус; кнопки админа меняют его, воркер проверяет перед каждой отправкой
+broadcast_status = {}
+
+BROADCAST_STATUS_TEXT = {
+    "running": "⏳ Идет",
+    "paused": "⏸ На паузе",
+    "cancelled": "⛔ Отменена",
+    "done": "✅ Завершена",
+}
+
+def create_broadcast(admin_id, text_, message_id):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*) FROM users WHERE accepted = 1")
+    total = cursor.fetchone()[0]
+    cursor.execute("""
+        INSERT INTO broadcasts (admin_id, text, status, cursor, total, message_id, created_at)
+        VALUES (?, ?, 'running', 0, ?, ?, ?)
+    """, (admin_id, text_, total, message_id, now_epoch()))
+    job_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+
+    broadcast_status[job_id] = "running"
+    broadcast_wakeup.set()
+    return job_id
+
+def set_broadcast_status(job_id, status):
+    broadcast_status[job_id] = status
+    conn = get_db_connection()
+    finished_at = now_epoch() if status in ("cancelled", "done") else None
+    conn.execute(
+        "UPDATE broadcasts SET status = ?, finished_at = ? WHERE id = ?",
+        (status, finished_at, job_id)
+    )
+    conn.commit()
+    conn.close()
+
+def broadcast_control_keyboard(job_id, status):
+    kb = InlineKeyboardMarkup()
+    if status == "running":
+        kb.row(
+            InlineKeyboardButton("⏸ Пауза", callback_data=f"bjob_pause_{job_id}"),
+            InlineKeyboardButton("⛔ Отменить", callback_data=f"bjob_cancel_{job_id}")
+        )
+    elif status == "paused":
+        kb.row(
+            InlineKeyboardButton("▶️ Продолжить", callback_data=f"bjob_resume_{job_id}"),
+            InlineKeyboardButton("⛔ Отменить", callback_data=f"bjob_cancel_{job_id}")
+        )
+    else:
+        return None
+    return kb
+
+def update_broadcast_progress(job_id):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT admin_id, status, total, sent, failed, message_id
+        FROM broadcasts WHERE id = ?
+    """, (job_id,))
+    row = cursor.fetchone()
+    conn.close()
+    if not row:
+        return
+
+    admin_id, status, total, sent, failed, message_id = row
+    text = (
+        f"📢 Рассылка #{job_id}: {BROADCAST_STATUS_TEXT.get(status, status)}\n\n"
+        f"📊 Обработано: {sent + failed} из {total}\n"
+        f"📨 Отправлено: {sent}\n"
+        f"❌ Ошибок: {failed}"
+    )
+    edit_message_text(
+        text,
+        admin_id,
+        message_id,
+        reply_markup=broadcast_control_keyboard(job_id, status)
+    )
+
+def run_broadcast(job_id):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT admin_id, text, cursor, sent, failed FROM broadcasts WHERE id = ?", (job_id,))
+    admin_id, text_, last_chat_id, sent, failed = cursor.fetchone()
+    last_progress = time.monotonic()
+
+    while broadcast_status.get(job_id) == "running":
+        # Получатели читаются порциями по индексу, начиная после курсора
+        cursor.execute("""
+            SELECT chat_id FROM users
+            WHERE accepted = 1 AND chat_id > ?
+            ORDER BY chat_id LIMIT ?
+        """, (last_chat_id, BROADCAST_BATCH))
+        recipients = [row[0] for row in cursor.fetchall()]
+
+        if not recipients:
+            set_broadcast_status(job_id, "done")
+            log_admin_action(
+                admin_id,
+                "broadcast",
+                details=f"Отправлено: {sent}, Ошибок: {failed}"
             )
-            bot.answer_callback_query(call.id)
-            return
-        
-        broadcast_text = temp_data.pop(f"broadcast_{call.message.chat.id}", None)
-        if not broadcast_text:
-            bot.answer_callback_query(call.id, "❌ Текст не найден", show_alert=True)
-            return
-        
-        bot.edit_message_text(
-            "📢 Начинаю рассылку...",
-            call.message.chat.id,
-            call.message.message_id
-        )
-        
-        # Получаем всех принятых пользователей
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT chat_id FROM users WHERE accepted = 1")
-        users = cursor.fetchall()
-        conn.close()
-        
-        success = 0
-        failed = 0
-        
-        for (user_id,) in users:
-            try:
-                bot.send_message(user_id, f"📢 **Рассылка:**\n\n{broadcast_text}", parse_mode="Markdown")
-                success += 1
-                time.sleep(0.05)
-            except Exception as e:
-                failed += 1
-        
-        # Логируем
+            break
+
+        for i in range(0, len(recipients), BROADCAST_WINDOW):
+            if broadcast_status.get(job_id) != "running":
+                break
+
+            # Окно сообщений отдается в общую очередь отправки: лимиты и
+            # повторы при 429 соблюдает она, а ответы админу и напоминания
+            # не ждут окончания всей рассылки
+            window = recipients[i:i + BROADCAST_WINDOW]
+            futures = [
+                send_message(chat_id, f"📢 **Рассылка:**\n\n{text_}", parse_mode="Markdown")
+                for chat_id in window
+            ]
+            for future in futures:
+                if future.exception() is None:
+                    sent += 1
+                else:
+                    failed += 1
+            last_chat_id = window[-1]
+
+            # Курсор сохраняется после каждого окна: после перезапуска
+            # рассылка продолжится с того же места
+            conn.execute(
+                "UPDATE broadcasts SET cursor = ?, sent = ?, failed = ? WHERE id = ?",
+                (last_chat_id, sent, failed, job_id)
+            )
+            conn.commit()
+
+            if time.monotonic() - last_progress >= BROADCAST_PROGRESS_INTERVAL:
+                update_broadcast_progress(job_id)
+                last_progress = time.monotonic()
+
+    if broadcast_status.get(job_id) == "cancelled":
         log_admin_action(
-            call.message.chat.id,
+            admin_id,
             "broadcast",
-            details=f"Отправлено: {success}, Ошибок: {failed}"
+            details=f"Отменена. Отправлено: {sent}, Ошибок: {failed}"
         )
-        
-        bot.send_message(
-            call.message.chat.id,
-            f"✅ Рассылка завершена!\n"
-            f"📨 Отправлено: {success}\n"
-            f"❌ Ошибок: {failed}"
-        )
-        
-        bot.answer_callback_query(call.id)
-        
-    except Exception as e:
-        print(f"Error in process_broadcast_confirm: {e}")
-        bot.answer_callback_query(call.id, "❌ Ошибка", show_alert=True)
+    update_broadcast_progress(job_id)
+
+def load_broadcasts():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, status FROM broadcasts WHERE status IN ('running', 'paused')")
+    for job_id, status in cursor.fetchall():
+        broadcast_status[job_id] = status
+    conn.close()
+
+def broadcast_worker():
+    while True:
+        broadcast_wakeup.clear()
+        running = sorted(job_id for job_id, status in list(broadcast_status.items()) if status == "running")
+        if not running:
+            broadcast_wakeup.wait()
+            continue
+
+        try:
+            run_broadcast(running[0])
+        except Exception as e:
+            print(f"Error in broadcast_worker: {e}")
+            time.sleep(5)
 
 # Команды
-@bot.message_handler(func=lambda m: m.text == "📋 Команды")
+@text_route("📋 Команды")
 @check_access
 def show_admin_commands(message):
     if not is_admin(message.chat.id):
@@ -1143,7 +3282,8 @@ def show_admin_commands(message):
         "/ban [ID] [время] - Заблокировать\n"
         "/unban [ID] - Разблокировать\n"
         "/bans - Список блокировок\n"
-        "/broadcast [текст] - Рассылка\n\n"
+        "/broadcast [текст] - Рассылка\n"
+        "/reconcile - Пересчитать счетчики статистики\n\n"
         "**Примеры ban:**\n"
         "/ban 123456789 permanent\n"
         "/ban 123456789 7d\n"
@@ -1154,147 +3294,171 @@ def show_admin_commands(message):
         "• 3h - 3 часа"
     )
     
-    bot.send_message(message.chat.id, commands_text, parse_mode="Markdown")
+    send_message(message.chat.id, commands_text, parse_mode="Markdown")
 
 # Альтернативные команды через /
 @bot.message_handler(commands=["admin"])
+@timed
 def admin_command(message):
     if is_admin(message.chat.id):
         admin_panel(message)
     else:
-        bot.send_message(message.chat.id, "🚫 Доступ запрещен")
+        send_message(message.chat.id, "🚫 Доступ запрещен")
 
 @bot.message_handler(commands=["stats"])
+@timed
 def stats_command(message):
     if is_admin(message.chat.id):
         show_statistics(message)
     else:
-        bot.send_message(message.chat.id, "🚫 Доступ запрещен")
+        send_message(message.chat.id, "🚫 Доступ запрещен")
 
 @bot.message_handler(commands=["users"])
+@timed
 def users_command(message):
     if is_admin(message.chat.id):
         list_users(message)
     else:
-        bot.send_message(message.chat.id, "🚫 Доступ запрещен")
+        send_message(message.chat.id, "🚫 Доступ запрещен")
 
 @bot.message_handler(commands=["bans"])
+@timed
 def bans_command(message):
     if is_admin(message.chat.id):
         list_bans(message)
     else:
-        bot.send_message(message.chat.id, "🚫 Доступ запрещен")
+        send_message(message.chat.id, "🚫 Доступ запрещен")
+
+@bot.message_handler(commands=["reconcile"])
+@timed
+def reconcile_command(message):
+    if not is_admin(message.chat.id):
+        send_message(message.chat.id, "🚫 Доступ запрещен")
+        return
+
+    try:
+        # Сначала дописываем отложенные вставки, чтобы пересчет их учел
+        flush_writes()
+        before, _ = read_counters()
+        totals = reconcile_counters_now()
+        changed = [
+            f"• {name}: {before.get(name, 0)} → {value}"
+            for name, value in totals.items() if before.get(name, 0) != value
+        ]
+        log_admin_action(message.chat.id, "reconcile", None, f"Исправлено: {len(changed)}")
+        send_message(
+            message.chat.id,
+            "✅ Счетчики пересчитаны\n\n" + ("\n".join(changed) or "Расхождений нет")
+        )
+    except Exception as e:
+        print(f"Error in reconcile_command: {e}")
+        send_message(message.chat.id, "❌ Ошибка при пересчете счетчиков")
 
 # ============================================================
 # ОСНОВНЫЕ ФУНКЦИИ БОТА
 # ============================================================
 
-@bot.message_handler(func=lambda m: m.text == "➕ Добавить напоминание")
+@text_route("➕ Добавить напоминание")
 @check_access
 def add_reminder(message):
     try:
-        bot.send_message(message.chat.id, "📅 Выберите год:", reply_markup=year_keyboard())
+        send_message(message.chat.id, "📅 Выберите год:", reply_markup=year_keyboard())
     except Exception as e:
         print(f"Error in add_reminder: {e}")
-        bot.send_message(message.chat.id, "❌ Ошибка при создании напоминания")
+        send_message(message.chat.id, "❌ Ошибка при создании напоминания")
+
+def format_reminder(text_, remind_time):
+    return f"• {from_epoch(remind_time).strftime('%d.%m.%Y')}: {escape_field(text_)}\n"
+
+# Ближайшие сначала; индекс idx_reminders_chat(chat_id, done, remind_time) + id
+reminders_pager = Pager(
+    "r", "📋 **Ваши напоминания**", "📭 У вас нет активных напоминаний",
+    table="reminders",
+    columns="text, remind_time",
+    keys=["remind_time", "id"],
+    format_row=format_reminder,
+    where="chat_id = ? AND done = 0",
+    scoped=True
+)
 
-@bot.message_handler(func=lambda m: m.text == "📋 Список напоминаний")
+@text_route("📋 Список напоминаний")
 @check_access
 def list_reminders(message):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT text, remind_time FROM reminders 
-            WHERE chat_id = ? AND done = 0 
-            ORDER BY remind_time ASC LIMIT 10
-        """, (message.chat.id,))
-        reminders = cursor.fetchall()
-        conn.close()
-        
-        if not reminders:
-            bot.send_message(message.chat.id, "📭 У вас нет активных напоминаний")
-            return
-        
-        text = "📋 **Ваши напоминания:**\n\n"
-        for reminder in reminders:
-            remind_time = datetime.fromisoformat(reminder[1]).strftime("%d.%m.%Y")
-            text += f"• {remind_time}: {reminder[0]}\n"
-        
-        bot.send_message(message.chat.id, text, parse_mode="Markdown")
+        reminders_pager.send(message.chat.id)
     except Exception as e:
         print(f"Error in list_reminders: {e}")
-        bot.send_message(message.chat.id, "❌ Ошибка при получении списка")
+        send_message(message.chat.id, "❌ Ошибка при получении списка")
 
-@bot.message_handler(func=lambda m: m.text == "❌ Удалить напоминание")
+@text_route("❌ Удалить напоминание")
 @check_access
 def delete_reminder(message):
-    bot.send_message(message.chat.id, "❌ Функция удаления напоминаний в разработке")
+    send_message(message.chat.id, "❌ Функция удаления напоминаний в разработке")
 
-@bot.message_handler(func=lambda m: m.text == "🎂 Добавить день рождения")
+@text_route("🎂 Добавить день рождения")
 @check_access
 def add_birthday(message):
-    bot.send_message(message.chat.id, "Введите: Имя ГГГГ-ММ-ДД\nПример: Анна 1990-05-15")
+    send_message(message.chat.id, "Введите: Имя ГГГГ-ММ-ДД\nПример: Анна 1990-05-15")
+
+def format_birthday(name, birth_date):
+    today = clock.now().date()
+    bdate = datetime.strptime(birth_date, "%Y-%m-%d").date()
+    next_bd = next_birthday(bdate, today)
+
+    days_left = (next_bd - today).days
+    return f"• {escape_field(name)}: {days_left} дней ({(next_bd).strftime('%d.%m')})\n"
+
+# Ближайшие сначала; индекс idx_birthdays_chat_next(chat_id, next_occurrence) + id
+birthdays_pager = Pager(
+    "d", "🎉 **Дни рождения**", "🎂 У вас нет сохраненных дней рождения",
+    table="birthdays",
+    columns="name, birth_date",
+    keys=["next_occurrence", "id"],
+    format_row=format_birthday,
+    where="chat_id = ? AND next_occurrence IS NOT NULL",
+    scoped=True
+)
 
-@bot.message_handler(func=lambda m: m.text == "🎉 Сколько дней до ДР")
+@text_route("🎉 Сколько дней до ДР")
 @check_access
 def days_to_birthday(message):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT name, birth_date FROM birthdays WHERE chat_id = ?", (message.chat.id,))
-        birthdays = cursor.fetchall()
-        conn.close()
-        
-        if not birthdays:
-            bot.send_message(message.chat.id, "🎂 У вас нет сохраненных дней рождения")
-            return
-        
-        today = datetime.now(TZ).date()
-        text = "🎉 **Дни рождения:**\n\n"
-        
-        for name, birth_date in birthdays:
-            bdate = datetime.strptime(birth_date, "%Y-%m-%d").date()
-            next_bd = bdate.replace(year=today.year)
-            
-            if next_bd < today:
-                next_bd = next_bd.replace(year=today.year + 1)
-            
-            days_left = (next_bd - today).days
-            text += f"• {name}: {days_left} дней ({(next_bd).strftime('%d.%m')})\n"
-        
-        bot.send_message(message.chat.id, text, parse_mode="Markdown")
+        birthdays_pager.send(message.chat.id)
     except Exception as e:
         print(f"Error in days_to_birthday: {e}")
-        bot.send_message(message.chat.id, "❌ Ошибка при подсчете")
+        send_message(message.chat.id, "❌ Ошибка при подсчете")
 
-@bot.message_handler(func=lambda m: m.text == "⏱ Таймер")
+@text_route("⏱ Таймер")
 @check_access
 def timer_help(message):
-    bot.send_message(message.chat.id, "Введите: количество минут текст\nПример: 10 Сделать чай")
+    send_message(message.chat.id, "Введите: количество минут текст\nПример: 10 Сделать чай")
 
-@bot.message_handler(func=lambda m: "-" in m.text and len(m.text.split()) == 2)
+@pattern_route(r"^\S+\s+\d{4}-\d{1,2}-\d{1,2}$")
 @check_access
 def save_birthday(message):
     try:
         name, birth_date = message.text.split()
         # Проверка формата даты
-        datetime.strptime(birth_date, "%Y-%m-%d")
+        bdate = datetime.strptime(birth_date, "%Y-%m-%d").date()
+        next_bd = next_birthday(bdate, clock.now().date())
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO birthdays(chat_id, name, birth_date) VALUES (?, ?, ?)",
-                       (message.chat.id, name, birth_date))
-        conn.commit()
-        conn.close()
-        bot.send_message(message.chat.id, f"🎂 День рождения {name} ({birth_date}) сохранен!")
+        saved = submit_write("INSERT INTO birthdays(chat_id, name, birth_date, next_occurrence) VALUES (?, ?, ?, ?)",
+                             (message.chat.id, name, birth_date, next_bd.isoformat()))
+
+        def confirm(saved):
+            if saved.exception() is not None:
+                send_message(message.chat.id, "❌ Ошибка при сохранении")
+                return
+            send_message(message.chat.id, f"🎂 День рождения {name} ({birth_date}) сохранен!")
+
+        saved.add_done_callback(confirm)
     except ValueError:
-        bot.send_message(message.chat.id, "❌ Неверный формат даты. Используйте ГГГГ-ММ-ДД")
+        send_message(message.chat.id, "❌ Неверный формат даты. Используйте ГГГГ-ММ-ДД")
     except Exception as e:
         print(f"Error in save_birthday: {e}")
-        bot.send_message(message.chat.id, "❌ Ошибка при сохранении")
+        send_message(message.chat.id, "❌ Ошибка при сохранении")
 
-@bot.message_handler(func=lambda m: m.text and m.text.split()[0].isdigit())
+@pattern_route(r"^\d+(\s|$)")
 @check_access
 def set_timer(message):
     try:
@@ -1302,131 +3466,573 @@ def set_timer(message):
         minutes = int(parts[0])
         text_ = parts[1] if len(parts) > 1 else "Таймер!"
 
-        end_time = datetime.now(TZ) + timedelta(minutes=minutes)
+        end_time = now_epoch() + minutes * 60
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO timers(chat_id, end_time, text) VALUES (?, ?, ?)",
-                       (message.chat.id, end_time.isoformat(), text_))
-        conn.commit()
-        conn.close()
+        saved = submit_write("INSERT INTO timers(chat_id, end_time, text) VALUES (?, ?, ?)",
+                             (message.chat.id, end_time, text_))
+
+        def confirm(saved):
+            if saved.exception() is not None:
+                send_message(message.chat.id, "❌ Ошибка при установке таймера")
+                return
+            # Кладем таймер в планировщик, как только известен его id
+            schedule_timer(saved.result(), message.chat.id, end_time, text_)
+            send_message(message.chat.id, f"⏱ Таймер на {minutes} минут установлен")
 
-        bot.send_message(message.chat.id, f"⏱ Таймер на {minutes} минут установлен")
+        saved.add_done_callback(confirm)
     except ValueError:
-        bot.send_message(message.chat.id, "❌ Введите число минут")
+        send_message(message.chat.id, "❌ Введите число минут")
     except Exception as e:
         print(f"Error in set_timer: {e}")
-        bot.send_message(message.chat.id, "❌ Ошибка при установке таймера")
+        send_message(message.chat.id, "❌ Ошибка при установке таймера")
 
 # ============================================================
 # ОБРАБОТЧИК ПО УМОЛЧАНИЮ
 # ============================================================
 
-@bot.message_handler(func=lambda m: True)
 @check_access
 def handle_other_messages(message):
-    if message.text not in ["➕ Добавить напоминание", "📋 Список напоминаний", 
-                           "❌ Удалить напоминание", "🎂 Добавить день рождения", 
-                           "🎉 Сколько дней до ДР", "⏱ Таймер", "⚙️ Админ панель", 
-                           "📊 Статистика", "👥 Список пользователей", "🔨 Заблокировать", 
-                           "🔓 Разблокировать", "🚫 Список блокировок", 
-                           "📜 Логи действий", "📢 Рассылка", "📋 Команды",
-                           "◀️ Назад в меню"]:
-        bot.send_message(message.chat.id, "Используйте кнопки меню")
+    send_message(message.chat.id, "Используйте кнопки меню")
+
+# Единственный обработчик текстовых сообщений; регистрируется последним,
+# поэтому команды (/start, /admin, ...) обрабатываются своими хендлерами
+@bot.message_handler(func=lambda m: True)
+def route_message(message):
+    handler = find_route(message)
+    route_hits[handler.__name__] = route_hits.get(handler.__name__, 0) + 1
+    with MetricTimer(f"handler.{handler.__name__}"):
+        return handler(message)
+
+# ============================================================
+# ЗАХВАТ И ПОДТВЕРЖДЕНИЕ ДОСТАВКИ
+# ============================================================
+
+# Напоминания и таймеры отправляются в три шага:
+#   1. claim - короткая транзакция помечает строку claimed_until = сейчас + CLAIM_LEASE
+#      и сразу коммитится, так что блокировка записи не ждет сети;
+#   2. deliver - сообщение уходит через очередь отправки вне всякой транзакции;
+#   3. ack/release - по итогу отправки каждая строка отдельно подтверждается
+#      (напоминание закрывается или переносится, таймер удаляется) или
+#      освобождается для повтора. Обе записи идут через групповую запись.
+# Доставка "хотя бы один раз": если бот упал между отправкой и ack, строка
+# снова будет отправлена - после перезапуска (release_stale_claims) или
+# когда истечет аренда. Строка, не доставленная CLAIM_MAX_ATTEMPTS раз
+# подряд (бот заблокирован пользователем и т.п.), подтверждается без доставки.
+
+# Аренда должна перекрывать время в очереди отправки, иначе следующий
+# проход checker захватит строку повторно и сообщение уйдет дважды
+CLAIM_LEASE = 15 * 60
+CLAIM_MAX_ATTEMPTS = 3
+# Через сколько секунд повторить таймер, который не удалось доставить
+CLAIM_RETRY_DELAY = 60
+
+def release_stale_claims():
+    # Бот работает одним процессом: захваты, оставшиеся от прошлого запуска,
+    # уже никто не подтвердит, и ждать конца аренды незачем
+    conn = get_db_connection()
+    conn.execute("UPDATE reminders SET claimed_until = NULL WHERE claimed_until IS NOT NULL")
+    conn.execute("UPDATE timers SET claimed_until = NULL WHERE claimed_until IS NOT NULL")
+    conn.commit()
+    conn.close()
+
+def claim_row(conn, table, row_id, now_ts):
+    # True, если строку захватили мы; коммит - за вызывающим
+    cursor = conn.execute(
+        f"UPDATE {table} SET claimed_until = ? WHERE id = ? AND (claimed_until IS NULL OR claimed_until <= ?)",
+        (now_ts + CLAIM_LEASE, row_id, now_ts)
+    )
+    return cursor.rowcount == 1
+
+def deliver_claimed(kind, due, chat_id, text, ack, release):
+    # Отправка захваченной строки; ack() или release() вызываются из потока
+    # очереди отправки, когда Telegram принял сообщение или отказал
+    future = send_scheduled(kind, due, chat_id, text)
+
+    def done(future):
+        try:
+            if future.exception() is None:
+                ack()
+            else:
+                release()
+        except Exception as e:
+            print(f"Error in deliver_claimed: {kind}: {e}")
+
+    future.add_done_callback(done)
+    return future
+
+# ============================================================
+# ПЛАНИРОВЩИК ТАЙМЕРОВ
+# ============================================================
+
+# Таймеры - это отложенные задачи общего планировщика (см. "ОТЛОЖЕННЫЕ ЗАДАЧИ"):
+# поток спит ровно до ближайшего дедлайна, поэтому стоимость ожидания
+# не зависит от количества таймеров, которые еще не наступили.
+
+def schedule_timer(timer_id, chat_id, end_time, text_):
+    return schedule_at(end_time, fire_timer, timer_id, chat_id, end_time, text_)
+
+def load_timers():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, chat_id, end_time, text FROM timers WHERE end_time IS NOT NULL")
+    rows = cursor.fetchall()
+    conn.close()
+
+    for tid, chat_id, end_time, text_ in rows:
+        schedule_timer(tid, chat_id, end_time, text_)
+
+def fire_timer(timer_id, chat_id, end_time, text_):
+    conn = get_db_connection()
+    try:
+        now_ts = now_epoch()
+        claimed = claim_row(conn, "timers", timer_id, now_ts)
+        row = conn.execute("SELECT attempts FROM timers WHERE id = ?", (timer_id,)).fetchone()
+        conn.commit()
+    finally:
+        conn.close()
+    # Таймер удален или его уже отправляет другой запуск
+    if not claimed or row is None:
+        return
+
+    attempts = row[0] + 1
+
+    def ack():
+        submit_write("DELETE FROM timers WHERE id = ?", (timer_id,))
+
+    def release():
+        if attempts >= CLAIM_MAX_ATTEMPTS:
+            print(f"Error in fire_timer: timer {timer_id} not delivered after {attempts} attempts")
+            ack()
+            return
+        released = submit_write(
+            "UPDATE timers SET claimed_until = NULL, attempts = ? WHERE id = ?",
+            (attempts, timer_id)
+        )
+        # Повтор - только после записи, иначе он застанет строку захваченной
+        released.add_done_callback(
+            lambda _: schedule_in(CLAIM_RETRY_DELAY, fire_timer, timer_id, chat_id, end_time, text_)
+        )
+
+    deliver_claimed("timer", end_time, chat_id, f"⏱ Таймер закончился!\n\n{text_}", ack, release)
+
+# ============================================================
+# ДОСТАВКА НАПОМИНАНИЙ
+# ============================================================
+
+# У напоминания с notify_before > 0 два уведомления: заранее, за notify_before
+# минут, и в сам срок. Момент следующего из них хранится в notify_at, поэтому
+# checker выбирает по индексу idx_reminders_notify только наступившие,
+# а не все напоминания на сутки вперед. Если ранний момент проспали (бот
+# не работал) и срок уже прошел, уходит только уведомление в срок.
+
+def add_months(dt, months):
+    month_index = dt.month - 1 + months
+    year = dt.year + month_index // 12
+    month = month_index % 12 + 1
+    day = min(dt.day, calendar.monthrange(year, month)[1])
+    return dt.replace(year=year, month=month, day=day)
+
+def next_reminder_time(dt, repeat_type):
+    if repeat_type == "daily":
+        return dt + timedelta(days=1)
+    if repeat_type == "weekly":
+        return dt + timedelta(weeks=1)
+    if repeat_type == "monthly":
+        return add_months(dt, 1)
+    if repeat_type == "yearly":
+        return add_months(dt, 12)
+    return None
+
+def next_reminder_epoch(remind_time, repeat_type):
+    # Повторы считаем по московскому календарю, а не прибавлением секунд
+    local = from_epoch(remind_time).replace(tzinfo=None)
+    next_local = next_reminder_time(local, repeat_type)
+    if next_local is None:
+        return None
+    return to_epoch(next_local)
+
+def claim_due_reminders(conn, now_ts):
+    # Шаг claim: короткая транзакция, без сети
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT id, chat_id, text, remind_time, repeat_type, notify_before, notify_at, attempts
+        FROM reminders
+        WHERE done = 0 AND notify_at <= ? AND (claimed_until IS NULL OR claimed_until <= ?)
+        ORDER BY notify_at
+    """, (now_ts, now_ts))
+    rows = cursor.fetchall()
+
+    claimed = []
+    for row in rows:
+        if claim_row(conn, "reminders", row[0], now_ts):
+            claimed.append(row)
+    conn.commit()
+    return claimed
+
+def reminder_ack(rid, next_ts, notify_before=0):
+    if next_ts is None:
+        return submit_write(
+            "UPDATE reminders SET done = 1, claimed_until = NULL, attempts = 0 WHERE id = ?", (rid,)
+        )
+    return submit_write(
+        "UPDATE reminders SET remind_time = ?, notify_at = ?, claimed_until = NULL, attempts = 0 WHERE id = ?",
+        (next_ts, next_ts - notify_before * 60, rid)
+    )
+
+def reminder_early_ack(rid, remind_time):
+    # Раннее уведомление отправлено - следующее будет в сам срок
+    return submit_write(
+        "UPDATE reminders SET notify_at = ?, claimed_until = NULL, attempts = 0 WHERE id = ?",
+        (remind_time, rid)
+    )
+
+def reminder_release(rid, attempts, ack):
+    if attempts >= CLAIM_MAX_ATTEMPTS:
+        print(f"Error in deliver_reminders: reminder {rid} not delivered after {attempts} attempts")
+        return ack()
+    # Следующий проход checker захватит напоминание снова
+    return submit_write(
+        "UPDATE reminders SET claimed_until = NULL, attempts = ? WHERE id = ?", (attempts, rid)
+    )
+
+def deliver_reminders(conn, now):
+    now_ts = int(now.timestamp())
+
+    for rid, chat_id, text_, remind_time, repeat_type, notify_before, notify_at, attempts in claim_due_reminders(conn, now_ts):
+        try:
+            if remind_time > now_ts:
+                minutes_left = (remind_time - now_ts) // 60
+                reminder_text = f"🔔 Напоминание (через {minutes_left} мин.):\n\n{text_}"
+                ack = functools.partial(reminder_early_ack, rid, remind_time)
+            else:
+                reminder_text = f"🔔 Напоминание!\n\n{text_}"
+                next_ts = next_reminder_epoch(remind_time, repeat_type)
+                # Если бот долго не работал - пропускаем прошедшие повторы
+                while next_ts is not None and next_ts <= now_ts:
+                    next_ts = next_reminder_epoch(next_ts, repeat_type)
+                ack = functools.partial(reminder_ack, rid, next_ts, notify_before or 0)
+
+            deliver_claimed(
+                "reminder", notify_at, chat_id, reminder_text,
+                ack, functools.partial(reminder_release, rid, attempts + 1, ack)
+            )
+        except Exception as e:
+            print(f"Error in deliver_reminders: reminder {rid}: {e}")
+            reminder_release(rid, attempts + 1, functools.partial(reminder_ack, rid, None))
+
+# ============================================================
+# ПОЗДРАВЛЕНИЯ С ДНЕМ РОЖДЕНИЯ
+# ============================================================
+
+# Час (по Москве), после которого запускается ежедневная рассылка поздравлений
+BIRTHDAY_HOUR = 9
+
+# Дата последнего запуска, чтобы задача выполнялась один раз в сутки
+last_birthday_run = None
+
+def run_birthday_job(conn, today):
+    cursor = conn.cursor()
+    # Берем только записи, у которых ближайшая дата уже наступила (поиск по индексу)
+    cursor.execute("""
+        SELECT id, chat_id, name, birth_date, next_occurrence
+        FROM birthdays
+        WHERE next_occurrence <= ?
+    """, (today.isoformat(),))
+    rows = cursor.fetchall()
+
+    to_send = []
+    advanced = []
+
+    for bid, chat_id, name, birth_date, next_occurrence in rows:
+        try:
+            bdate = datetime.strptime(birth_date, "%Y-%m-%d").date()
+
+            # Пропущенные дни (бот был выключен) не поздравляем задним числом
+            if next_occurrence == today.isoformat():
+                cursor.execute("""
+                    INSERT OR IGNORE INTO birthday_notifications(birthday_id, year, sent_at)
+                    VALUES (?, ?, ?)
+                """, (bid, today.year, now_epoch()))
+                if cursor.rowcount == 1:
+                    to_send.append((chat_id, name))
+
+            next_bd = next_birthday(bdate, today + timedelta(days=1))
+            advanced.append((next_bd.isoformat(), bid))
+        except Exception as e:
+            print(f"Error in run_birthday_job: birthday {bid}: {e}")
+
+    # Сначала фиксируем журнал, чтобы после перезапуска не поздравить повторно
+    conn.commit()
+
+    # Срок поздравления - BIRTHDAY_HOUR по Москве
+    due = to_epoch(datetime(today.year, today.month, today.day, BIRTHDAY_HOUR))
+    for chat_id, name in to_send:
+        send_scheduled("birthday", due, chat_id, f"🎉 Сегодня день рождения у {name}!")
+
+    cursor.executemany("UPDATE birthdays SET next_occurrence = ? WHERE id = ?", advanced)
+    conn.commit()
 
 # ============================================================
 # CHECKER (исправлен)
 # ============================================================
 
+# Один проход проверки; вынесен отдельно, чтобы его можно было
+# вызвать из бенчмарка (bot_benchmark.py)
+def run_checker_sweep(now):
+    global last_birthday_run
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    # Напоминания
+    with MetricTimer("checker.reminders"):
+        deliver_reminders(conn, now)
+
+    # Дни рождения - один раз в сутки
+    today = now.date()
+    if now.hour >= BIRTHDAY_HOUR and last_birthday_run != today:
+        with MetricTimer("checker.birthdays"):
+            run_birthday_job(conn, today)
+        last_birthday_run = today
+
+    # Брошенные диалоги
+    with MetricTimer("checker.fsm"):
+        user_state.evict_expired()
+        temp_data.evict_expired()
+
+    # Проверка истекших блокировок
+    with MetricTimer("checker.bans"):
+        cursor.execute(
+            "SELECT chat_id FROM bans WHERE until IS NOT NULL AND until < ?",
+            (int(now.timestamp()),)
+        )
+        bans = cursor.fetchall()
+
+        for (chat_id,) in bans:
+            cursor.execute("DELETE FROM bans WHERE chat_id=?", (chat_id,))
+            cache_unban(chat_id)
+            send_message(chat_id, "🔓 Срок вашей блокировки истек")
+
+    # Опоздания уведомлений за прошедшие 30 секунд
+    with MetricTimer("checker.lateness"):
+        hours = flush_lateness(conn)
+
+    with MetricTimer("checker.commit"):
+        conn.commit()
+
+    alerts = check_lateness_slo(conn, hours)
+    conn.close()
+    send_lateness_alerts(alerts)
+
 def checker():
     while True:
         try:
-            now = datetime.now(TZ)
-            conn = get_db_connection()
-            cursor = conn.cursor()
-
-            # Таймеры
-            cursor.execute("SELECT id, chat_id, end_time, text FROM timers")
-            timers = cursor.fetchall()
-
-            for tid, chat_id, end_time, text_ in timers:
-                try:
-                    end_dt = datetime.fromisoformat(end_time)
-                    if end_dt <= now:
-                        try:
-                            bot.send_message(chat_id, f"⏱ Таймер закончился!\n\n{text_}")
-                        except:
-                            pass
-                        cursor.execute("DELETE FROM timers WHERE id=?", (tid,))
-                except:
-                    pass
-
-            # Дни рождения
-            cursor.execute("SELECT chat_id, name, birth_date FROM birthdays")
-            bds = cursor.fetchall()
-
-            today = now.date()
-
-            for chat_id, name, bd in bds:
-                try:
-                    bdate = datetime.strptime(bd, "%Y-%m-%d").date()
-                    next_bd = bdate.replace(year=today.year)
-
-                    if next_bd < today:
-                        next_bd = next_bd.replace(year=today.year + 1)
-
-                    if (next_bd - today).days == 0 and now.hour == 9:
-                        try:
-                            bot.send_message(chat_id, f"🎉 Сегодня день рождения у {name}!")
-                        except:
-                            pass
-                except:
-                    pass
-
-            # Проверка истекших блокировок
-            cursor.execute("SELECT chat_id, until FROM bans WHERE until != 'permanent'")
-            bans = cursor.fetchall()
-            
-            for chat_id, until in bans:
-                try:
-                    until_dt = datetime.fromisoformat(until)
-                    if now > until_dt:
-                        cursor.execute("DELETE FROM bans WHERE chat_id=?", (chat_id,))
-                        try:
-                            bot.send_message(chat_id, "🔓 Срок вашей блокировки истек")
-                        except:
-                            pass
-                except:
-                    pass
-
-            conn.commit()
-            conn.close()
-
+            run_checker_sweep(clock.now())
         except Exception as e:
             print(f"Error in checker: {e}")
             try:
-                conn.close()
+                get_db_connection().close()
             except:
                 pass
         
-        time.sleep(30)
+        clock.sleep(30)
+
+# ============================================================
+# ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА
+# ============================================================
+
+# Обновления распределяются по воркерам по chat_id: сообщения одного чата
+# всегда попадают в одну очередь и обрабатываются строго по порядку
+# (важно для user_state/temp_data), а разные чаты обрабатываются параллельно.
+UPDATE_WORKERS = 8
+UPDATE_SHARD_QUEUE_SIZE = 1000
+
+update_shards = []
+
+def update_chat_id(update):
+    for name in ("message", "edited_message", "channel_post", "edited_channel_post",
+                 "my_chat_member", "chat_member", "chat_join_request"):
+        obj = getattr(update, name, None)
+        if obj is not None:
+            return obj.chat.id
+
+    call = getattr(update, "callback_query", None)
+    if call is not None:
+        if call.message is not None:
+            return call.message.chat.id
+        return call.from_user.id
+
+    for name in ("inline_query", "chosen_inline_result", "shipping_query", "pre_checkout_query"):
+        obj = getattr(update, name, None)
+        if obj is not None:
+            return obj.from_user.id
+
+    return None
+
+def dispatch_updates(updates):
+    # Если воркеры не запущены (например, модуль импортирован скриптом) - обрабатываем сразу
+    if not update_shards:
+        bot.process_updates_now(updates)
+        return
+
+    for update in updates:
+        chat_id = update_chat_id(update)
+        key = chat_id if chat_id is not None else update.update_id
+        # Очередь ограничена: при перегрузке polling/webhook ждут, а не копят память
+        update_shards[key % len(update_shards)].put(update)
+
+def update_worker(shard):
+    while True:
+        update = shard.get()
+        try:
+            bot.process_updates_now([update])
+        except Exception as e:
+            print(f"Error in update_worker: {e}")
+
+def update_queue_depths():
+    return [shard.qsize() for shard in update_shards]
+
+def start_update_workers():
+    for _ in range(UPDATE_WORKERS):
+        shard = queue.Queue(maxsize=UPDATE_SHARD_QUEUE_SIZE)
+        update_shards.append(shard)
+        threading.Thread(target=update_worker, args=(shard,), daemon=True).start()
+
+# ============================================================
+# WEBHOOK
+# ============================================================
+
+# Обновления от Telegram складываются в ограниченную очередь, HTTP-ответ
+# отдается сразу. Если очередь заполнена, отвечаем 503 - Telegram
+# повторит доставку позже, а память бота не растет.
+webhook_queue = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+webhook_stats = {"accepted": 0, "rejected": 0, "forbidden": 0, "failed": 0}
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self.send_error(404)
+            return
+
+        secret = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+            webhook_stats["forbidden"] += 1
+            self.send_error(403)
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+
+        try:
+            webhook_queue.put_nowait(body)
+        except queue.Full:
+            webhook_stats["rejected"] += 1
+            self.send_error(503)
+            return
+
+        webhook_stats["accepted"] += 1
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        # Не печатаем строку на каждый запрос
+        pass
+
+class WebhookServer(ThreadingHTTPServer):
+    # Стандартной очереди из 5 соединений не хватает при всплесках
+    request_queue_size = 128
+    daemon_threads = True
+
+def webhook_worker():
+    while True:
+        body = webhook_queue.get()
+        try:
+            update = telebot.types.Update.de_json(body.decode("utf-8"))
+            bot.process_new_updates([update])
+        except Exception as e:
+            webhook_stats["failed"] += 1
+            print(f"Error in webhook_worker: {e}")
+
+def start_webhook_server():
+    server = WebhookServer((WEBHOOK_HOST, WEBHOOK_PORT), WebhookHandler)
+    for _ in range(WEBHOOK_WORKERS):
+        threading.Thread(target=webhook_worker, daemon=True).start()
+    return server
+
+def run_webhook():
+    server = start_webhook_server()
+    bot.remove_webhook()
+    bot.set_webhook(url=WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    print(f"Webhook слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+def run_polling():
+    while True:
+        try:
+            # getUpdates не работает, пока у бота установлен webhook; при 429
+            # или сетевой ошибке снятие повторится вместе с polling
+            bot.remove_webhook()
+            bot.polling(none_stop=True, interval=0, timeout=20)
+        except Exception as e:
+            print(f"Ошибка в polling: {e}")
+            time.sleep(5)
 
 # ============================================================
 # ЗАПУСК
 # ============================================================
 
-if __name__ == "__main__":
-    print(f"Бот запущен. Админ ID: {ADMIN_ID}")
-    print("Нажмите Ctrl+C для остановки")
-    
+# Все фоновые части бота; вызывается при запуске и из replay_harness.py
+def start_services():
+    # Загружаем кэш доступа
+    load_access_cache()
+
+    # Запускаем групповую запись в базу
+    start_writer()
+
+    # Запускаем очередь исходящих сообщений и воркеры обработки обновлений
+    start_outbox()
+    start_update_workers()
+
+    # Захваты прошлого запуска уже не подтвердятся - отправим эти строки заново
+    release_stale_claims()
+
+    # Загружаем таймеры из базы и запускаем планировщик отложенных задач
+    load_timers()
+    task_thread = threading.Thread(target=delayed_task_worker, daemon=True)
+    task_thread.start()
+
+    # Продолжаем незавершенные рассылки
+    load_broadcasts()
+    broadcast_thread = threading.Thread(target=broadcast_worker, daemon=True)
+    broadcast_thread.start()
+
     # Запускаем checker в отдельном потоке
     checker_thread = threading.Thread(target=checker, daemon=True)
     checker_thread.start()
+
+if __name__ == "__main__":
+    print(f"Бот запущен. Админ ID: {ADMIN_ID}")
+    print("Нажмите Ctrl+C для остановки")
     
+    # Локальная страница /metrics
+    if METRICS_ENABLED and METRICS_PORT:
+        try:
+            start_metrics_server()
+            print(f"Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+        except Exception as e:
+            print(f"Error in start_metrics_server: {e}")
+
+    start_services()
+
     # Запускаем бота с обработкой ошибок
-    while True:
+    if RUN_MODE == "webhook":
         try:
-            bot.polling(none_stop=True, interval=0, timeout=20)
+            run_webhook()
         except Exception as e:
-            print(f"Ошибка в polling: {e}")
-            time.sleep(5)
+            print(f"Ошибка webhook: {e}. Переключаюсь на polling")
+
+    run_polling()